@@ -0,0 +1,358 @@
+import shutil
+import sys
+from pathlib import Path
+
+import numpy as np
+from brainglobe_atlasapi import BrainGlobeAtlas
+from brainglobe_utils.brainmapper import analysis as brainglobe_analysis
+from brainglobe_utils.IO.cells import get_cells, save_cells
+from brainreg.core.paths import Paths as BrainRegPaths
+
+from brainglobe_workflows.brainmapper import analyse
+from brainglobe_workflows.brainmapper.artifacts import get_image_shape
+from brainglobe_workflows.brainmapper.cell_arrays import (
+    read_cell_arrays,
+    save_cell_arrays,
+)
+from brainglobe_workflows.brainmapper.main import (
+    generate_heatmap,
+    get_downsampled_space,
+)
+from brainglobe_workflows.brainmapper.parser import brainmapper_parser
+from brainglobe_workflows.brainmapper.prep import (
+    Paths,
+    prep_brainmapper_general,
+)
+from brainglobe_workflows.brainmapper.summary import (
+    summarise_points_by_atlas_region,
+)
+from brainglobe_workflows.brainmapper.synthetic import (
+    SYNTHETIC_BACKGROUND_FILENAME,
+    SYNTHETIC_ORIENTATION,
+    SYNTHETIC_SIGNAL_FILENAME,
+    generate_synthetic_atlas,
+    generate_synthetic_registration,
+)
+from brainglobe_workflows.brainmapper.transform import (
+    transform_points_to_atlas_space,
+)
+
+N_CELLS_PARAMS = [1_000, 10_000]
+VOXEL_SIZES = (50, 50, 50)
+
+
+class BrainmapperBenchmark:
+    """
+    A base class for timing benchmarks for the brainmapper workflow stages
+    that run after the registration and cell classification.
+
+    It includes:
+     - a setup_cache function that writes a synthetic atlas to the local
+       BrainGlobe directory, and synthetic registration and classification
+       outputs for each number of cells in `N_CELLS_PARAMS`. This function
+       runs only once before all repeats of the benchmark, and needs no
+       network access.
+     - a setup function, that prepares the brainmapper input arguments for
+       a new output directory, reading the registration outputs and cells
+       from the synthetic data.
+     - a teardown function, that removes the output directory.
+
+    Subclasses that define an `n_cells` parameter run on the synthetic data
+    with that number of cells; the others on the first one.
+
+    See the cellfinder benchmarks for the asv nomenclature.
+    """
+
+    timeout = 600  # default: 60 s
+    version = None
+    warmup_time = 0.1  # seconds
+    rounds = 2
+    repeat = 0
+    sample_time = 0.01  # default: 10 ms = 0.01 s;
+    min_run_count = 2  # default:2
+
+    synthetic_dir = Path("brainmapper_synthetic")
+
+    def setup_cache(self):
+        """
+        Write the synthetic atlas and registration outputs.
+
+        The atlas is written to the BrainGlobe directory in the BrainGlobe
+        config, so that brainmapper finds it by name. The registration
+        outputs are saved in the current working directory, which asv keeps
+        for all repeats of the benchmark.
+        """
+        atlas_name = generate_synthetic_atlas()
+        atlas = BrainGlobeAtlas(atlas_name, check_latest=False)
+        for n_cells in N_CELLS_PARAMS:
+            generate_synthetic_registration(
+                self.synthetic_dir / f"n_cells_{n_cells}",
+                atlas,
+                n_cells=n_cells,
+                voxel_sizes=VOXEL_SIZES,
+            )
+        return atlas_name
+
+    def setup(self, atlas_name, n_cells=N_CELLS_PARAMS[0]):
+        """
+        Prepare the brainmapper input arguments, as `prep` does, with
+        the registration outputs and cells of the synthetic data.
+        """
+        self.input_dir = (self.synthetic_dir / f"n_cells_{n_cells}").resolve()
+        self.output_dir = Path("output").resolve()
+        self.argv = [
+            "brainmapper",
+            "-s",
+            str(self.input_dir / SYNTHETIC_SIGNAL_FILENAME),
+            "-b",
+            str(self.input_dir / SYNTHETIC_BACKGROUND_FILENAME),
+            "-o",
+            str(self.output_dir),
+            "-v",
+            *[str(v) for v in VOXEL_SIZES],
+            "--orientation",
+            SYNTHETIC_ORIENTATION,
+            "--atlas",
+            atlas_name,
+        ]
+
+        self.args = brainmapper_parser().parse_args(self.argv[1:])
+        self.args.paths = Paths(self.args.output_dir)
+        self.args.paths.make_channel_specific_paths()
+        Path(self.args.paths.points_directory).mkdir(parents=True)
+        self.args.brainreg_paths = BrainRegPaths(
+            str(self.input_dir / "registration")
+        )
+        self.classified_points = str(
+            self.input_dir / "points" / "cell_classification.xml"
+        )
+        self.classified_points_arrays = str(
+            self.input_dir / "points" / "cell_classification.arrays"
+        )
+
+        self.atlas = BrainGlobeAtlas(atlas_name, check_latest=False)
+
+    def teardown(self, atlas_name, n_cells=N_CELLS_PARAMS[0]):
+        shutil.rmtree(self.output_dir)
+
+
+class TimePrepBrainmapper(BrainmapperBenchmark):
+    """
+    Time the general brainmapper setup: parsing the command line, creating
+    the output directory, starting the log and instantiating the atlas.
+
+    The atlas instantiation checks for a newer version of the atlas online,
+    which is included in the timing.
+    """
+
+    number = 1  # each call adds log handlers
+
+    def setup(self, atlas_name):
+        BrainmapperBenchmark.setup(self, atlas_name)
+        self.sys_argv = sys.argv
+        sys.argv = self.argv
+
+    def teardown(self, atlas_name):
+        sys.argv = self.sys_argv
+        BrainmapperBenchmark.teardown(self, atlas_name)
+
+    def time_prep_brainmapper_general(self, atlas_name):
+        prep_brainmapper_general()
+
+
+class TimeGetDownsampledSpace(BrainmapperBenchmark):
+    """
+    Time defining the downsampled space, which reads the shape of the
+    registration boundaries image.
+    """
+
+    def time_get_downsampled_space(self, atlas_name):
+        get_downsampled_space(
+            self.atlas, self.args.brainreg_paths.boundaries_file_path
+        )
+
+
+class TimePointsIO(BrainmapperBenchmark):
+    """
+    Time reading and writing the cells, as an XML file and as arrays.
+    """
+
+    params = N_CELLS_PARAMS
+    param_names = ["n_cells"]
+
+    def setup(self, atlas_name, n_cells):
+        BrainmapperBenchmark.setup(self, atlas_name, n_cells)
+        self.cells = get_cells(self.classified_points)
+        self.cell_arrays = read_cell_arrays(self.classified_points_arrays)
+
+    def time_get_cells(self, atlas_name, n_cells):
+        get_cells(self.classified_points, cells_only=True)
+
+    def time_save_cells(self, atlas_name, n_cells):
+        save_cells(self.cells, self.args.paths.classified_points)
+
+    def time_read_cell_arrays(self, atlas_name, n_cells):
+        read_cell_arrays(self.classified_points_arrays).cells_only()
+
+    def time_save_cell_arrays(self, atlas_name, n_cells):
+        save_cell_arrays(
+            self.cell_arrays, self.args.paths.classified_points_arrays
+        )
+
+
+class TimeAnalyse(BrainmapperBenchmark):
+    """
+    Time the cell position analysis: transforming the cells to the atlas
+    space, summarising them by atlas region and exporting them to
+    brainrender.
+    """
+
+    params = N_CELLS_PARAMS
+    param_names = ["n_cells"]
+
+    def setup(self, atlas_name, n_cells):
+        BrainmapperBenchmark.setup(self, atlas_name, n_cells)
+        self.cells = read_cell_arrays(
+            self.classified_points_arrays
+        ).cells_only()
+        self.downsampled_space = get_downsampled_space(
+            self.atlas, self.args.brainreg_paths.boundaries_file_path
+        )
+
+    def time_analyse(self, atlas_name, n_cells):
+        analyse.run(self.args, self.cells, self.atlas, self.downsampled_space)
+
+
+class TimeTransformPoints(BrainmapperBenchmark):
+    """
+    Time transforming points to the atlas space, for up to a million points
+    at random positions in the raw data.
+    """
+
+    params = [100_000, 1_000_000]
+    param_names = ["n_points"]
+
+    def setup(self, atlas_name, n_points):
+        BrainmapperBenchmark.setup(self, atlas_name)
+        self.signal_path = self.args.signal_planes_paths[0]
+        raw_shape = get_image_shape(self.signal_path)
+        rng = np.random.default_rng(0)
+        self.points = rng.uniform(0, 1, (n_points, 3)) * raw_shape
+        self.downsampled_space = get_downsampled_space(
+            self.atlas, self.args.brainreg_paths.boundaries_file_path
+        )
+        self.deformation_field_paths = [
+            self.args.brainreg_paths.deformation_field_0,
+            self.args.brainreg_paths.deformation_field_1,
+            self.args.brainreg_paths.deformation_field_2,
+        ]
+
+    def teardown(self, atlas_name, n_points):
+        BrainmapperBenchmark.teardown(self, atlas_name)
+
+    def time_transform_points_to_atlas_space(self, atlas_name, n_points):
+        transform_points_to_atlas_space(
+            self.points,
+            self.signal_path,
+            self.args.orientation,
+            self.args.voxel_sizes,
+            self.downsampled_space,
+            self.atlas,
+            self.deformation_field_paths,
+            downsampled_points_path=self.args.paths.downsampled_points,
+            atlas_points_path=self.args.paths.atlas_points,
+        )
+
+    def peakmem_transform_points_to_atlas_space(self, atlas_name, n_points):
+        self.time_transform_points_to_atlas_space(atlas_name, n_points)
+
+
+class TimeSummarisePoints(BrainmapperBenchmark):
+    """
+    Time summarising points by atlas region, for up to five million points
+    at random positions in the atlas, compared with brainglobe_utils.
+
+    brainglobe_utils looks up and counts the points one by one, so it is
+    only timed for the smaller number of points.
+    """
+
+    params = (
+        [100_000, 5_000_000],
+        ["brainglobe_workflows", "brainglobe_utils"],
+    )
+    param_names = ["n_points", "implementation"]
+
+    def setup(self, atlas_name, n_points, implementation):
+        if implementation == "brainglobe_utils" and n_points > 100_000:
+            raise NotImplementedError
+        BrainmapperBenchmark.setup(self, atlas_name)
+        rng = np.random.default_rng(0)
+        self.points = (
+            rng.uniform(0, 1, (n_points, 3)) * self.atlas.shape
+        ).astype(np.int32)
+        # read the atlas images before timing
+        self.atlas.annotation
+        self.atlas.hemispheres
+        self.summarise = {
+            "brainglobe_workflows": summarise_points_by_atlas_region,
+            "brainglobe_utils": (
+                brainglobe_analysis.summarise_points_by_atlas_region
+            ),
+        }[implementation]
+
+    def teardown(self, atlas_name, n_points, implementation):
+        BrainmapperBenchmark.teardown(self, atlas_name)
+
+    def time_summarise_points_by_atlas_region(
+        self, atlas_name, n_points, implementation
+    ):
+        self.summarise(
+            self.points,
+            self.points,
+            self.atlas,
+            self.args.brainreg_paths.volume_csv_path,
+        )
+
+
+class TimeHeatmap(BrainmapperBenchmark):
+    """
+    Time the heatmap generation, without smoothing, with smoothing, and
+    with three smoothing values generated from a single pass over the
+    cells, in memory and in slabs (as for heatmaps larger than the memory
+    budget).
+
+    The cells are transformed to the downsampled space by the analysis in
+    `setup`, as brainmapper does before generating the figures.
+    """
+
+    params = (
+        N_CELLS_PARAMS,
+        [None, 100, (50, 100, 200)],
+        ["in_memory", "slabs"],
+    )
+    param_names = ["n_cells", "smoothing", "method"]
+
+    def setup(self, atlas_name, n_cells, smoothing, method):
+        BrainmapperBenchmark.setup(self, atlas_name, n_cells)
+        self.args.heatmap_smooth = smoothing
+        if method == "slabs":
+            # a memory budget smaller than any heatmap
+            self.args.max_ram = 1e-9
+        self.downsampled_space = get_downsampled_space(
+            self.atlas, self.args.brainreg_paths.boundaries_file_path
+        )
+        analyse.run(
+            self.args,
+            get_cells(self.classified_points, cells_only=True),
+            self.atlas,
+            self.downsampled_space,
+        )
+
+    def teardown(self, atlas_name, n_cells, smoothing, method):
+        BrainmapperBenchmark.teardown(self, atlas_name, n_cells)
+
+    def time_generate_heatmap(self, atlas_name, n_cells, smoothing, method):
+        generate_heatmap(self.args, self.atlas, self.downsampled_space)
+
+    def peakmem_generate_heatmap(self, atlas_name, n_cells, smoothing, method):
+        generate_heatmap(self.args, self.atlas, self.downsampled_space)
@@ -1,6 +1,8 @@
+import copy
 import json
 import os
 import shutil
+import time
 from pathlib import Path
 
 from brainglobe_utils.IO.cells import save_cells
@@ -10,11 +12,19 @@ from cellfinder.core.tools.prep import prep_models
 
 from brainglobe_workflows.cellfinder.cellfinder import (
     CellfinderConfig,
+    classify_cell_candidates,
+    detect_cell_candidates,
+    read_input_data,
     run_workflow_from_cellfinder_run,
 )
 from brainglobe_workflows.cellfinder.cellfinder import (
     setup as setup_cellfinder_workflow,
 )
+from brainglobe_workflows.cellfinder.synthetic import (
+    SYNTHETIC_CONFIG_FILENAME,
+    generate_synthetic_data,
+)
+from brainglobe_workflows.metrics import RunMetrics
 from brainglobe_workflows.utils import DEFAULT_JSON_CONFIG_PATH_CELLFINDER
 
 
@@ -108,10 +118,11 @@ class TimeBenchmark:
         assert Path(self.input_config_path).exists()
 
         # Instantiate a CellfinderConfig from the input json file
-        # (fetches data from GIN if required)
+        # and fetch data from GIN if required
         with open(self.input_config_path) as cfg:
             config_dict = json.load(cfg)
         config = CellfinderConfig(**config_dict)
+        config.fetch_input_data()
 
         # Check paths to input data exist in config now
         assert Path(config._signal_dir_path).exists()
@@ -181,6 +192,68 @@ class TimeReadInputDask(TimeBenchmark):
         read_with_dask(str(self.cfg._background_dir_path))
 
 
+class TimeReadInputZarr(TimeBenchmark):
+    """
+    Time reading the input data from zarr stores, compared to reading it
+    from directories of TIFF planes.
+
+    The input data is converted to zarr stores once, in `setup_cache`.
+    Both reads include computing the arrays, so that the cost of decoding
+    the data is timed, and not only the cost of building the dask graph.
+
+    Parameters
+    ----------
+    TimeBenchmark : _type_
+        A base class for timing benchmarks for the cellfinder workflow.
+    """
+
+    zarr_dir = Path("cellfinder_zarr")
+
+    def setup_cache(self):
+        """
+        Download the input data from GIN if required, and convert the
+        signal and background data to zarr stores.
+
+        The zarr stores are saved in the current working directory, which
+        asv keeps for all repeats of the benchmark.
+        """
+        # basic setup_cache
+        TimeBenchmark.setup_cache(self)
+
+        with open(self.input_config_path) as cfg:
+            config = CellfinderConfig(**json.load(cfg))
+
+        for dir_path in [config._signal_dir_path, config._background_dir_path]:
+            read_with_dask(str(dir_path)).to_zarr(
+                str(self.zarr_dir / f"{Path(dir_path).name}.zarr"),
+                overwrite=True,
+            )
+
+    def setup(self):
+        # basic setup
+        TimeBenchmark.setup(self)
+
+        # point the config to the zarr stores
+        self.zarr_cfg = copy.copy(self.cfg)
+        self.zarr_cfg.input_data_format = "zarr"
+        self.zarr_cfg._signal_dir_path = (
+            self.zarr_dir / f"{Path(self.cfg._signal_dir_path).name}.zarr"
+        )
+        self.zarr_cfg._background_dir_path = (
+            self.zarr_dir / f"{Path(self.cfg._background_dir_path).name}.zarr"
+        )
+
+    def time_read_tiff(self):
+        signal_array, background_array = read_input_data(self.cfg)
+        signal_array.compute()
+        background_array.compute()
+
+    def time_read_zarr(self):
+        signal_array, background_array = read_input_data(self.zarr_cfg)
+        signal_array.compute()
+        background_array.compute()
+
+
 class TimeDetectAndClassifyCells(TimeBenchmark):
     """
     Time the cell detection main pipeline (`cellfinder_run`)
@@ -281,3 +354,321 @@ class TimeSaveCells(TimeBenchmark):
 
     def time_save_cells(self):
         save_cells(self.detected_cells, self.cfg._detected_cells_path)
+
+
+class MemoryBenchmark(TimeBenchmark):
+    """
+    A base class for memory benchmarks of the cellfinder workflow stages.
+
+    Each stage is benchmarked in two ways:
+    - a `peakmem_*` benchmark, for which asv reports the peak resident
+      memory (RSS) of the benchmark process, including the memory used
+      by the setup;
+    - a `track_*` benchmark, which returns the peak resident memory of the
+      benchmark process and all its children (e.g. the worker processes
+      that cellfinder spawns for filtering and splitting), sampled while
+      the stage runs.
+
+    Parameters
+    ----------
+    TimeBenchmark : _type_
+        A base class for timing benchmarks for the cellfinder workflow.
+    """
+
+    # the memory of a stage does not change across iterations
+    number = 1
+
+    def measure_peak_rss(self, stage) -> int:
+        """
+        Run a workflow stage and return the peak resident memory of the
+        process tree while it runs, in bytes.
+        """
+        metrics = RunMetrics(sampling_interval=0.1)
+        with metrics.stage(stage.__name__):
+            stage()
+        return metrics.stages[0]["peak_rss_bytes"]
+
+
+class MemReadInput(MemoryBenchmark):
+    """
+    Measure the memory used to read the input data.
+
+    The arrays are computed, so that the memory of the decoded data is
+    included, and not only that of the dask graph.
+    """
+
+    def read_input(self):
+        signal_array, background_array = read_input_data(self.cfg)
+        signal_array.compute()
+        background_array.compute()
+
+    def peakmem_read_input(self):
+        self.read_input()
+
+    def track_peak_rss_read_input(self):
+        return self.measure_peak_rss(self.read_input)
+
+    track_peak_rss_read_input.unit = "bytes"
+
+
+class MemDetectCells(MemoryBenchmark):
+    """
+    Measure the memory used to detect the cell candidates.
+    """
+
+    def setup(self):
+        # basic setup
+        TimeBenchmark.setup(self)
+
+        # never read the cell candidates from the cache
+        self.cfg.cache_detection = False
+        self.signal_array, self.background_array = read_input_data(self.cfg)
+
+    def detect_cells(self):
+        detect_cell_candidates(
+            self.cfg, self.signal_array, self.background_array
+        )
+
+    def peakmem_detect_cells(self):
+        self.detect_cells()
+
+    def track_peak_rss_detect_cells(self):
+        return self.measure_peak_rss(self.detect_cells)
+
+    track_peak_rss_detect_cells.unit = "bytes"
+
+
+class MemClassifyCells(MemoryBenchmark):
+    """
+    Measure the memory used to classify the cell candidates.
+
+    The cell candidates are detected in the setup.
+    """
+
+    def setup(self):
+        # basic setup
+        TimeBenchmark.setup(self)
+
+        self.signal_array, self.background_array = read_input_data(self.cfg)
+        self.candidates = detect_cell_candidates(
+            self.cfg, self.signal_array, self.background_array
+        )
+
+    def classify_cells(self):
+        classify_cell_candidates(
+            self.cfg,
+            self.signal_array,
+            self.background_array,
+            self.candidates,
+        )
+
+    def peakmem_classify_cells(self):
+        self.classify_cells()
+
+    def track_peak_rss_classify_cells(self):
+        return self.measure_peak_rss(self.classify_cells)
+
+    track_peak_rss_classify_cells.unit = "bytes"
+
+
+class MemSaveCells(MemoryBenchmark):
+    """
+    Measure the memory used to save the detected cells.
+
+    The cells are detected and classified in the setup.
+    """
+
+    def setup(self):
+        # basic setup
+        TimeBenchmark.setup(self)
+
+        signal_array, background_array = read_input_data(self.cfg)
+        candidates = detect_cell_candidates(
+            self.cfg, signal_array, background_array
+        )
+        self.detected_cells = classify_cell_candidates(
+            self.cfg, signal_array, background_array, candidates
+        )
+
+    def save_detected_cells(self):
+        save_cells(self.detected_cells, self.cfg._detected_cells_path)
+
+    def peakmem_save_cells(self):
+        self.save_detected_cells()
+
+    def track_peak_rss_save_cells(self):
+        return self.measure_peak_rss(self.save_detected_cells)
+
+    track_peak_rss_save_cells.unit = "bytes"
+
+
+class TimeDetectSynthetic:
+    """
+    Time cell detection on synthetic data of increasing size.
+
+    The synthetic data is generated in `setup_cache`, so this benchmark
+    runs offline. The number of planes and cells is multiplied by the
+    `scale` parameter, and the detection throughput is tracked in planes
+    per second.
+    """
+
+    timeout = 3600
+    rounds = 1
+    repeat = 1
+    number = 1
+    params = [1, 4, 16]
+    param_names = ["scale"]
+
+    synthetic_dir = Path("cellfinder_synthetic")
+
+    def setup_cache(self):
+        """
+        Generate the synthetic data for every scale.
+
+        The data is saved in the current working directory, which asv
+        keeps for all repeats of the benchmark.
+        """
+        for scale in self.params:
+            generate_synthetic_data(
+                self.synthetic_dir / f"scale_{scale}", scale=scale
+            )
+
+    def setup(self, scale):
+        with open(
+            self.synthetic_dir / f"scale_{scale}" / SYNTHETIC_CONFIG_FILENAME
+        ) as cfg:
+            config_dict = json.load(cfg)
+        config_dict["output_parent_dir"] = str(Path("output").resolve())
+        self.cfg = CellfinderConfig(**config_dict)
+        self.cfg.prepare()
+        self.signal_array, self.background_array = read_input_data(self.cfg)
+
+    def teardown(self, scale):
+        shutil.rmtree(Path(self.cfg._output_path).resolve())
+
+    def detect_cells(self):
+        detect_cell_candidates(
+            self.cfg, self.signal_array, self.background_array
+        )
+
+    def time_detect_cells(self, scale):
+        self.detect_cells()
+
+    def track_detection_throughput(self, scale):
+        start_time = time.perf_counter()
+        self.detect_cells()
+        return len(self.signal_array) / (time.perf_counter() - start_time)
+
+    track_detection_throughput.unit = "planes/s"
+
+
+def get_n_free_cpus_params() -> list:
+    """
+    Return the numbers of CPU cores to leave free, so that 1, 2, 4, ...
+    and all the cores of the machine are used.
+    """
+    n_cpus = os.cpu_count() or 1
+    n_cpus_used = {n_cpus}
+    n = 1
+    while n < n_cpus:
+        n_cpus_used.add(n)
+        n *= 2
+    return sorted((n_cpus - n for n in n_cpus_used), reverse=True)
+
+
+class DetectionScaling(TimeBenchmark):
+    """
+    Track the detection throughput, in planes per second, over the number
+    of CPU cores, the detection batch size and memory pinning.
+
+    Together, the results give the strong-scaling curve of the detection
+    step for the data in the config. Note that `pin_memory` only has an
+    effect when detecting on a GPU.
+
+    Parameters
+    ----------
+    TimeBenchmark : _type_
+        A base class for timing benchmarks for the cellfinder workflow.
+    """
+
+    params = [get_n_free_cpus_params(), [1, 4, 16], [False, True]]
+    param_names = ["n_free_cpus", "detection_batch_size", "pin_memory"]
+
+    def setup(self, n_free_cpus, detection_batch_size, pin_memory):
+        # basic setup
+        TimeBenchmark.setup(self)
+
+        self.cfg.n_free_cpus = n_free_cpus
+        self.cfg.detection_batch_size = detection_batch_size
+        self.cfg.pin_memory = pin_memory
+        # never read the cell candidates from the cache
+        self.cfg.cache_detection = False
+        self.signal_array, self.background_array = read_input_data(self.cfg)
+
+    def teardown(self, *params):
+        TimeBenchmark.teardown(self)
+
+    def track_planes_per_second(
+        self, n_free_cpus, detection_batch_size, pin_memory
+    ):
+        end_plane = self.cfg.end_plane
+        if end_plane < 0 or end_plane > len(self.signal_array):
+            end_plane = len(self.signal_array)
+        n_planes = end_plane - self.cfg.start_plane
+
+        start_time = time.perf_counter()
+        detect_cell_candidates(
+            self.cfg, self.signal_array, self.background_array
+        )
+        return n_planes / (time.perf_counter() - start_time)
+
+    track_planes_per_second.unit = "planes/s"
+
+
+class ClassificationScaling(TimeBenchmark):
+    """
+    Track the classification throughput, in cells per second, over the
+    number of CPU cores, the classification batch size and memory pinning.
+
+    The cell candidates are detected once and cached in the output parent
+    directory, so that they are reused for every combination of parameters.
+
+    Parameters
+    ----------
+    TimeBenchmark : _type_
+        A base class for timing benchmarks for the cellfinder workflow.
+    """
+
+    params = [get_n_free_cpus_params(), [16, 32, 64], [False, True]]
+    param_names = ["n_free_cpus", "classification_batch_size", "pin_memory"]
+
+    def setup(self, n_free_cpus, classification_batch_size, pin_memory):
+        # basic setup
+        TimeBenchmark.setup(self)
+
+        self.signal_array, self.background_array = read_input_data(self.cfg)
+        self.cfg.cache_detection = True
+        self.candidates = detect_cell_candidates(
+            self.cfg, self.signal_array, self.background_array
+        )
+
+        self.cfg.n_free_cpus = n_free_cpus
+        self.cfg.classification_batch_size = classification_batch_size
+        self.cfg.pin_memory = pin_memory
+
+    def teardown(self, *params):
+        TimeBenchmark.teardown(self)
+
+    def track_cells_per_second(
+        self, n_free_cpus, classification_batch_size, pin_memory
+    ):
+        start_time = time.perf_counter()
+        classify_cell_candidates(
+            self.cfg,
+            self.signal_array,
+            self.background_array,
+            self.candidates,
+        )
+        return len(self.candidates) / (time.perf_counter() - start_time)
+
+    track_cells_per_second.unit = "cells/s"
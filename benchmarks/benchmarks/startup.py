@@ -0,0 +1,106 @@
+import subprocess
+import sys
+
+from brainglobe_workflows.brainmapper.parser import brainmapper_parser
+from brainglobe_workflows.cellfinder.cellfinder import read_cellfinder_config
+from brainglobe_workflows.utils import DEFAULT_JSON_CONFIG_PATH_CELLFINDER
+
+# modules imported when the workflows are launched
+ENTRY_MODULES = [
+    "brainglobe_workflows.brainmapper.main",
+    "brainglobe_workflows.brainmapper.parser",
+    "brainglobe_workflows.brainmapper.prep",
+    "brainglobe_workflows.cellfinder.cellfinder",
+]
+
+
+class TimeStartup:
+    """
+    Time the start-up of the workflows, that dominates the run time of
+    short jobs (e.g. validating inputs, or printing the help).
+
+    The `timeraw_*` benchmarks run their code in a new Python process, so
+    they include the cold import time of all the modules the code needs.
+    The `time_*` benchmarks run in the benchmark process, once the modules
+    are imported.
+
+    Notes
+    -----
+    See https://asv.readthedocs.io/en/stable/writing_benchmarks.html#raw-timing-benchmarks
+    """
+
+    timeout = 600  # default: 60 s
+    version = None
+    rounds = 2
+    repeat = 5
+
+    def timeraw_import_brainmapper_parser_and_build(self):
+        return """
+        from brainglobe_workflows.brainmapper.parser import brainmapper_parser
+        brainmapper_parser()
+        """
+
+    def timeraw_brainmapper_help(self):
+        return """
+        import contextlib
+        import os
+
+        from brainglobe_workflows.brainmapper.parser import brainmapper_parser
+
+        with open(os.devnull, "w") as devnull:
+            with contextlib.redirect_stdout(devnull):
+                try:
+                    brainmapper_parser().parse_args(["--help"])
+                except SystemExit:
+                    pass
+        """
+
+    def timeraw_import_and_read_cellfinder_config(self):
+        return f"""
+        from brainglobe_workflows.cellfinder.cellfinder import (
+            read_cellfinder_config,
+        )
+        read_cellfinder_config({str(DEFAULT_JSON_CONFIG_PATH_CELLFINDER)!r})
+        """
+
+    def time_brainmapper_parser(self):
+        brainmapper_parser()
+
+    def time_read_cellfinder_config(self):
+        read_cellfinder_config(DEFAULT_JSON_CONFIG_PATH_CELLFINDER)
+
+
+class TimeImportEntryModules:
+    """
+    Time the cold import of each entry module of the workflows, and track
+    the number of modules it imports.
+    """
+
+    timeout = 600  # default: 60 s
+    version = None
+    rounds = 2
+    repeat = 5
+    params = ENTRY_MODULES
+    param_names = ["module"]
+
+    def timeraw_import(self, module):
+        return f"import {module}"
+
+    def track_n_imported_modules(self, module):
+        """
+        Return the number of modules in `sys.modules` after importing the
+        entry module in a new Python process.
+        """
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                f"import sys; import {module}; print(len(sys.modules))",
+            ],
+            capture_output=True,
+            check=True,
+            text=True,
+        )
+        return int(result.stdout.strip().splitlines()[-1])
+
+    track_n_imported_modules.unit = "modules"
@@ -1,27 +1,46 @@
 import logging
 
 import numpy as np
-from brainglobe_utils.brainmapper.analysis import (
+from brainglobe_utils.brainmapper.export import export_points_to_brainrender
+
+from brainglobe_workflows.brainmapper.cell_arrays import (
+    CellArrays,
+    cells_to_arrays,
+)
+from brainglobe_workflows.brainmapper.summary import (
     summarise_points_by_atlas_region,
 )
-from brainglobe_utils.brainmapper.export import export_points_to_brainrender
-from brainglobe_utils.brainreg.transform import transform_points_to_atlas_space
+from brainglobe_workflows.brainmapper.transform import (
+    transform_points_to_atlas_space,
+)
+
 
+def run(args, cells, atlas, downsampled_space, structure_table=None):
+    """
+    Transform the cells to the atlas space, summarise them by atlas region
+    and export them to brainrender.
 
-def run(args, cells, atlas, downsampled_space):
+    `cells` are the cells as `CellArrays`, an (N, 3) array of their
+    coordinates in z, y, x order, or a list of `Cell` objects. The
+    structures of the atlas are read from `atlas` unless `structure_table`
+    is given.
+
+    Returns the table of all the cells, the summary and the hierarchy
+    summary, as `summary.summarise_points_by_atlas_region`.
+    """
     deformation_field_paths = [
         args.brainreg_paths.deformation_field_0,
         args.brainreg_paths.deformation_field_1,
         args.brainreg_paths.deformation_field_2,
     ]
 
-    cell_list = []
-    for cell in cells:
-        cell_list.append([cell.z, cell.y, cell.x])
-    cells = np.array(cell_list)
+    if isinstance(cells, CellArrays):
+        cells = cells.zyx()
+    elif not isinstance(cells, np.ndarray):
+        cells = cells_to_arrays(cells).zyx()
 
     logging.info("Transforming points to atlas space")
-    transformed_cells, points_out_of_bounds = transform_points_to_atlas_space(
+    transformed_cells, in_bounds = transform_points_to_atlas_space(
         cells,
         args.signal_planes_paths[0],
         args.orientation,
@@ -32,22 +51,26 @@ def run(args, cells, atlas, downsampled_space):
         downsampled_points_path=args.paths.downsampled_points,
         atlas_points_path=args.paths.atlas_points,
     )
+    n_out_of_bounds = np.count_nonzero(~in_bounds)
     logging.warning(
-        f"{len(points_out_of_bounds)} points ignored due to falling outside "
+        f"{n_out_of_bounds} points ignored due to falling outside "
         f"of atlas. This may be due to inaccuracies with "
         f"cell detection or registration. Please inspect the results."
     )
 
     logging.info("Summarising cell positions")
-    summarise_points_by_atlas_region(
-        cells,
+    summaries = summarise_points_by_atlas_region(
+        cells[in_bounds],
         transformed_cells,
         atlas,
         args.brainreg_paths.volume_csv_path,
         args.paths.all_points_csv,
         args.paths.summary_csv,
+        hierarchy_summary_filename=args.paths.summary_hierarchy_csv,
+        structure_table=structure_table,
     )
     logging.info("Exporting data to brainrender")
     export_points_to_brainrender(
         transformed_cells, atlas.resolution[0], args.paths.brainrender_points
     )
+    return summaries
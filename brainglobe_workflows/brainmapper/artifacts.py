@@ -0,0 +1,204 @@
+"""Keep the data loaded by a brainmapper stage for the later stages
+
+Several brainmapper stages read the same files: the classified cells are
+read by both the analysis and the figures, and the shape of the
+registration boundaries image is read for every channel. The artifact
+store keeps the data once loaded (or once computed, before it is saved) in
+memory, so later stages reuse it rather than reading and decoding the file
+again.
+
+Each artifact is keyed by the path of its file, and is reloaded if the
+file was modified since. The store is bounded in memory: the least recently
+used artifacts are evicted once the total size of the artifacts exceeds
+the limit.
+"""
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, List, Tuple, Union
+
+Pathlike = Union[str, os.PathLike]
+
+DEFAULT_MAX_BYTES = 4 * 2**30
+# approximate memory used by a brainglobe_utils Cell
+CELL_NBYTES = 200
+
+
+def get_image_shape(path: Pathlike) -> Tuple[int, ...]:
+    """Get the shape of a 3D image from its file header, without reading
+    the image data.
+
+    Parameters
+    ----------
+    path : Pathlike
+        path to a TIFF file, or to any image that brainglobe_utils can
+        read lazily (e.g. a directory of 2D TIFF planes)
+
+    Returns
+    -------
+    Tuple[int, ...]
+        shape of the image
+    """
+    import tifffile
+
+    if os.path.isfile(path) and str(path).lower().endswith((".tif", ".tiff")):
+        with tifffile.TiffFile(path) as tiff:
+            return tuple(tiff.series[0].shape)
+
+    from brainglobe_utils.IO.image.load import read_with_dask
+
+    return tuple(read_with_dask(str(path)).shape)
+
+
+def _get_file_key(path: Pathlike) -> Tuple[str, int, int]:
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+
+def _get_nbytes(value: Any) -> int:
+    if hasattr(value, "nbytes"):
+        return int(value.nbytes)
+    if isinstance(value, list):
+        return len(value) * CELL_NBYTES
+    if isinstance(value, tuple):
+        return sum(_get_nbytes(item) for item in value)
+    return 0
+
+
+class ArtifactStore:
+    """Keep the data loaded by the brainmapper stages in memory, up to a
+    memory limit. The store can be shared by several threads.
+
+    Examples
+    --------
+    >>> artifacts = ArtifactStore()
+    >>> cells = artifacts.get_cells(classified_points_path, cells_only=True)
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        approximate memory limit of the stored artifacts, by default 4 GiB.
+        Artifacts larger than the limit are not stored.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._artifacts: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(
+        self,
+        kind: Hashable,
+        path: Pathlike,
+        load: Callable[[], Any],
+    ) -> Any:
+        """Get an artifact, loading it if it is not stored, or if its file
+        was modified since it was stored.
+
+        Parameters
+        ----------
+        kind : Hashable
+            the kind of artifact (e.g. "cells" or "image"), as different
+            kinds may be loaded from the same file
+        path : Pathlike
+            path to the file the artifact is loaded from
+        load : Callable[[], Any]
+            function loading the artifact
+
+        Returns
+        -------
+        Any
+            the artifact
+        """
+        key = (kind, os.path.abspath(path))
+        file_key = _get_file_key(path)
+        with self._lock:
+            stored = self._artifacts.get(key)
+            if stored is not None and stored[0] == file_key:
+                self._artifacts.move_to_end(key)
+                return stored[1]
+
+        value = load()
+        self._store(key, file_key, value)
+        return value
+
+    def put(self, kind: Hashable, path: Pathlike, value: Any) -> None:
+        """Store an artifact, once it is saved to its file.
+
+        Parameters
+        ----------
+        kind : Hashable
+            the kind of artifact
+        path : Pathlike
+            path to the file the artifact was saved to
+        value : Any
+            the artifact
+        """
+        self._store((kind, os.path.abspath(path)), _get_file_key(path), value)
+
+    def _store(self, key: tuple, file_key: tuple, value: Any) -> None:
+        nbytes = _get_nbytes(value)
+        with self._lock:
+            self._remove(key)
+            if nbytes > self.max_bytes:
+                logging.debug(
+                    f"Not keeping {key} in memory ({nbytes} bytes), as it "
+                    f"is larger than the artifact store"
+                )
+                return
+            self._artifacts[key] = (file_key, value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                self._remove(next(iter(self._artifacts)))
+
+    def _remove(self, key: tuple) -> None:
+        stored = self._artifacts.pop(key, None)
+        if stored is not None:
+            self.nbytes -= stored[2]
+
+    def clear(self) -> None:
+        """Remove all the artifacts."""
+        with self._lock:
+            self._artifacts.clear()
+            self.nbytes = 0
+
+    def get_cells(self, path: Pathlike, cells_only: bool = False) -> List:
+        """Get the cells saved in a cells XML file.
+
+        Parameters
+        ----------
+        path : Pathlike
+            path to the cells XML file
+        cells_only : bool, optional
+            if True, only return the candidates classified as cells, by
+            default False
+
+        Returns
+        -------
+        List[Cell]
+            the cells
+        """
+        from brainglobe_utils.IO.cells import get_cells
+
+        cells = self.get("cells", path, lambda: get_cells(str(path)))
+        if cells_only:
+            return [cell for cell in cells if cell.is_cell()]
+        return list(cells)
+
+    def get_image_shape(self, path: Pathlike) -> Tuple[int, ...]:
+        """Get the shape of an image, read from its file header once.
+
+        Parameters
+        ----------
+        path : Pathlike
+            path to the image
+
+        Returns
+        -------
+        Tuple[int, ...]
+            shape of the image
+        """
+        return self.get("shape", path, lambda: get_image_shape(path))
@@ -0,0 +1,258 @@
+"""Save and read cells as typed arrays, one file per column
+
+Reading and writing millions of cells as XML (with `save_cells` and
+`get_cells`) is slow: the file is parsed into a `Cell` object per cell,
+which the analysis then converts back to an array. Instead, brainmapper
+saves the cells to a directory with a NumPy (`.npy`) file per column: the
+`x`, `y` and `z` coordinates, the `type`, and optionally the classification
+`score`. Each column is read directly as an array, memory-mapped if needed.
+
+The cells XML files are still saved for compatibility, and can also be
+exported from the arrays with:
+
+    python -m brainglobe_workflows.brainmapper.cell_arrays <arrays> <xml>
+"""
+
+import argparse
+import os
+import shutil
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Union
+
+import numpy as np
+
+Pathlike = Union[str, os.PathLike]
+
+CELL_ARRAYS_SUFFIX = ".arrays"
+POSITION_COLUMNS = ("x", "y", "z")
+
+
+class CellArrays(NamedTuple):
+    """The cells of a brain, as arrays.
+
+    Attributes
+    ----------
+    x, y, z : np.ndarray
+        the coordinates of the cells, in voxels of the raw data
+    type : np.ndarray
+        the type of the cells, as in `brainglobe_utils.cells.cells.Cell`
+    score : np.ndarray, optional
+        the probability of being a cell given by the classification
+    """
+
+    x: np.ndarray
+    y: np.ndarray
+    z: np.ndarray
+    type: np.ndarray
+    score: Optional[np.ndarray] = None
+
+    @property
+    def n_cells(self) -> int:
+        """The number of cells."""
+        return len(self.type)
+
+    def zyx(self) -> np.ndarray:
+        """Return the coordinates as an (N, 3) array, in z, y, x order."""
+        return np.column_stack((self.z, self.y, self.x))
+
+    def select(self, mask: np.ndarray) -> "CellArrays":
+        """Return the cells selected by a boolean mask or indices."""
+        return CellArrays(
+            *(column[mask] if column is not None else None for column in self)
+        )
+
+    def cells_only(self) -> "CellArrays":
+        """Return the cells classified as cells."""
+        from brainglobe_utils.cells.cells import Cell
+
+        return self.select(self.type == Cell.CELL)
+
+
+def deal_with_artifacts(
+    cell_arrays: CellArrays, artifact_keep: bool = True
+) -> CellArrays:
+    """Convert or remove the candidates detected as artifacts, as when
+    saving cells to XML with `save_cells`.
+
+    Parameters
+    ----------
+    cell_arrays : CellArrays
+        the cells
+    artifact_keep : bool, optional
+        if True, the artifacts are kept, with their type changed to unknown,
+        otherwise they are removed. By default True.
+
+    Returns
+    -------
+    CellArrays
+        the cells
+    """
+    from brainglobe_utils.cells.cells import Cell
+
+    is_artifact = cell_arrays.type == Cell.ARTIFACT
+    if artifact_keep:
+        return cell_arrays._replace(
+            type=np.where(is_artifact, Cell.UNKNOWN, cell_arrays.type)
+        )
+    return cell_arrays.select(~is_artifact)
+
+
+def get_cell_arrays_path(xml_path: Pathlike) -> Path:
+    """Get the path of the cell arrays saved alongside a cells XML file.
+
+    Parameters
+    ----------
+    xml_path : Pathlike
+        path to the cells XML file (e.g. `points/cells.xml`)
+
+    Returns
+    -------
+    Path
+        path to the cell arrays directory (e.g. `points/cells.arrays`)
+    """
+    return Path(xml_path).with_suffix(CELL_ARRAYS_SUFFIX)
+
+
+def cells_to_arrays(cells: List) -> CellArrays:
+    """Convert a list of `Cell` objects to arrays.
+
+    Parameters
+    ----------
+    cells : List[Cell]
+        the cells
+
+    Returns
+    -------
+    CellArrays
+        the cells as arrays
+    """
+    n_cells = len(cells)
+    return CellArrays(
+        *(
+            np.fromiter(
+                (getattr(cell, column) for cell in cells),
+                dtype=np.int32,
+                count=n_cells,
+            )
+            for column in (*POSITION_COLUMNS, "type")
+        )
+    )
+
+
+def arrays_to_cells(cell_arrays: CellArrays) -> List:
+    """Convert cell arrays to a list of `Cell` objects.
+
+    Parameters
+    ----------
+    cell_arrays : CellArrays
+        the cells as arrays
+
+    Returns
+    -------
+    List[Cell]
+        the cells
+    """
+    from brainglobe_utils.cells.cells import Cell
+
+    return [
+        Cell((x, y, z), cell_type)
+        for x, y, z, cell_type in zip(
+            cell_arrays.x.tolist(),
+            cell_arrays.y.tolist(),
+            cell_arrays.z.tolist(),
+            cell_arrays.type.tolist(),
+        )
+    ]
+
+
+def save_cell_arrays(cell_arrays: CellArrays, path: Pathlike) -> None:
+    """Save cells to a directory of arrays, replacing any previous cells.
+
+    The columns are written to a temporary directory that is then renamed,
+    so that the directory never has columns of different saves.
+
+    Parameters
+    ----------
+    cell_arrays : CellArrays
+        the cells
+    path : Pathlike
+        path to the directory to save the arrays to
+    """
+    path = Path(path)
+    tmp_path = path.with_name(path.name + ".tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+    for column, values in cell_arrays._asdict().items():
+        if values is not None:
+            np.save(tmp_path / f"{column}.npy", np.asarray(values))
+    shutil.rmtree(path, ignore_errors=True)
+    tmp_path.rename(path)
+
+
+def read_cell_arrays(path: Pathlike, mmap: bool = False) -> CellArrays:
+    """Read cells saved with `save_cell_arrays`.
+
+    Parameters
+    ----------
+    path : Pathlike
+        path to the directory of arrays
+    mmap : bool, optional
+        if True, memory-map the arrays rather than reading them, by
+        default False
+
+    Returns
+    -------
+    CellArrays
+        the cells
+    """
+    path = Path(path)
+    mmap_mode = "r" if mmap else None
+    columns = {}
+    for column in CellArrays._fields:
+        column_path = path / f"{column}.npy"
+        if column_path.exists():
+            columns[column] = np.load(column_path, mmap_mode=mmap_mode)
+        elif column in CellArrays._field_defaults:
+            columns[column] = None
+        else:
+            raise FileNotFoundError(
+                f"The cell arrays in {path} have no {column} column"
+            )
+    return CellArrays(**columns)
+
+
+def export_cell_arrays_to_xml(
+    path: Pathlike, xml_path: Pathlike, artifact_keep: bool = True
+) -> None:
+    """Export cells saved as arrays to a cells XML file.
+
+    Parameters
+    ----------
+    path : Pathlike
+        path to the directory of arrays
+    xml_path : Pathlike
+        path to the XML file to save
+    artifact_keep : bool, optional
+        whether to keep the artifacts in the XML file, by default True
+    """
+    from brainglobe_utils.IO.cells import save_cells
+
+    save_cells(
+        arrays_to_cells(read_cell_arrays(path)),
+        str(xml_path),
+        artifact_keep=artifact_keep,
+    )
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Export cells saved as arrays to a cells XML file"
+    )
+    parser.add_argument("arrays_path", help="Directory of cell arrays")
+    parser.add_argument("xml_path", help="Cells XML file to save")
+    args = parser.parse_args(argv)
+    export_cell_arrays_to_xml(args.arrays_path, args.xml_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+classify
+===============
+
+Classify the cell candidates of each signal channel with a shared model
+and background image.
+
+The background image and the classification network are the same for all
+the signal channels of a brain, so they are read and loaded once per run,
+on first use, and shared by all the channels, including channels
+processed in parallel.
+"""
+
+import logging
+import threading
+from pathlib import Path
+
+
+class SharedClassificationInputs:
+    """
+    The background image and the classification model, shared by all the
+    signal channels of a run. Each is loaded on first use, once, and is
+    safe to use from several threads.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        the brainmapper arguments
+    """
+
+    def __init__(self, args):
+        self.background_planes_path = args.background_planes_path[0]
+        self.model_weights = args.model_weights
+        self.install_path = args.install_path
+        self.model = args.model
+        self.trained_model = args.trained_model
+        self.network_depth = args.network_depth
+        self._background_array = None
+        self._network = None
+        self._load_lock = threading.Lock()
+        # the model is not guaranteed to be thread-safe, so the channels
+        # run their inference in turn
+        self.inference_lock = threading.Lock()
+
+    def get_background_array(self):
+        from brainglobe_utils.IO.image.load import read_z_stack
+
+        with self._load_lock:
+            if self._background_array is None:
+                self._background_array = read_z_stack(
+                    self.background_planes_path
+                )
+        return self._background_array
+
+    def get_network(self):
+        from cellfinder.core.classify.tools import get_model
+        from cellfinder.core.tools import prep
+        from cellfinder.core.train.train_yaml import models
+
+        with self._load_lock:
+            if self._network is None:
+                model_weights = prep.prep_model_weights(
+                    self.model_weights, self.install_path, self.model
+                )
+                trained_model = self.trained_model
+                if trained_model and Path(trained_model).suffix == ".h5":
+                    logging.warning(
+                        "Weights provided in place of the model, "
+                        "loading weights into default model."
+                    )
+                    model_weights = trained_model
+                    trained_model = None
+                logging.debug("Loading the classification model")
+                self._network = get_model(
+                    existing_model=trained_model,
+                    model_weights=model_weights,
+                    network_depth=models[self.network_depth],
+                    inference=True,
+                )
+        return self._network
+
+
+def classify_points(
+    candidates, signal_array, shared_inputs, args, max_workers=3
+):
+    """
+    Classify the cell candidates of a signal channel.
+
+    This mirrors `cellfinder.core.classify.classify.main`, but uses the
+    shared background image and model rather than loading them for each
+    channel, and takes and returns the cells as arrays.
+
+    Parameters
+    ----------
+    candidates : CellArrays
+        the cell candidates to classify
+    signal_array : numpy.ndarray or dask array
+        the signal image, in z, y, x order
+    shared_inputs : SharedClassificationInputs
+        the background image and classification model of the run
+    args : argparse.Namespace
+        the brainmapper arguments of the channel
+    max_workers : int, optional
+        the maximum number of processes loading the cubes, by default 3
+
+    Returns
+    -------
+    CellArrays
+        the classified cells, with their probability of being a cell as
+        score. Candidates too close to the edge of the image to be
+        classified are left out.
+    """
+    import numpy as np
+    from brainglobe_utils.general.system import get_num_processes
+    from cellfinder.core.classify.cube_generator import (
+        CuboidArrayDataset,
+        CuboidBatchSampler,
+    )
+    from torch.utils.data import DataLoader
+
+    from brainglobe_workflows.brainmapper.cell_arrays import arrays_to_cells
+
+    background_array = shared_inputs.get_background_array()
+    network = shared_inputs.get_network()
+    if signal_array.ndim != 3:
+        raise IOError("Signal data must be 3D")
+    if background_array.ndim != 3:
+        raise IOError("Background data must be 3D")
+
+    workers = get_num_processes(min_free_cpu_cores=args.n_free_cpus)
+    workers = min(workers, max_workers)
+
+    dataset = CuboidArrayDataset(
+        signal_array=signal_array,
+        background_array=background_array,
+        points=arrays_to_cells(candidates),
+        data_voxel_sizes=list(map(float, args.voxel_sizes)),
+        network_voxel_sizes=args.network_voxel_sizes,
+        network_cuboid_voxels=(
+            args.cube_depth,
+            args.cube_height,
+            args.cube_width,
+        ),
+        axis_order=("z", "y", "x"),
+        max_axis_0_cuboids_buffered=1,
+    )
+    # the sampler doesn't shuffle, so the predictions are in the order of
+    # the batches it returns
+    sampler = CuboidBatchSampler(
+        dataset=dataset,
+        batch_size=args.classification_batch_size,
+        sort_by_axis="z",
+        auto_shuffle=False,
+    )
+    data_loader = DataLoader(
+        dataset=dataset,
+        sampler=sampler,
+        batch_size=None,
+        num_workers=workers,
+        pin_memory=args.pin_memory,
+    )
+
+    if workers:
+        dataset.start_dataset_thread(workers)
+    try:
+        outputs = []
+        for data in data_loader:
+            with shared_inputs.inference_lock:
+                outputs.append(network(data).cpu().numpy())
+    finally:
+        dataset.stop_dataset_thread()
+
+    if outputs:
+        outputs = np.concatenate(outputs, axis=0)
+    else:
+        outputs = np.empty((0, 2), dtype=np.float32)
+    # the index of each classified candidate, in the order of the outputs
+    sampled = np.fromiter(
+        (i for batch in sampler for i in batch), dtype=np.int64
+    )
+    candidate_indices = dataset.points_arr[:, 4].numpy().astype(np.int64)
+
+    classified = candidates.select(candidate_indices[sampled])
+    return classified._replace(
+        type=(np.argmax(outputs, axis=1) + 1).astype(np.int32),
+        score=outputs[:, 1],
+    )
@@ -0,0 +1,459 @@
+"""Analyse the cells of a cohort of brains registered to the same atlas
+
+brainmapper analyses one brain per run, and loads the atlas for each run.
+The cohort analysis re-runs the cell position analysis (the `analyse`
+stage) of many finished brainmapper output directories, registered to the
+same atlas, in parallel processes:
+
+- the atlas is loaded once, and its annotation and hemispheres images are
+  saved to a temporary directory, from which each process memory-maps
+  them, so the processes share them rather than each loading the atlas,
+- the structure hierarchy is read once, and passed to each process,
+- the number of cells in each region (including its substructures) of
+  each brain are combined into a single region x brain table, saved to
+  `region_counts.csv` in the cohort output directory.
+
+The outputs of the analysis of each brain are saved to its output
+directory, as brainmapper saves them. To analyse a cohort:
+
+    python -m brainglobe_workflows.brainmapper.cohort \
+        /path/to/brain_1 /path/to/brain_2 --output-dir /path/to/cohort
+"""
+
+import argparse
+import json
+import logging
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from brainglobe_workflows.brainmapper.summary import (
+    StructureTable,
+    get_structure_table,
+)
+
+Pathlike = Union[str, os.PathLike]
+
+REGION_COUNTS_FILENAME = "region_counts.csv"
+
+# the atlas index of the worker processes, set by `_init_worker`
+_atlas_index = None
+
+
+class AtlasIndex:
+    """The parts of an atlas used by the cell position analysis, which can
+    be shared by several processes.
+
+    The annotation and hemispheres images are memory-mapped from NumPy
+    files, so they are only read once in memory by the operating system,
+    whatever the number of processes using them. When pickled (to be sent
+    to another process), only the paths of the images are pickled.
+
+    It has the attributes of `BrainGlobeAtlas` used by the analysis.
+
+    Parameters
+    ----------
+    directory : Pathlike
+        directory of the annotation and hemispheres images, as saved by
+        `AtlasIndex.from_atlas`
+    atlas_name : str
+        name of the atlas
+    resolution : Tuple[float, float, float]
+        resolution of the atlas, in microns
+    orientation : str
+        orientation of the atlas, in the brainglobe-space convention
+    structure_table : StructureTable
+        the structures of the atlas
+    """
+
+    def __init__(
+        self,
+        directory: Pathlike,
+        atlas_name: str,
+        resolution: Tuple[float, float, float],
+        orientation: str,
+        structure_table: StructureTable,
+    ):
+        self.directory = Path(directory)
+        self.atlas_name = atlas_name
+        self.resolution = resolution
+        self.metadata = {"orientation": orientation}
+        self.structure_table = structure_table
+        self._images: dict = {}
+
+    @classmethod
+    def from_atlas(cls, atlas, directory: Pathlike) -> "AtlasIndex":
+        """Save the images of an atlas to a directory, and index them.
+
+        Parameters
+        ----------
+        atlas : BrainGlobeAtlas
+            the atlas
+        directory : Pathlike
+            directory to save the images to
+
+        Returns
+        -------
+        AtlasIndex
+            the index of the atlas
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        for name in ("annotation", "hemispheres"):
+            np.save(directory / f"{name}.npy", getattr(atlas, name))
+        return cls(
+            directory,
+            atlas.atlas_name,
+            tuple(atlas.resolution),
+            atlas.metadata["orientation"],
+            get_structure_table(atlas),
+        )
+
+    def _get_image(self, name: str) -> np.ndarray:
+        if name not in self._images:
+            self._images[name] = np.load(
+                self.directory / f"{name}.npy", mmap_mode="r"
+            )
+        return self._images[name]
+
+    @property
+    def annotation(self) -> np.ndarray:
+        """The annotation image, memory-mapped."""
+        return self._get_image("annotation")
+
+    @property
+    def hemispheres(self) -> np.ndarray:
+        """The hemispheres image, memory-mapped."""
+        return self._get_image("hemispheres")
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        """The shape of the atlas images."""
+        return self.annotation.shape
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["_images"] = {}
+        return state
+
+
+def get_brain_channels(
+    brain_dir: Pathlike, name: Optional[str] = None
+) -> List[Tuple[str, argparse.Namespace]]:
+    """Get the arguments to analyse each signal channel of a brain, from
+    the metadata of its brainmapper output directory.
+
+    Parameters
+    ----------
+    brain_dir : Pathlike
+        brainmapper output directory of the brain
+    name : str, optional
+        name of the brain, by default the name of its output directory
+
+    Returns
+    -------
+    List[Tuple[str, argparse.Namespace]]
+        the name of each channel (the name of the brain, followed by the
+        channel for brains with several signal channels) and its arguments
+    """
+    from brainreg.core.paths import Paths as BrainRegPaths
+
+    from brainglobe_workflows.brainmapper.prep import (
+        Paths,
+        check_and_return_ch_ids,
+    )
+
+    brain_dir = Path(brain_dir)
+    if name is None:
+        name = brain_dir.resolve().name
+    paths = Paths(str(brain_dir))
+    with open(paths.metadata_path) as f:
+        metadata = json.load(f)
+
+    signal_planes_paths = metadata["signal_planes_paths"]
+    signal_ch_ids, _ = check_and_return_ch_ids(
+        metadata["signal_ch_ids"],
+        metadata["background_ch_id"],
+        signal_planes_paths,
+    )
+    channels = []
+    for signal_paths, channel in zip(signal_planes_paths, signal_ch_ids):
+        # the outputs of each channel are saved to a subdirectory, if there
+        # are several
+        if len(signal_planes_paths) > 1:
+            channel_name = f"{name}/channel_{channel}"
+            output_dir = brain_dir / f"channel_{channel}"
+        else:
+            channel_name = name
+            output_dir = brain_dir
+        channel_paths = Paths(str(output_dir))
+        channel_paths.make_channel_specific_paths()
+        channels.append(
+            (
+                channel_name,
+                argparse.Namespace(
+                    atlas=metadata["atlas"],
+                    signal_planes_paths=[signal_paths],
+                    orientation=metadata["orientation"],
+                    voxel_sizes=metadata["voxel_sizes"],
+                    output_dir=str(output_dir),
+                    signal_channel=channel,
+                    paths=channel_paths,
+                    brainreg_paths=BrainRegPaths(
+                        paths.registration_output_folder
+                    ),
+                ),
+            )
+        )
+    return channels
+
+
+def _init_worker(atlas_index: AtlasIndex) -> None:
+    global _atlas_index
+    _atlas_index = atlas_index
+
+
+def analyse_channel(
+    args: argparse.Namespace, atlas_index: Optional[AtlasIndex] = None
+) -> pd.DataFrame:
+    """Run the cell position analysis of a channel of a brain.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        the arguments of the channel, from `get_brain_channels`
+    atlas_index : AtlasIndex, optional
+        the atlas, by default that of the worker process
+
+    Returns
+    -------
+    pd.DataFrame
+        the hierarchy summary of the channel, with the number of cells in
+        each structure and its substructures. Empty if there are no cells.
+    """
+    from brainglobe_workflows.brainmapper import analyse
+    from brainglobe_workflows.brainmapper.artifacts import ArtifactStore
+    from brainglobe_workflows.brainmapper.main import (
+        get_cell_arrays,
+        get_downsampled_space,
+    )
+
+    if atlas_index is None:
+        atlas_index = _atlas_index
+
+    points = get_cell_arrays(
+        args.paths.classified_points,
+        args.paths.classified_points_arrays,
+        ArtifactStore(),
+    ).cells_only()
+    if points.n_cells == 0:
+        logging.info(f"No cells in {args.output_dir}, skipping")
+        return pd.DataFrame(columns=["structure_id", "total_cells"])
+
+    downsampled_space = get_downsampled_space(
+        atlas_index, args.brainreg_paths.boundaries_file_path
+    )
+    _, _, hierarchy_summary = analyse.run(
+        args,
+        points,
+        atlas_index,
+        downsampled_space,
+        structure_table=atlas_index.structure_table,
+    )
+    return hierarchy_summary
+
+
+def create_region_counts_df(
+    hierarchy_summaries: Sequence[pd.DataFrame],
+    names: Sequence[str],
+    structure_table: StructureTable,
+) -> pd.DataFrame:
+    """Combine the cell counts of several brains into a region x brain
+    table.
+
+    Parameters
+    ----------
+    hierarchy_summaries : Sequence[pd.DataFrame]
+        the hierarchy summary of each brain
+    names : Sequence[str]
+        the name of each brain
+    structure_table : StructureTable
+        the structures of the atlas
+
+    Returns
+    -------
+    pd.DataFrame
+        the number of cells in each structure (including its
+        substructures) with cells in any of the brains, with a row per
+        structure, and a column per brain
+    """
+    counts = np.zeros((structure_table.n_structures, len(names)), np.int64)
+    for column, hierarchy_summary in enumerate(hierarchy_summaries):
+        rows = structure_table.get_indices(
+            hierarchy_summary["structure_id"].to_numpy(dtype=np.int64)
+        )
+        counts[rows, column] = hierarchy_summary["total_cells"]
+
+    with_cells = np.flatnonzero(counts.any(axis=1))
+    df = pd.DataFrame(
+        {
+            "structure_id": structure_table.ids[with_cells],
+            "acronym": structure_table.acronyms[with_cells],
+            "structure_name": structure_table.names[with_cells],
+            "parent_structure_id": structure_table.parent_ids[with_cells],
+            "depth": structure_table.depths[with_cells],
+        }
+    )
+    counts_df = pd.DataFrame(counts[with_cells], columns=list(names))
+    return pd.concat([df, counts_df], axis=1)
+
+
+def run_cohort_analysis(
+    brain_dirs: Sequence[Pathlike],
+    output_dir: Pathlike,
+    atlas=None,
+    n_processes: int = 1,
+) -> pd.DataFrame:
+    """Analyse the cells of several brains registered to the same atlas,
+    and save the number of cells in each region of each brain.
+
+    Parameters
+    ----------
+    brain_dirs : Sequence[Pathlike]
+        brainmapper output directories of the brains
+    output_dir : Pathlike
+        directory to save the region x brain counts to
+    atlas : BrainGlobeAtlas, optional
+        the atlas the brains are registered to, by default the one in the
+        metadata of the first brain
+    n_processes : int, optional
+        number of brains analysed at the same time, by default 1
+
+    Returns
+    -------
+    pd.DataFrame
+        the number of cells in each region of each brain, as saved to
+        `region_counts.csv`
+    """
+    channels = [
+        channel
+        for brain_dir in brain_dirs
+        for channel in get_brain_channels(brain_dir)
+    ]
+    names = [name for name, _ in channels]
+    if len(set(names)) < len(names):
+        raise ValueError(
+            "The brain output directories must have different names"
+        )
+    if atlas is None:
+        from brainglobe_atlasapi import BrainGlobeAtlas
+
+        atlas = BrainGlobeAtlas(channels[0][1].atlas)
+    for name, args in channels:
+        if args.atlas != atlas.atlas_name:
+            raise ValueError(
+                f"{name} is registered to {args.atlas}, "
+                f"not to {atlas.atlas_name}"
+            )
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=output_dir) as index_dir:
+        logging.info(f"Indexing the {atlas.atlas_name} atlas")
+        atlas_index = AtlasIndex.from_atlas(atlas, index_dir)
+        channel_args = [args for _, args in channels]
+
+        if n_processes > 1:
+            logging.info(
+                f"Analysing {len(channels)} brains, "
+                f"{n_processes} at a time"
+            )
+            with ProcessPoolExecutor(
+                max_workers=n_processes,
+                initializer=_init_worker,
+                initargs=(atlas_index,),
+            ) as executor:
+                hierarchy_summaries = list(
+                    executor.map(analyse_channel, channel_args)
+                )
+        else:
+            logging.info(f"Analysing {len(channels)} brains")
+            hierarchy_summaries = [
+                analyse_channel(args, atlas_index) for args in channel_args
+            ]
+
+    region_counts = create_region_counts_df(
+        hierarchy_summaries, names, atlas_index.structure_table
+    )
+    region_counts.to_csv(output_dir / REGION_COUNTS_FILENAME, index=False)
+    return region_counts
+
+
+def cohort_parser(argv: List[str]) -> argparse.Namespace:
+    """Define argument parser for the cohort analysis.
+
+    Parameters
+    ----------
+    argv : List[str]
+        list of command line input arguments
+
+    Returns
+    -------
+    args : argparse.Namespace
+        command line input arguments parsed
+    """
+    from brainglobe_utils.general.numerical import check_positive_int
+
+    parser = argparse.ArgumentParser(
+        description="Analyse the cells of a cohort of brains registered to "
+        "the same atlas, and combine their counts per region."
+    )
+    parser.add_argument(
+        "brain_dirs",
+        nargs="+",
+        help="brainmapper output directories of the brains.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        required=True,
+        type=str,
+        help="Directory to save the region x brain cell counts to.",
+    )
+    parser.add_argument(
+        "--n-processes",
+        default=1,
+        type=check_positive_int,
+        help="Number of brains to analyse at the same time.",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> pd.DataFrame:
+    """Run the cohort analysis from the command line.
+
+    Parameters
+    ----------
+    argv : List[str], optional
+        list of command line input arguments, by default those of the
+        process
+
+    Returns
+    -------
+    pd.DataFrame
+        the number of cells in each region of each brain
+    """
+    logging.basicConfig(level=logging.INFO)
+    args = cohort_parser(argv)
+    return run_cohort_analysis(
+        args.brain_dirs, args.output_dir, n_processes=args.n_processes
+    )
+
+
+if __name__ == "__main__":
+    main()
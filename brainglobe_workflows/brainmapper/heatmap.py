@@ -0,0 +1,574 @@
+"""Generate heatmaps of the cells with bounded memory
+
+`brainglobe_utils.image.heatmap.heatmap_from_points` reads all the points,
+and builds, smooths and masks the heatmap as whole images in memory, as
+float64. brainmapper reads the points in chunks, and keeps the images in
+memory as 32 bit images if they fit in the memory budget. Otherwise, for
+large images, it works on temporary chunked (zarr) images, a part at a
+time:
+
+- the downsampled points are read in chunks, and counted in tiles of the
+  image of counts, so only a chunk of points and a tile of counts are in
+  memory at a time,
+- the counts are smoothed with a Gaussian filter one axis at a time: in
+  slabs of planes along the in-plane axes, and then in stripes of the
+  slabs, extended by the filter radius, along the axis across planes,
+- the heatmap is masked with the registered atlas, memory-mapped,
+- each heatmap is written as a TIFF file, as before, a slab at a time.
+
+The memory used then depends on the size of a slab, and not on the number
+of points or of planes. Each heatmap can also be written as a chunked
+multi-resolution (OME-Zarr) pyramid, to browse large heatmaps.
+
+In both cases, the points are counted once for all the smoothing values,
+so several heatmaps are generated with a single pass over the points.
+The heatmaps are the same as those of `heatmap_from_points`, to within
+rounding.
+"""
+
+import logging
+import os
+import tempfile
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+Pathlike = Union[str, os.PathLike]
+
+DEFAULT_POINTS_CHUNK_SIZE = 1_000_000
+# memory used to generate a heatmap in memory: the counts (uint32), the
+# smoothed heatmap (float32), the 16 bit heatmap and the mask (bool)
+IN_MEMORY_BYTES_PER_VOXEL = 4 + 4 + 2 + 1
+# the temporary images are chunked in slabs of planes (along the first
+# axis), split into stripes along the second axis
+DEFAULT_SLAB_SIZE = 32
+DEFAULT_STRIPE_SIZE = 128
+# the filter is truncated at 4 sigma, as in skimage.filters.gaussian
+TRUNCATE = 4.0
+# the lowest resolution of the pyramid is at least this size along each axis
+MIN_PYRAMID_SIZE = 16
+PYRAMID_CHUNK_SIZE = 128
+
+
+def read_points_in_chunks(
+    path: Pathlike, chunk_size: int = DEFAULT_POINTS_CHUNK_SIZE
+) -> Iterator[np.ndarray]:
+    """Read points saved to an HDF file, a chunk at a time.
+
+    Points saved as an HDF table (as by `transform`) are read a chunk at a
+    time. Points saved in the fixed HDF format (e.g. by a previous version
+    of brainmapper) are read at once, and returned in chunks.
+
+    Parameters
+    ----------
+    path : Pathlike
+        path to the HDF file of points
+    chunk_size : int, optional
+        number of points per chunk, by default 1,000,000
+
+    Yields
+    ------
+    np.ndarray
+        (N, 3) array of points
+    """
+    import pandas as pd
+
+    with pd.HDFStore(path, mode="r") as store:
+        key = store.keys()[0]
+        if store.get_storer(key).is_table:
+            for df in store.select(key, chunksize=chunk_size):
+                yield df.values
+            return
+        points = store.select(key).values
+    for start in range(0, len(points), chunk_size):
+        yield points[start : start + chunk_size]
+
+
+def get_voxel_indices(
+    points: np.ndarray, shape: Sequence[int]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Get the voxel of each point, as `np.histogramdd` bins them with
+    bins of one voxel: the last voxel along each axis includes the points
+    at its far edge.
+
+    Parameters
+    ----------
+    points : np.ndarray
+        (N, 3) array of points
+    shape : Sequence[int]
+        shape of the image
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        (N, 3) array of the voxel indices of the points, and boolean mask of
+        the points inside the image
+    """
+    shape = np.asarray(shape)
+    points = np.asarray(points, dtype=np.float64)
+    in_image = np.all((points >= 0) & (points <= shape), axis=1)
+    indices = np.floor(points).astype(np.int64)
+    indices = np.minimum(indices, shape - 1)
+    return indices, in_image
+
+
+def accumulate_counts(point_chunks: Iterable[np.ndarray], counts) -> None:
+    """Add the number of points in each voxel to an image, tile by tile.
+
+    Parameters
+    ----------
+    point_chunks : Iterable[np.ndarray]
+        chunks of (N, 3) points
+    counts : zarr.Array
+        chunked image of counts, updated a chunk (tile) at a time
+    """
+    shape = np.array(counts.shape)
+    tile_shape = np.array(counts.chunks)
+    n_tiles = -(-shape // tile_shape)
+    for points in point_chunks:
+        indices, in_image = get_voxel_indices(points, shape)
+        indices = indices[in_image]
+        tile_ids = np.ravel_multi_index((indices // tile_shape).T, n_tiles)
+        order = np.argsort(tile_ids, kind="stable")
+        tile_ids, indices = tile_ids[order], indices[order]
+        unique_ids, starts = np.unique(tile_ids, return_index=True)
+        for tile_id, tile_indices in zip(
+            unique_ids, np.split(indices, starts[1:])
+        ):
+            start = np.array(np.unravel_index(tile_id, n_tiles)) * tile_shape
+            stop = np.minimum(start + tile_shape, shape)
+            region = tuple(slice(a, b) for a, b in zip(start, stop))
+            tile_counts = np.bincount(
+                np.ravel_multi_index((tile_indices - start).T, stop - start),
+                minlength=np.prod(stop - start),
+            ).reshape(stop - start)
+            counts[region] = counts[region] + tile_counts
+
+
+def count_points(
+    point_chunks: Iterable[np.ndarray], shape: Sequence[int]
+) -> np.ndarray:
+    """Count the points in each voxel of an image, in memory.
+
+    Parameters
+    ----------
+    point_chunks : Iterable[np.ndarray]
+        chunks of (N, 3) points
+    shape : Sequence[int]
+        shape of the image
+
+    Returns
+    -------
+    np.ndarray
+        the image of counts, as uint32
+    """
+    counts = np.zeros(shape, dtype=np.uint32)
+    flat_counts = counts.reshape(-1)
+    for points in point_chunks:
+        indices, in_image = get_voxel_indices(points, shape)
+        voxels, n_points = np.unique(
+            np.ravel_multi_index(indices[in_image].T, shape),
+            return_counts=True,
+        )
+        flat_counts[voxels] += n_points.astype(np.uint32)
+    return counts
+
+
+def smooth_and_mask_in_memory(
+    counts: np.ndarray, sigma: float, mask: Optional[np.ndarray]
+) -> Tuple[np.ndarray, float]:
+    """Smooth an image in memory with a Gaussian filter, as
+    `skimage.filters.gaussian`, and mask it.
+
+    Parameters
+    ----------
+    counts : np.ndarray
+        the image to smooth
+    sigma : float
+        standard deviation of the filter, in voxels. If 0, the image is
+        not smoothed.
+    mask : np.ndarray, optional
+        image above 0 in the voxels to keep
+
+    Returns
+    -------
+    Tuple[np.ndarray, float]
+        the smoothed and masked image, as float32, and its maximum
+    """
+    from scipy.ndimage import gaussian_filter
+
+    smoothed = counts.astype(np.float32)
+    if sigma > 0:
+        # filtered in place, one axis at a time
+        gaussian_filter(
+            smoothed,
+            sigma=sigma,
+            mode="nearest",
+            truncate=TRUNCATE,
+            output=smoothed,
+        )
+    if mask is not None:
+        smoothed *= mask > 0
+    return smoothed, float(smoothed.max(initial=0))
+
+
+def _iter_slabs(n_planes: int, slab_size: int) -> Iterator[slice]:
+    for start in range(0, n_planes, slab_size):
+        yield slice(start, min(start + slab_size, n_planes))
+
+
+def smooth_and_mask(
+    counts,
+    sigma: float,
+    mask: Optional[np.ndarray],
+    in_plane,
+    out,
+) -> float:
+    """Smooth an image with a Gaussian filter, as
+    `skimage.filters.gaussian`, one axis at a time, and mask it.
+
+    The image is read and written a slab or a stripe at a time: the filter
+    is applied along the second and third axes to slabs of planes, saved to
+    `in_plane`, and then along the first axis to stripes of `in_plane`,
+    extended by the radius of the filter.
+
+    Parameters
+    ----------
+    counts : zarr.Array
+        the image to smooth
+    sigma : float
+        standard deviation of the filter, in voxels. If 0, the image is
+        not smoothed.
+    mask : np.ndarray, optional
+        image (e.g. memory-mapped) above 0 in the voxels to keep
+    in_plane, out : zarr.Array
+        float images, chunked as `counts`, to save the image smoothed along
+        the in-plane axes, and the output image to
+
+    Returns
+    -------
+    float
+        the maximum of the output image
+    """
+    from scipy.ndimage import gaussian_filter1d
+
+    filter_kwargs = dict(sigma=sigma, mode="nearest", truncate=TRUNCATE)
+    n_planes = counts.shape[0]
+    slab_size, stripe_size = counts.chunks[:2]
+    if sigma > 0:
+        for slab in _iter_slabs(n_planes, slab_size):
+            block = counts[slab].astype(np.float64)
+            for axis in (1, 2):
+                block = gaussian_filter1d(block, axis=axis, **filter_kwargs)
+            in_plane[slab] = block
+        source = in_plane
+        radius = int(TRUNCATE * sigma + 0.5)
+    else:
+        source = counts
+        radius = 0
+
+    max_value = 0.0
+    for slab in _iter_slabs(n_planes, slab_size):
+        # extended by the filter radius, so that the planes of the slab are
+        # filtered as in the whole image
+        start = max(slab.start - radius, 0)
+        stop = min(slab.stop + radius, n_planes)
+        core = slice(slab.start - start, slab.stop - start)
+        for stripe in _iter_slabs(counts.shape[1], stripe_size):
+            block = source[start:stop, stripe].astype(np.float64)
+            if radius:
+                block = gaussian_filter1d(block, axis=0, **filter_kwargs)
+            block = block[core]
+            if mask is not None:
+                block *= mask[slab, stripe] > 0
+            out[slab, stripe] = block
+            max_value = max(max_value, float(block.max(initial=0)))
+    return max_value
+
+
+def read_mask(path: Pathlike, shape: Sequence[int]) -> np.ndarray:
+    """Read an image to mask the heatmap with, memory-mapped if possible.
+
+    If the image is not of the shape of the heatmap, it is rescaled to it,
+    in memory, as `heatmap_from_points` does.
+
+    Returns
+    -------
+    np.ndarray
+        the image, which is above 0 in the voxels to keep
+    """
+    import tifffile
+
+    try:
+        image = tifffile.memmap(path, mode="r")
+    except ValueError:
+        logging.debug(f"Cannot memory-map {path}, reading it instead")
+        image = tifffile.imread(path)
+    if image.shape != tuple(shape):
+        from brainglobe_utils.image.heatmap import rescale_array
+
+        image = rescale_array(np.asarray(image), np.empty(shape, np.bool_))
+    return image
+
+
+def get_pyramid_scale_factors(shape: Sequence[int]) -> List[int]:
+    """Get the downsampling factors of the levels of the pyramid below the
+    full resolution, down to `MIN_PYRAMID_SIZE` voxels along each axis."""
+    scale_factors = []
+    factor = 2
+    while min(shape) // factor >= MIN_PYRAMID_SIZE:
+        scale_factors.append(factor)
+        factor *= 2
+    return scale_factors
+
+
+def get_heatmap_paths(
+    heatmap_path: Pathlike, smoothing: Optional[float], first: bool
+) -> Tuple[Path, Path]:
+    """Get the paths of the TIFF file and the pyramid of a heatmap.
+
+    The first heatmap is saved to `heatmap_path`, and the others to a file
+    named after their smoothing, e.g. `heatmap_smoothing_200um.tiff`.
+
+    Parameters
+    ----------
+    heatmap_path : Pathlike
+        path to the heatmap TIFF file (e.g. `figures/heatmap.tiff`)
+    smoothing : float, optional
+        smoothing of the heatmap, in microns, or None for no smoothing
+    first : bool
+        whether it is the first heatmap
+
+    Returns
+    -------
+    Tuple[Path, Path]
+        the paths of the TIFF file and of the pyramid (e.g.
+        `figures/heatmap.zarr`)
+    """
+    heatmap_path = Path(heatmap_path)
+    if not first:
+        if smoothing is None:
+            suffix = "no_smoothing"
+        else:
+            suffix = f"smoothing_{smoothing:g}um"
+        heatmap_path = heatmap_path.with_name(
+            f"{heatmap_path.stem}_{suffix}{heatmap_path.suffix}"
+        )
+    return heatmap_path, heatmap_path.with_suffix(".zarr")
+
+
+def write_heatmap(
+    smoothed,
+    max_value: float,
+    tiff_path: Pathlike,
+    slab_size: int,
+    level_0=None,
+) -> None:
+    """Scale a heatmap to the 16 bit range, as
+    `scale_and_convert_to_16_bits`, and write it as a TIFF file, a slab at
+    a time.
+
+    Parameters
+    ----------
+    smoothed : np.ndarray or zarr.Array
+        the smoothed and masked heatmap
+    max_value : float
+        the maximum of the heatmap
+    tiff_path : Pathlike
+        path to save the heatmap to
+    slab_size : int
+        number of planes scaled at a time
+    level_0 : np.ndarray or zarr.Array, optional
+        uint16 image to also save the scaled heatmap to (e.g. to write
+        the pyramid from)
+    """
+    import tifffile
+
+    scale = (2**16 - 1) / max_value if max_value > 0 else 0
+
+    def planes():
+        for slab in _iter_slabs(smoothed.shape[0], slab_size):
+            block = (smoothed[slab] * scale).astype(np.uint16)
+            if level_0 is not None:
+                level_0[slab] = block
+            yield from block
+
+    tifffile.imwrite(
+        tiff_path,
+        data=planes(),
+        shape=smoothed.shape,
+        dtype=np.uint16,
+        photometric="minisblack",
+        metadata={"axes": "ZYX"},
+    )
+
+
+def write_pyramid(
+    level_0, pyramid_path: Pathlike, resolution: Sequence[float]
+) -> None:
+    """Write a 16 bit heatmap as a multi-resolution (OME-Zarr) pyramid.
+
+    Parameters
+    ----------
+    level_0 : np.ndarray or zarr.Array
+        the heatmap, at full resolution
+    pyramid_path : Pathlike
+        path to save the pyramid to
+    resolution : Sequence[float]
+        resolution of the heatmap, in microns
+    """
+    import dask.array as da
+    import ngff_zarr as nz
+
+    if isinstance(level_0, np.ndarray):
+        level_0 = da.from_array(level_0, chunks=PYRAMID_CHUNK_SIZE)
+    else:
+        level_0 = da.from_zarr(level_0)
+    image = nz.to_ngff_image(
+        level_0,
+        dims=["z", "y", "x"],
+        scale={dim: res / 1000 for dim, res in zip("zyx", resolution)},
+        axes_units={dim: "millimeter" for dim in "zyx"},
+        name="heatmap",
+    )
+    multiscales = nz.to_multiscales(
+        image,
+        scale_factors=get_pyramid_scale_factors(level_0.shape),
+        method=nz.Methods.DASK_BIN_SHRINK,
+        chunks=PYRAMID_CHUNK_SIZE,
+    )
+    nz.to_ngff_zarr(str(pyramid_path), multiscales, overwrite=True)
+
+
+def get_sigma(smoothing: Optional[float], image_resolution: float) -> int:
+    """Get the standard deviation of the filter, in voxels, as
+    `heatmap_from_points` does, or 0 for no smoothing."""
+    if smoothing is None:
+        return 0
+    return int(round(smoothing / image_resolution))
+
+
+def generate_heatmaps(
+    points_path: Pathlike,
+    image_resolution: float,
+    image_shape: Sequence[int],
+    heatmap_path: Pathlike,
+    smoothings: Sequence[Optional[float]],
+    mask_image_path: Optional[Pathlike] = None,
+    pyramid: bool = False,
+    max_bytes: Optional[int] = None,
+    points_chunk_size: int = DEFAULT_POINTS_CHUNK_SIZE,
+    slab_size: int = DEFAULT_SLAB_SIZE,
+    stripe_size: int = DEFAULT_STRIPE_SIZE,
+) -> List[Path]:
+    """Generate a heatmap of points for each smoothing value, with a single
+    pass over the points.
+
+    Parameters
+    ----------
+    points_path : Pathlike
+        path to the HDF file of points, in voxels of the heatmap
+    image_resolution : float
+        resolution of the heatmap, in microns (assumed isotropic)
+    image_shape : Sequence[int]
+        shape of the heatmap
+    heatmap_path : Pathlike
+        path to save the first heatmap to, as a TIFF file. See
+        `get_heatmap_paths` for the others.
+    smoothings : Sequence[Optional[float]]
+        Gaussian smoothing sigma of each heatmap, in microns, or None for
+        no smoothing
+    mask_image_path : Pathlike, optional
+        image to mask the heatmaps with (e.g. the registered atlas), so the
+        voxels where it is 0 are 0 in the heatmaps. By default, the
+        heatmaps are not masked.
+    pyramid : bool, optional
+        whether to also save each heatmap as an OME-Zarr pyramid (e.g.
+        `heatmap.zarr`), by default False
+    max_bytes : int, optional
+        memory budget. The heatmaps are generated in memory if they fit in
+        it (see `IN_MEMORY_BYTES_PER_VOXEL`), and in slabs otherwise. By
+        default, they are generated in memory.
+    points_chunk_size : int, optional
+        number of points read at a time, by default 1,000,000
+    slab_size : int, optional
+        number of planes processed at a time, by default 32
+    stripe_size : int, optional
+        size along the second axis of the parts of a slab (extended by the
+        filter radius) filtered along the first axis, by default 128
+
+    Returns
+    -------
+    List[Path]
+        the paths of the TIFF files of the heatmaps
+    """
+    from brainglobe_utils.general.system import ensure_directory_exists
+
+    heatmap_path = Path(heatmap_path)
+    ensure_directory_exists(heatmap_path.parent)
+    image_shape = tuple(int(n) for n in image_shape)
+    if mask_image_path is not None:
+        mask_image = read_mask(mask_image_path, image_shape)
+    else:
+        mask_image = None
+    resolution = (image_resolution,) * len(image_shape)
+    point_chunks = read_points_in_chunks(points_path, points_chunk_size)
+    paths = [
+        get_heatmap_paths(heatmap_path, smoothing, first=idx == 0)
+        for idx, smoothing in enumerate(smoothings)
+    ]
+
+    nbytes = int(np.prod(image_shape)) * IN_MEMORY_BYTES_PER_VOXEL
+    if max_bytes is None or nbytes <= max_bytes:
+        counts = count_points(point_chunks, image_shape)
+        for smoothing, (tiff_path, pyramid_path) in zip(smoothings, paths):
+            smoothed, max_value = smooth_and_mask_in_memory(
+                counts, get_sigma(smoothing, image_resolution), mask_image
+            )
+            level_0 = np.empty(image_shape, np.uint16) if pyramid else None
+            logging.debug(f"Saving heatmap to {tiff_path}")
+            write_heatmap(smoothed, max_value, tiff_path, slab_size, level_0)
+            del smoothed
+            if pyramid:
+                write_pyramid(level_0, pyramid_path, resolution)
+        return [tiff_path for tiff_path, _ in paths]
+
+    import zarr
+
+    logging.info(
+        f"Generating the heatmaps in slabs, as they need {nbytes / 1e9:.1f}"
+        " GB in memory"
+    )
+    with tempfile.TemporaryDirectory(dir=heatmap_path.parent) as tmp_dir:
+
+        def create_image(name, dtype):
+            return zarr.create_array(
+                store=os.path.join(tmp_dir, f"{name}.zarr"),
+                shape=image_shape,
+                chunks=(slab_size, stripe_size, image_shape[2]),
+                dtype=dtype,
+                fill_value=0,
+                # the temporary images are read and written several times
+                compressors=None,
+            )
+
+        counts = create_image("counts", np.uint32)
+        accumulate_counts(point_chunks, counts)
+        in_plane = create_image("in_plane", np.float32)
+        smoothed = create_image("smoothed", np.float32)
+        level_0 = create_image("level_0", np.uint16) if pyramid else None
+
+        for smoothing, (tiff_path, pyramid_path) in zip(smoothings, paths):
+            max_value = smooth_and_mask(
+                counts,
+                get_sigma(smoothing, image_resolution),
+                mask_image,
+                in_plane,
+                smoothed,
+            )
+            logging.debug(f"Saving heatmap to {tiff_path}")
+            write_heatmap(smoothed, max_value, tiff_path, slab_size, level_0)
+            if pyramid:
+                write_pyramid(level_0, pyramid_path, resolution)
+    return [tiff_path for tiff_path, _ in paths]
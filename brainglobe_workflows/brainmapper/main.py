@@ -5,24 +5,35 @@ main
 Runs each part of the brainmapper pipeline in turn.
 """
 
+import copy
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-import brainglobe_space as bgs
-import pandas as pd
-import tifffile
-from brainglobe_utils.cells.cells import MissingCellsError
 from brainglobe_utils.general.system import ensure_directory_exists
-from brainglobe_utils.image.heatmap import heatmap_from_points
-from brainglobe_utils.IO.cells import get_cells, save_cells
-from brainglobe_utils.IO.image.load import read_z_stack
+
+from brainglobe_workflows.brainmapper.artifacts import (
+    ArtifactStore,
+    get_image_shape,
+)
+from brainglobe_workflows.metrics import RunMetrics
+
+# The image, atlas and cellfinder libraries are imported in the functions
+# that use them, so that parsing and validating the command line, and
+# planning what to run, do not pay for importing them.
 
 BRAINREG_PRE_PROCESSING_ARGS = None
 
 
-def get_downsampled_space(atlas, downsampled_image_path):
-    target_shape = tifffile.imread(downsampled_image_path).shape
+def get_downsampled_space(atlas, downsampled_image_path, artifacts=None):
+    import brainglobe_space as bgs
+
+    # only the shape is needed, which is read from the file header
+    if artifacts is None:
+        target_shape = get_image_shape(downsampled_image_path)
+    else:
+        target_shape = artifacts.get_image_shape(downsampled_image_path)
     downsampled_space = bgs.AnatomicalSpace(
         atlas.metadata["orientation"],
         shape=target_shape,
@@ -31,27 +42,125 @@ def get_downsampled_space(atlas, downsampled_image_path):
     return downsampled_space
 
 
-def cells_exist(points_file):
-    try:
-        get_cells(points_file, cells_only=True)
-        return True
-    except MissingCellsError:
-        return False
+def generate_heatmap(args, atlas, downsampled_space):
+    """
+    Generate a heatmap of the cells in the downsampled space for each
+    value of `args.heatmap_smooth`, masked by the registered atlas if
+    `args.mask_figures` is set.
 
+    The cells are read in chunks from the downsampled points file written
+    by the analysis. The heatmaps are generated in memory if they fit in
+    `args.max_ram` (by default, half of the available memory), and in
+    slabs otherwise (see `heatmap.py`).
+    """
+    import psutil
 
-def main():
-    from brainreg.core.main import main as register
+    from brainglobe_workflows.brainmapper.heatmap import generate_heatmaps
 
-    from brainglobe_workflows.brainmapper import prep
+    smoothings = args.heatmap_smooth
+    if not isinstance(smoothings, (list, tuple)):
+        smoothings = [smoothings]
+    if args.mask_figures:
+        mask_image_path = args.brainreg_paths.registered_atlas
+    else:
+        mask_image_path = None
+    if args.max_ram is None:
+        max_bytes = psutil.virtual_memory().available // 2
+    else:
+        max_bytes = int(args.max_ram * 1e9)
+
+    generate_heatmaps(
+        args.paths.downsampled_points,
+        atlas.resolution[0],  # assumes isotropic atlas
+        downsampled_space.shape,
+        args.paths.heatmap,
+        smoothings,
+        mask_image_path=mask_image_path,
+        pyramid=args.heatmap_pyramid,
+        max_bytes=max_bytes,
+    )
 
-    start_time = datetime.now()
-    args, arg_groups, what_to_run, atlas = prep.prep_brainmapper_general()
 
-    if what_to_run.register:
-        # TODO: add register_part_brain option
-        logging.info("Registering to atlas")
-        args, additional_images_downsample = prep.prep_registration(args)
-        register(
+def get_cell_arrays(xml_path, arrays_path, artifacts):
+    """
+    Get the cells saved as arrays, or, if there are none (e.g. outputs of
+    a previous version of brainmapper), read them from the XML file.
+    """
+    from brainglobe_workflows.brainmapper.cell_arrays import (
+        cells_to_arrays,
+        read_cell_arrays,
+    )
+
+    if os.path.exists(arrays_path):
+        return artifacts.get(
+            "cell_arrays", arrays_path, lambda: read_cell_arrays(arrays_path)
+        )
+    return cells_to_arrays(artifacts.get_cells(xml_path))
+
+
+def save_cell_outputs(args, cell_arrays, xml_path, arrays_path, artifacts):
+    """
+    Save cells as arrays, and, unless `args.no_cells_xml` is set, as an
+    XML file. The cells are also kept in `artifacts` for the later stages.
+    """
+    from pathlib import Path
+
+    from brainglobe_utils.IO.cells import cells_to_csv, save_cells
+
+    from brainglobe_workflows.brainmapper.cell_arrays import (
+        arrays_to_cells,
+        save_cell_arrays,
+    )
+
+    save_cell_arrays(cell_arrays, arrays_path)
+    artifacts.put("cell_arrays", arrays_path, cell_arrays)
+    if not args.no_cells_xml:
+        save_cells(
+            arrays_to_cells(cell_arrays), xml_path, save_csv=args.save_csv
+        )
+    elif args.save_csv:
+        cells_to_csv(
+            arrays_to_cells(cell_arrays), Path(xml_path).with_suffix(".csv")
+        )
+
+
+def get_concurrent_n_free_cpus(n_free_cpus, registration_n_cpus=None):
+    """
+    Split the CPU cores available between the registration and the cell
+    detection and classification, when they run concurrently.
+
+    Parameters
+    ----------
+    n_free_cpus : int
+        number of CPU cores to leave unused
+    registration_n_cpus : int, optional
+        number of CPU cores for the registration, by default half of the
+        cores available
+
+    Returns
+    -------
+    Tuple[int, int]
+        the number of CPU cores to leave free for the registration, and for
+        the cell detection and classification
+    """
+    n_cpus = os.cpu_count()
+    n_available = max(n_cpus - n_free_cpus, 1)
+    if registration_n_cpus is None:
+        registration_n_cpus = max(n_available // 2, 1)
+    registration_n_cpus = min(registration_n_cpus, n_available)
+    detection_n_cpus = max(n_available - registration_n_cpus, 1)
+    return n_cpus - registration_n_cpus, n_cpus - detection_n_cpus
+
+
+def register(
+    args, arg_groups, additional_images_downsample, metrics, what_to_run
+):
+    from brainreg.core.main import main as brainreg_register
+
+    logging.info("Registering to atlas")
+    what_to_run.start_stage("register", args)
+    with metrics.stage("register"):
+        brainreg_register(
             args.atlas,
             args.orientation,
             args.target_brain_path,
@@ -65,134 +174,389 @@ def main():
             backend=args.backend,
             debug=args.debug,
         )
+    what_to_run.complete_stage("register", args)
+
+
+def get_parallel_n_free_cpus(n_free_cpus, n_parallel_channels):
+    """
+    Split the CPU cores available between the signal channels processed in
+    parallel.
+
+    Parameters
+    ----------
+    n_free_cpus : int
+        number of CPU cores to leave unused
+    n_parallel_channels : int
+        number of channels processed at the same time
+
+    Returns
+    -------
+    int
+        the number of CPU cores to leave free for each channel
+    """
+    n_cpus = os.cpu_count()
+    n_available = max(n_cpus - n_free_cpus, 1)
+    return n_cpus - max(n_available // n_parallel_channels, 1)
+
+
+def get_channel_args(args, output_dir, signal_paths, channel):
+    """
+    Return a copy of the args to process a signal channel, with the
+    outputs saved to a `channel_<id>` subdirectory of `output_dir`. The
+    args passed are not modified.
+    """
+    channel_directory = os.path.join(output_dir, "channel_" + str(channel))
+    os.makedirs(channel_directory, exist_ok=True)
+
+    channel_args = copy.copy(args)
+    channel_args.signal_planes_paths = [signal_paths] + list(
+        args.signal_planes_paths[1:]
+    )
+    channel_args.output_dir = channel_directory
+    channel_args.paths = copy.copy(args.paths)
+    channel_args.signal_channel = channel
+    return channel_args
+
+
+def run_for_each_channel(
+    function,
+    args,
+    what_to_run,
+    output_dir,
+    signal_planes_paths,
+    n_parallel_channels=1,
+):
+    """
+    Run `function(args, what_to_run)` for each signal channel, with a copy
+    of the args updated for the channel, so the args passed (which may be
+    shared with a concurrent registration) are not modified. With more than
+    one channel, the outputs of each channel are saved to a `channel_<id>`
+    subdirectory of `output_dir`, and each channel gets its own copy of
+    `what_to_run`.
+
+    With `n_parallel_channels` > 1, up to that many channels are processed
+    at the same time in threads, each with its own copy of the args and of
+    `what_to_run`, and a share of the CPU cores.
+    """
+    if len(signal_planes_paths) > 1 and n_parallel_channels > 1:
+        n_parallel_channels = min(
+            n_parallel_channels, len(signal_planes_paths)
+        )
+        channel_n_free_cpus = get_parallel_n_free_cpus(
+            args.n_free_cpus, n_parallel_channels
+        )
+        with ThreadPoolExecutor(max_workers=n_parallel_channels) as executor:
+            futures = []
+            for idx, signal_paths in enumerate(signal_planes_paths):
+                channel = args.signal_ch_ids[idx]
+                channel_args = get_channel_args(
+                    args, output_dir, signal_paths, channel
+                )
+                channel_args.n_free_cpus = channel_n_free_cpus
+                logging.info("Processing channel: " + str(channel))
+                futures.append(
+                    executor.submit(
+                        function, channel_args, copy.copy(what_to_run)
+                    )
+                )
+            for future in futures:
+                future.result()
+
+    elif len(signal_planes_paths) > 1:
+        for idx, signal_paths in enumerate(signal_planes_paths):
+            channel = args.signal_ch_ids[idx]
+            channel_args = get_channel_args(
+                args, output_dir, signal_paths, channel
+            )
+            logging.info("Processing channel: " + str(channel))
+            function(channel_args, copy.copy(what_to_run))
+
+    else:
+        channel_args = copy.copy(args)
+        channel_args.paths = copy.copy(args.paths)
+        channel_args.signal_channel = args.signal_ch_ids[0]
+        function(channel_args, what_to_run)
 
+
+def main():
+    from brainglobe_workflows.brainmapper import prep
+
+    start_time = datetime.now()
+    metrics = RunMetrics()
+    args, arg_groups, what_to_run, atlas = prep.prep_brainmapper_general()
+    output_dir = args.output_dir
+
+    if args.convert_input:
+        args = prep.prep_input_conversion(args)
+    # the paths of each channel, as args.signal_planes_paths[0] is set to
+    # those of the channel in the args of each channel
+    signal_planes_paths = list(args.signal_planes_paths)
+
+    if what_to_run.register:
+        # TODO: add register_part_brain option
+        args, additional_images_downsample = prep.prep_registration(args)
     else:
         logging.info("Skipping registration")
 
-    if len(args.signal_planes_paths) > 1:
-        base_directory = args.output_dir
+    # the background image and classification model are loaded once, and
+    # shared by all the channels
+    from brainglobe_workflows.brainmapper.classify import (
+        SharedClassificationInputs,
+    )
 
-        for idx, signal_paths in enumerate(args.signal_planes_paths):
-            channel = args.signal_ch_ids[idx]
-            logging.info("Processing channel: " + str(channel))
-            channel_directory = os.path.join(
-                base_directory, "channel_" + str(channel)
+    shared_inputs = SharedClassificationInputs(args)
+    # the data read or computed by a stage, and reused by the later ones
+    artifacts = ArtifactStore(max_bytes=int(args.artifact_cache_gb * 2**30))
+    n_parallel_channels = args.n_parallel_channels
+
+    if what_to_run.register and args.concurrent_registration:
+        # The registration mostly runs in external (NiftyReg) processes, so
+        # a thread is enough to run it alongside the detection and
+        # classification. The analysis and figures need the registration,
+        # so they run for each channel once it is done.
+        n_free_cpus = args.n_free_cpus
+        registration_args = copy.copy(args)
+        registration_args.n_free_cpus, args.n_free_cpus = (
+            get_concurrent_n_free_cpus(
+                args.n_free_cpus, args.registration_n_cpus
             )
-            if not os.path.exists(channel_directory):
-                os.makedirs(channel_directory)
+        )
+        # whether each channel has cells, set by the classification
+        channel_cells_exist = {}
 
-            # prep signal channel specific args
-            args.signal_planes_paths[0] = signal_paths
-            # TODO: don't overwrite args.output_dir - use Paths instead
-            args.output_dir = channel_directory
-            args.signal_channel = channel
-            # Run for each channel
-            run_all(args, what_to_run, atlas)
+        def detect_and_classify(channel_args, channel_what_to_run):
+            channel_args, _ = prep.prep_channel_specific_general(
+                channel_args, channel_what_to_run
+            )
+            run_detection_and_classification(
+                channel_args,
+                channel_what_to_run,
+                metrics,
+                shared_inputs,
+                artifacts,
+            )
+            channel_cells_exist[channel_args.signal_channel] = (
+                channel_what_to_run.cells_exist
+            )
+
+        def analyse_and_plot(channel_args, channel_what_to_run):
+            channel_args, _ = prep.prep_channel_specific_general(
+                channel_args, channel_what_to_run
+            )
+            channel_what_to_run.cells_exist = channel_cells_exist[
+                channel_args.signal_channel
+            ]
+            run_analysis_and_figures(
+                channel_args, channel_what_to_run, atlas, metrics, artifacts
+            )
+
+        logging.info("Registering concurrently with cell detection")
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # a copy of what_to_run, as it is updated for each channel
+            # while the registration runs
+            registration = executor.submit(
+                register,
+                registration_args,
+                arg_groups,
+                additional_images_downsample,
+                metrics,
+                copy.copy(what_to_run),
+            )
+            run_for_each_channel(
+                detect_and_classify,
+                args,
+                what_to_run,
+                output_dir,
+                signal_planes_paths,
+                n_parallel_channels,
+            )
+            registration.result()
+
+        args.n_free_cpus = n_free_cpus
+        run_for_each_channel(
+            analyse_and_plot,
+            args,
+            what_to_run,
+            output_dir,
+            signal_planes_paths,
+            n_parallel_channels,
+        )
 
     else:
-        args.signal_channel = args.signal_ch_ids[0]
-        run_all(args, what_to_run, atlas)
+        if what_to_run.register:
+            register(
+                args,
+                arg_groups,
+                additional_images_downsample,
+                metrics,
+                what_to_run,
+            )
+        run_for_each_channel(
+            lambda channel_args, channel_what_to_run: run_all(
+                channel_args,
+                channel_what_to_run,
+                atlas,
+                metrics,
+                shared_inputs,
+                artifacts,
+            ),
+            args,
+            what_to_run,
+            output_dir,
+            signal_planes_paths,
+            n_parallel_channels,
+        )
+
+    metrics.save(output_dir)
     logging.info(
         "Finished. Total time taken: {}".format(datetime.now() - start_time)
     )
 
 
-def run_all(args, what_to_run, atlas):
-    from cellfinder.core.classify import classify
-    from cellfinder.core.detect import detect
-    from cellfinder.core.tools import prep
-
-    from brainglobe_workflows.brainmapper import analyse
+def run_all(
+    args,
+    what_to_run,
+    atlas,
+    metrics=None,
+    shared_inputs=None,
+    artifacts=None,
+):
     from brainglobe_workflows.brainmapper.prep import (
-        prep_candidate_detection,
         prep_channel_specific_general,
     )
 
-    points = None
-    signal_array = None
+    if metrics is None:
+        metrics = RunMetrics()
+    if artifacts is None:
+        artifacts = ArtifactStore()
+
     args, what_to_run = prep_channel_specific_general(args, what_to_run)
+    run_detection_and_classification(
+        args, what_to_run, metrics, shared_inputs, artifacts
+    )
+    run_analysis_and_figures(args, what_to_run, atlas, metrics, artifacts)
+
+
+def run_detection_and_classification(
+    args, what_to_run, metrics, shared_inputs=None, artifacts=None
+):
+    """
+    Detect and classify the cell candidates of a channel. These steps do
+    not depend on the registration.
+
+    The background image and classification model are taken from
+    `shared_inputs`, so they can be shared between channels. If it is not
+    given, they are loaded for this channel only. The classified cells are
+    kept in `artifacts` for the analysis and figures.
+    """
+    from brainglobe_utils.IO.image.load import read_z_stack
+
+    from brainglobe_workflows.brainmapper.cell_arrays import (
+        cells_to_arrays,
+        deal_with_artifacts,
+    )
+    from brainglobe_workflows.brainmapper.prep import prep_candidate_detection
+
+    if artifacts is None:
+        artifacts = ArtifactStore()
+    channel = args.signal_channel
+
+    candidates = None
+    signal_array = None
 
     if what_to_run.detect:
+        from cellfinder.core.detect import detect
+
         logging.info("Detecting cell candidates")
+        what_to_run.start_stage("detect", args)
         args = prep_candidate_detection(args)
-        signal_array = read_z_stack(
-            args.signal_planes_paths[args.signal_channel]
-        )
+        with metrics.stage("read", channel=channel):
+            signal_array = read_z_stack(
+                args.signal_planes_paths[args.signal_channel]
+            )
 
-        points = detect.main(
-            signal_array=signal_array,
-            start_plane=args.start_plane,
-            end_plane=args.end_plane,
-            voxel_sizes=args.voxel_sizes,
-            soma_diameter=args.soma_diameter,
-            max_cluster_size=args.max_cluster_size,
-            ball_xy_size=args.ball_xy_size,
-            ball_z_size=args.ball_z_size,
-            ball_overlap_fraction=args.ball_overlap_fraction,
-            soma_spread_factor=args.soma_spread_factor,
-            n_free_cpus=args.n_free_cpus,
-            log_sigma_size=args.log_sigma_size,
-            n_sds_above_mean_thresh=args.n_sds_above_mean_thresh,
-            n_sds_above_mean_tiled_thresh=args.n_sds_above_mean_tiled_thresh,
-            tiled_thresh_tile_size=args.tiled_thresh_tile_size,
-            save_planes=args.save_planes,
-            plane_directory=args.plane_directory,
-            batch_size=args.detection_batch_size,
-            torch_device=args.torch_device,
-            pin_memory=args.pin_memory,
-        )
+        with metrics.stage("detect", channel=channel):
+            detected = detect.main(
+                signal_array=signal_array,
+                start_plane=args.start_plane,
+                end_plane=args.end_plane,
+                voxel_sizes=args.voxel_sizes,
+                soma_diameter=args.soma_diameter,
+                max_cluster_size=args.max_cluster_size,
+                ball_xy_size=args.ball_xy_size,
+                ball_z_size=args.ball_z_size,
+                ball_overlap_fraction=args.ball_overlap_fraction,
+                soma_spread_factor=args.soma_spread_factor,
+                n_free_cpus=args.n_free_cpus,
+                log_sigma_size=args.log_sigma_size,
+                n_sds_above_mean_thresh=args.n_sds_above_mean_thresh,
+                n_sds_above_mean_tiled_thresh=(
+                    args.n_sds_above_mean_tiled_thresh
+                ),
+                tiled_thresh_tile_size=args.tiled_thresh_tile_size,
+                save_planes=args.save_planes,
+                plane_directory=args.plane_directory,
+                batch_size=args.detection_batch_size,
+                torch_device=args.torch_device,
+                pin_memory=args.pin_memory,
+            )
         ensure_directory_exists(args.paths.points_directory)
 
-        save_cells(
-            points,
-            args.paths.detected_points,
-            save_csv=args.save_csv,
-            artifact_keep=args.artifact_keep,
-        )
+        with metrics.stage("save", channel=channel):
+            candidates = deal_with_artifacts(
+                cells_to_arrays(detected), artifact_keep=args.artifact_keep
+            )
+            save_cell_outputs(
+                args,
+                candidates,
+                args.paths.detected_points,
+                args.paths.detected_points_arrays,
+                artifacts,
+            )
+        what_to_run.complete_stage("detect", args)
 
     else:
         logging.info("Skipping cell detection")
-        points = get_cells(args.paths.detected_points)
 
     if what_to_run.classify:
-        model_weights = prep.prep_model_weights(
-            args.model_weights,
-            args.install_path,
-            args.model,
+        from brainglobe_workflows.brainmapper.classify import (
+            SharedClassificationInputs,
+            classify_points,
         )
+
+        if shared_inputs is None:
+            shared_inputs = SharedClassificationInputs(args)
         if what_to_run.classify:
-            if points is None:
-                points = get_cells(args.paths.detected_points)
-            if signal_array is None:
-                signal_array = read_z_stack(
-                    args.signal_planes_paths[args.signal_channel]
+            if candidates is None:
+                candidates = get_cell_arrays(
+                    args.paths.detected_points,
+                    args.paths.detected_points_arrays,
+                    artifacts,
                 )
+            with metrics.stage("read", channel=channel):
+                if signal_array is None:
+                    signal_array = read_z_stack(
+                        args.signal_planes_paths[args.signal_channel]
+                    )
+                shared_inputs.get_background_array()
             logging.info("Running cell classification")
-            background_array = read_z_stack(args.background_planes_path[0])
+            what_to_run.start_stage("classify", args)
 
-            points = classify.main(
-                points=points,
-                signal_array=signal_array,
-                background_array=background_array,
-                n_free_cpus=args.n_free_cpus,
-                voxel_sizes=args.voxel_sizes,
-                network_voxel_sizes=args.network_voxel_sizes,
-                batch_size=args.classification_batch_size,
-                cube_height=args.cube_height,
-                cube_width=args.cube_width,
-                cube_depth=args.cube_depth,
-                trained_model=args.trained_model,
-                model_weights=model_weights,
-                network_depth=args.network_depth,
-                pin_memory=args.pin_memory,
-            )
-            save_cells(
-                points,
-                args.paths.classified_points,
-                save_csv=args.save_csv,
-            )
+            with metrics.stage("classify", channel=channel):
+                classified = classify_points(
+                    candidates, signal_array, shared_inputs, args
+                )
+            with metrics.stage("save", channel=channel):
+                save_cell_outputs(
+                    args,
+                    classified,
+                    args.paths.classified_points,
+                    args.paths.classified_points_arrays,
+                    artifacts,
+                )
+            what_to_run.complete_stage("classify", args)
 
-            what_to_run.cells_exist = cells_exist(args.paths.classified_points)
+            what_to_run.cells_exist = classified.n_cells > 0
 
         else:
             logging.info("No cells were detected, skipping classification.")
@@ -200,49 +564,64 @@ def run_all(args, what_to_run, atlas):
     else:
         logging.info("Skipping cell classification")
 
+
+def run_analysis_and_figures(
+    args, what_to_run, atlas, metrics, artifacts=None
+):
+    """
+    Analyse the positions of the classified cells of a channel in the
+    atlas, and generate the figures. These steps need the registration.
+
+    The classified cells and the shape of the downsampled space are taken
+    from `artifacts` if they were loaded by a previous stage.
+    """
+    if artifacts is None:
+        artifacts = ArtifactStore()
+    channel = args.signal_channel
+
     what_to_run.update_if_cells_required()
 
     if what_to_run.analyse or what_to_run.figures:
         downsampled_space = get_downsampled_space(
-            atlas, args.brainreg_paths.boundaries_file_path
+            atlas, args.brainreg_paths.boundaries_file_path, artifacts
         )
 
     if what_to_run.analyse:
-        points = get_cells(args.paths.classified_points, cells_only=True)
-        if len(points) == 0:
+        from brainglobe_workflows.brainmapper import analyse
+
+        points = get_cell_arrays(
+            args.paths.classified_points,
+            args.paths.classified_points_arrays,
+            artifacts,
+        ).cells_only()
+        what_to_run.start_stage("analyse", args)
+        if points.n_cells == 0:
             logging.info("No cells detected, skipping cell position analysis")
+            what_to_run.complete_stage("analyse", args, outputs=[])
         else:
             logging.info("Analysing cell positions")
-            analyse.run(args, points, atlas, downsampled_space)
+            with metrics.stage("analyse", channel=channel):
+                analyse.run(args, points, atlas, downsampled_space)
+            what_to_run.complete_stage("analyse", args)
     else:
         logging.info("Skipping cell position analysis")
 
     if what_to_run.figures:
-        points = get_cells(args.paths.classified_points, cells_only=True)
-        if len(points) == 0:
+        points = get_cell_arrays(
+            args.paths.classified_points,
+            args.paths.classified_points_arrays,
+            artifacts,
+        ).cells_only()
+        what_to_run.start_stage("figures", args)
+        if points.n_cells == 0:
             logging.info("No cells detected, skipping")
+            what_to_run.complete_stage("figures", args, outputs=[])
         else:
             logging.info("Generating heatmap")
 
-            if args.mask_figures:
-                mask_image = tifffile.imread(
-                    args.brainreg_paths.registered_atlas
-                )
-            else:
-                mask_image = None
-
-            downsampled_points = pd.read_hdf(
-                args.paths.downsampled_points
-            ).values
-
-            heatmap_from_points(
-                downsampled_points,
-                atlas.resolution[0],  # assumes isotropic atlas
-                downsampled_space.shape,
-                output_filename=args.paths.heatmap,
-                smoothing=args.heatmap_smooth,
-                mask_image=mask_image,
-            )
+            with metrics.stage("figures", channel=channel):
+                generate_heatmap(args, atlas, downsampled_space)
+            what_to_run.complete_stage("figures", args)
     else:
         logging.info("Skipping figure generation")
 
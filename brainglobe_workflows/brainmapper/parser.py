@@ -17,8 +17,7 @@ from brainglobe_utils.general.numerical import (
     check_positive_int,
 )
 from brainglobe_utils.general.string import check_str
-from brainreg.core.cli import atlas_parse, geometry_parser, niftyreg_parse
-from brainreg.core.cli import backend_parse as brainreg_backend_parse
+from brainreg.core.backend.niftyreg.parser import niftyreg_parse
 from cellfinder.core.download.cli import download_parser
 from cellfinder.core.tools.source_files import user_specific_configuration_path
 
@@ -68,14 +67,60 @@ def brainmapper_parser():
 
     # brainreg options
     parser = atlas_parse(parser)
-    parser = geometry_parser(parser)
-    parser = brainreg_backend_parse(parser)
+    parser = geometry_parse(parser)
+    parser = backend_parse(parser)
     # This needs to be abstracted away into brainreg for multiple backends
     parser = niftyreg_parse(parser)
 
     return parser
 
 
+# The brainreg options are defined as in `brainreg.core.cli`, rather than
+# imported from it: that module imports brainreg's registration pipeline,
+# and with it the atlas API and image libraries, which would make parsing
+# the command line (or printing the help) take several seconds.
+
+
+def atlas_parse(parser):
+    atlas_parser = parser.add_argument_group("brainreg registration options")
+    atlas_parser.add_argument(
+        "--atlas",
+        dest="atlas",
+        type=str,
+        default="allen_mouse_25um",
+        help="Brainglobe atlas to use for registration. Run 'brainglobe list' "
+        "to see the atlases available.",
+    )
+    return parser
+
+
+def backend_parse(parser):
+    backend_parser = parser.add_argument_group("registration backend options")
+    backend_parser.add_argument(
+        "--backend",
+        dest="backend",
+        type=str,
+        default="niftyreg",
+        help="Registration backend to use.",
+    )
+    return parser
+
+
+def geometry_parse(parser):
+    geometry_opt_parser = parser.add_argument_group(
+        "Options to define size/shape/orientation of data"
+    )
+    geometry_opt_parser.add_argument(
+        "--orientation",
+        type=str,
+        required=True,
+        help="The orientation of the sample brain. "
+        "This is used to transpose the atlas "
+        "into the same orientation as the brain.",
+    )
+    return parser
+
+
 def main_parse(parser):
     main_parser = parser.add_argument_group("General options")
 
@@ -216,6 +261,15 @@ def io_parse(parser):
         help="The last plane to process in the Z dimension (exclusive, to "
         "process a subset of the data).",
     )
+    io_parser.add_argument(
+        "--convert-input",
+        dest="convert_input",
+        action="store_true",
+        help="Convert the input planes once into a single 3D TIFF stack per "
+        "channel, cached in the output directory, before processing. This "
+        "speeds up reading data stored as many 2D TIFF files. The cached "
+        "stacks are reused while the input files are unchanged.",
+    )
     return parser
 
 
@@ -456,8 +510,18 @@ def figures_parse(parser):
         "--heatmap-smoothing",
         dest="heatmap_smooth",
         type=check_positive_float,
-        default=100,
-        help="Gaussian smoothing sigma, in um.",
+        nargs="+",
+        default=[100],
+        help="Gaussian smoothing sigma, in um. Several values can be given, "
+        "to generate a heatmap for each, with the first one saved as "
+        "'heatmap.tiff'. Use 'None' for no smoothing.",
+    )
+    figure_parser.add_argument(
+        "--heatmap-pyramid",
+        dest="heatmap_pyramid",
+        action="store_true",
+        help="Also save each heatmap as a multi-resolution OME-Zarr pyramid "
+        "(e.g. 'heatmap.zarr'), to browse large heatmaps.",
     )
     figure_parser.add_argument(
         "--no-mask-figs",
@@ -479,6 +543,44 @@ def misc_parse(parser):
         help="The number of CPU cores on the machine to leave "
         "unused by the program to spare resources.",
     )
+    misc_parser.add_argument(
+        "--concurrent-registration",
+        dest="concurrent_registration",
+        action="store_true",
+        help="Run the registration at the same time as the cell detection "
+        "and classification, which do not depend on it, splitting the CPU "
+        "cores between them. The analysis starts once both are done.",
+    )
+    misc_parser.add_argument(
+        "--registration-n-cpus",
+        dest="registration_n_cpus",
+        type=check_positive_int,
+        default=None,
+        help="The number of CPU cores used by the registration when it runs "
+        "at the same time as the cell detection (see "
+        "--concurrent-registration). The other cores are used by the cell "
+        "detection and classification. Defaults to half of the cores "
+        "available.",
+    )
+    misc_parser.add_argument(
+        "--n-parallel-channels",
+        dest="n_parallel_channels",
+        type=check_positive_int,
+        default=1,
+        help="The number of signal channels to detect and classify cells "
+        "in at the same time, splitting the CPU cores between them. The "
+        "background image and the classification model are loaded once "
+        "and shared by all the channels.",
+    )
+    misc_parser.add_argument(
+        "--artifact-cache-gb",
+        dest="artifact_cache_gb",
+        type=float,
+        default=4,
+        help="The memory, in GB, used to keep the classified cells and the "
+        "shape of the registered image, read or computed by a step, for the "
+        "later steps, rather than reading them again.",
+    )
     misc_parser.add_argument(
         "--torch-device",
         dest="torch_device",
@@ -504,7 +606,8 @@ def misc_parse(parser):
         type=check_positive_float,
         default=None,
         help="Maximum amount of RAM to use (in GB) - not currently fully "
-        "implemented for all parts of brainmapper",
+        "implemented for all parts of brainmapper. Heatmaps that need more "
+        "are generated in slabs. By default, half of the available RAM.",
     )
     misc_parser.add_argument(
         "--save-csv",
@@ -513,6 +616,16 @@ def misc_parse(parser):
         help="Save .csv files of cell locations (in addition to xml)."
         "Useful for importing into other software.",
     )
+    misc_parser.add_argument(
+        "--no-cells-xml",
+        dest="no_cells_xml",
+        action="store_true",
+        help="Only save the cells as arrays (in the 'cells.arrays' and "
+        "'cell_classification.arrays' directories), and not as xml files, "
+        "which are slow to write and read for millions of cells. The xml "
+        "files can be exported later with "
+        "'python -m brainglobe_workflows.brainmapper.cell_arrays'.",
+    )
     misc_parser.add_argument(
         "--debug",
         dest="debug",
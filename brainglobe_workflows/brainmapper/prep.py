@@ -8,9 +8,8 @@ import json
 import logging
 import os
 from argparse import Namespace
-from pathlib import PurePath
+from pathlib import Path, PurePath
 
-from brainglobe_atlasapi import BrainGlobeAtlas
 from brainglobe_utils.general.exceptions import CommandLineInputError
 from brainglobe_utils.general.list import check_unique_list, common_member
 from brainglobe_utils.general.system import (
@@ -22,9 +21,11 @@ from fancylog import fancylog
 
 import brainglobe_workflows as package_for_log
 import brainglobe_workflows.brainmapper.parser as parser
+from brainglobe_workflows.brainmapper import stages
 from brainglobe_workflows.brainmapper.parser import (
     brainmapper_parser,
 )
+from brainglobe_workflows.utils import CONVERTED_DIRNAME
 
 
 def get_arg_groups(args, parser):
@@ -69,13 +70,26 @@ class Paths:
         self.registration_metadata_path = os.path.join(
             self.registration_output_folder, "brainreg.json"
         )
+        self.converted_input_folder = os.path.join(
+            self.output_dir, CONVERTED_DIRNAME
+        )
+        # the records of the stages that have completed (see stages.py)
+        self.stages_directory = os.path.join(self.output_dir, "stages")
 
     def make_channel_specific_paths(self):
         self.points_directory = os.path.join(self.output_dir, "points")
+        self.channel_stages_directory = os.path.join(self.output_dir, "stages")
         self.detected_points = os.path.join(self.points_directory, "cells.xml")
         self.classified_points = os.path.join(
             self.points_directory, "cell_classification.xml"
         )
+        # the same cells, saved as arrays (see cell_arrays.py)
+        self.detected_points_arrays = os.path.join(
+            self.points_directory, "cells.arrays"
+        )
+        self.classified_points_arrays = os.path.join(
+            self.points_directory, "cell_classification.arrays"
+        )
         self.downsampled_points = os.path.join(
             self.points_directory, "downsampled.points"
         )
@@ -94,6 +108,9 @@ class Paths:
         self.all_points_csv = os.path.join(
             self.analysis_directory, "all_points.csv"
         )
+        self.summary_hierarchy_csv = os.path.join(
+            self.analysis_directory, "summary_hierarchy.csv"
+        )
 
 
 def serialise(obj):
@@ -130,11 +147,15 @@ def prep_brainmapper_general():
 
     log_metadata(args.paths.metadata_path, args)
 
-    what_to_run = CalcWhatToRun(args)
     args.signal_ch_ids, args.background_ch_id = check_and_return_ch_ids(
         args.signal_ch_ids, args.background_ch_id, args.signal_planes_paths
     )
     args.brainreg_paths = BrainRegPaths(args.paths.registration_output_folder)
+    what_to_run = CalcWhatToRun(args)
+
+    # imported here, as it imports the image libraries
+    from brainglobe_atlasapi import BrainGlobeAtlas
+
     atlas = BrainGlobeAtlas(args.atlas)
     return args, arg_groups, what_to_run, atlas
 
@@ -223,9 +244,32 @@ def check_sig_bg_id_overlap(signal_ids, background_id):
         )
 
 
+def get_model_weights_path(args):
+    """
+    Get the path to the model, or the model weights, that the cells are
+    classified with, as in `classify.SharedClassificationInputs`: the
+    trained model or the weights given, or otherwise the default weights,
+    which are downloaded if they are not installed.
+    """
+    model_path = getattr(args, "trained_model", None) or getattr(
+        args, "model_weights", None
+    )
+    if model_path is not None:
+        return Path(model_path)
+
+    from cellfinder.core.tools.prep import prep_model_weights
+
+    return prep_model_weights(None, args.install_path, args.model)
+
+
 class CalcWhatToRun:
     """
-    Class to (hopefully) simplify what should and shouldn't be run
+    Class to (hopefully) simplify what should and shouldn't be run.
+
+    A stage runs if it is enabled on the command line, unless it has
+    already completed with the same inputs and parameters (see stages.py).
+    The fingerprints of the stages are kept for the current channel, so
+    the stages that run save them once they complete.
     """
 
     def __init__(self, args):
@@ -237,16 +281,34 @@ class CalcWhatToRun:
         self.candidates_exist = True
         self.cells_exist = True
 
-        self.atlas_image = os.path.join(
-            args.paths.registration_output_folder, "registered_atlas.tiff"
+        # what the outputs of each stage are computed from, and their
+        # fingerprints, or None if a stage cannot run
+        self.stage_keys = {}
+        self.fingerprints = {}
+        self.stage_records = {}
+        # the fingerprint of the classification model, found once the
+        # classification is known to be enabled, as the default model
+        # weights may need to be downloaded
+        self.model_fingerprint = None
+
+        # the input data are fingerprinted before they are converted (with
+        # --convert-input), so that converting them does not change the
+        # fingerprints
+        sort_input_file = getattr(args, "sort_input_file", False)
+        self.signal_fingerprints = [
+            stages.fingerprint_input_data(signal_paths, sort_input_file)
+            for signal_paths in args.signal_planes_paths
+        ]
+        self.background_fingerprint = stages.fingerprint_input_data(
+            args.background_planes_path[0], sort_input_file
         )
         # order is important
         self.cli_options(args)
-        self.existence()
+        self.registration_update(args)
 
     def update(self, args):
         self.cli_options(args)
-        self.existence()
+        self.registration_update(args)
         self.channel_specific_update(args)
 
     def cli_options(self, args):
@@ -256,40 +318,105 @@ class CalcWhatToRun:
         self.analyse = not args.no_analyse
         self.figures = not args.no_figures
 
-    def existence(self):
-        if os.path.exists(self.atlas_image):
-            logging.warning(
-                "Registered atlas exists, assuming " "already run. Skipping."
-            )
-            self.register = False
+    def registration_update(self, args):
+        # new dicts, so the copies of this object made for each channel
+        # do not share them
+        self.stage_keys = {}
+        self.fingerprints = {}
+        self.stage_records = {}
+        self.update_stage(
+            "register",
+            args,
+            {
+                "background": self.background_fingerprint,
+                "signal": self.signal_fingerprints,
+            },
+        )
 
     def channel_specific_update(self, args):
-        if os.path.exists(args.paths.detected_points):
-            logging.warning(
-                "Initial detection file exists (cells.xml), "
-                "assuming already run. Skipping."
-            )
-            self.detect = False
-
-        if os.path.exists(args.paths.classified_points):
+        channel_idx = args.signal_ch_ids.index(args.signal_channel)
+        signal_fingerprint = self.signal_fingerprints[channel_idx]
+        if self.classify and self.model_fingerprint is None:
+            model_path = get_model_weights_path(args)
+            if model_path.exists():
+                from brainglobe_workflows.image_io import fingerprint_files
+
+                self.model_fingerprint = fingerprint_files([model_path])
+
+        self.update_stage("detect", args, {"signal": signal_fingerprint})
+        self.update_stage(
+            "classify",
+            args,
+            {
+                "signal": signal_fingerprint,
+                "background": self.background_fingerprint,
+                "model": self.model_fingerprint,
+            },
+        )
+        self.update_stage("analyse", args, {"signal": signal_fingerprint})
+        self.update_stage("figures", args)
+
+    def update_stage(self, name, args, inputs=None):
+        """
+        Decide whether a stage runs, and compute its fingerprint from its
+        inputs and those of the stages it reads from.
+
+        A stage enabled on the command line runs unless it has completed
+        with the same fingerprint. A stage that does not run takes the
+        fingerprint of its existing outputs. A stage that reads from a
+        stage with no outputs cannot run.
+        """
+        inputs = dict(inputs or {})
+        for dependency in stages.STAGES[name].dependencies:
+            inputs[dependency] = self.fingerprints[dependency]
+        missing = [
+            dependency
+            for dependency in stages.STAGES[name].dependencies
+            if inputs[dependency] is None
+        ]
+
+        run = getattr(self, name)
+        if run and missing:
             logging.warning(
-                "Cell classification file "
-                "(cell_classification.xml)"
-                " exists, assuming already run. Skipping cell detection, "
-                "and classification"
+                f"Cannot run the {name} stage, as there are no outputs of "
+                f"the {', '.join(missing)} stage. Skipping."
             )
-            self.classify = False
-            self.detect = False
-
-        if not os.path.exists(self.atlas_image):
-            self.analyse = False
-            self.figures = False
-
-        if os.path.exists(args.paths.summary_csv):
-            self.analyse = False
-
-        if os.path.exists(args.paths.heatmap):
-            self.figures = False
+            run = False
+
+        if run:
+            key = stages.get_stage_key(name, args, inputs)
+            fingerprint = stages.get_fingerprint(key)
+            record = stages.read_stage_record(name, args)
+            if stages.is_stage_complete(record, fingerprint):
+                logging.warning(
+                    f"The {name} stage has already run with the same "
+                    "inputs and parameters. Skipping."
+                )
+                run = False
+            else:
+                stages.log_stage_to_run(name, record, key)
+                self.stage_keys = {**self.stage_keys, name: key}
+        else:
+            fingerprint = stages.get_outputs_fingerprint(name, args)
+
+        setattr(self, name, run)
+        self.fingerprints = {**self.fingerprints, name: fingerprint}
+
+    def start_stage(self, name, args):
+        """
+        Remove the record of a stage before it runs, so its outputs are not
+        reused if it does not complete.
+        """
+        stages.remove_stage_record(name, args)
+
+    def complete_stage(self, name, args, outputs=None):
+        """
+        Save the record of a stage that has completed, with its outputs,
+        by default all of them.
+        """
+        stages.save_stage_record(
+            name, args, self.stage_keys[name], outputs=outputs
+        )
 
     def update_if_candidates_required(self):
         if not self.candidates_exist:
@@ -301,6 +428,38 @@ class CalcWhatToRun:
             self.figures = False
 
 
+def prep_input_conversion(args):
+    """
+    Convert the signal and background planes into single 3D TIFF stacks,
+    cached in the output directory, and point the input paths to them.
+    The conversion is skipped if the source files are unchanged since a
+    previous run.
+    """
+    from brainglobe_workflows.image_io import convert_to_tiff_stack
+
+    logging.info("Converting input data to 3D TIFF stacks")
+    args.signal_planes_paths = [
+        str(
+            convert_to_tiff_stack(
+                signal_paths,
+                args.paths.converted_input_folder,
+                sort_input_file=args.sort_input_file,
+            )
+        )
+        for signal_paths in args.signal_planes_paths
+    ]
+    args.background_planes_path = [
+        str(
+            convert_to_tiff_stack(
+                args.background_planes_path[0],
+                args.paths.converted_input_folder,
+                sort_input_file=args.sort_input_file,
+            )
+        )
+    ]
+    return args
+
+
 def prep_registration(args):
     args.target_brain_path = args.background_planes_path[0]
     logging.debug("Making registration directory")
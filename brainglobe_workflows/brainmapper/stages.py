@@ -0,0 +1,459 @@
+"""Decide which stages of brainmapper need to run
+
+Once a stage of brainmapper (registration, cell detection, classification,
+analysis or figures) has completed, it saves a record of what its outputs
+were computed from, and a fingerprint (a hash) of it:
+
+- the parameters that change its outputs,
+- the input data it reads, from the path, size and modification time of
+  each file, taken from the cached file manifest of a directory of planes
+  (see `image_io`),
+- the fingerprints of the stages whose outputs it reads, and
+- the versions of the packages that compute its outputs.
+
+A stage is skipped only if its record has the same fingerprint as the
+current run and all its outputs exist. So changing a parameter re-runs the
+stages that depend on it, and only those (e.g. changing the heatmap
+smoothing only generates the figures again), and the outputs of a stage
+that was interrupted, which has no record, are not reused.
+
+The fingerprint of a stage depends on the fingerprints of the stages it
+reads from, computed from their own inputs and parameters, so whether each
+stage needs to run is known before any of them runs. A stage disabled on
+the command line (e.g. with `--no-register`) does not run, and its outputs
+are read as they are: the stages that read them use its record if it has
+one, or otherwise a fingerprint of its output files.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+
+Pathlike = Union[str, os.PathLike]
+
+STAGE_RECORD_SUFFIX = ".json"
+
+
+class Stage(NamedTuple):
+    """A stage of brainmapper, and what its outputs depend on."""
+
+    # the name of the stage, which is also the attribute of
+    # `prep.CalcWhatToRun` set if it runs
+    name: str
+    # the arguments that change the outputs of the stage
+    parameters: Tuple[str, ...]
+    # the stages whose outputs are read by the stage
+    dependencies: Tuple[str, ...]
+    # the packages that compute the outputs of the stage
+    packages: Tuple[str, ...]
+    # whether the stage runs for each signal channel
+    channel_specific: bool
+
+
+NIFTYREG_PARAMETERS = (
+    "affine_n_steps",
+    "affine_use_n_steps",
+    "freeform_n_steps",
+    "freeform_use_n_steps",
+    "bending_energy_weight",
+    "grid_spacing",
+    "smoothing_sigma_reference",
+    "smoothing_sigma_floating",
+    "histogram_n_bins_floating",
+    "histogram_n_bins_reference",
+)
+
+# the stages, in the order they run
+STAGES = {
+    stage.name: stage
+    for stage in (
+        Stage(
+            "register",
+            ("atlas", "orientation", "voxel_sizes", "backend")
+            + NIFTYREG_PARAMETERS,
+            (),
+            ("brainreg",),
+            False,
+        ),
+        Stage(
+            "detect",
+            (
+                "voxel_sizes",
+                "start_plane",
+                "end_plane",
+                "soma_diameter",
+                "ball_xy_size",
+                "ball_z_size",
+                "ball_overlap_fraction",
+                "log_sigma_size",
+                "n_sds_above_mean_thresh",
+                "n_sds_above_mean_tiled_thresh",
+                "tiled_thresh_tile_size",
+                "soma_spread_factor",
+                "max_cluster_size",
+                "artifact_keep",
+            ),
+            (),
+            ("cellfinder",),
+            True,
+        ),
+        Stage(
+            "classify",
+            (
+                "voxel_sizes",
+                "network_voxel_sizes",
+                "cube_width",
+                "cube_height",
+                "cube_depth",
+                "trained_model",
+                "model_weights",
+                "model",
+                "network_depth",
+            ),
+            ("detect",),
+            ("cellfinder",),
+            True,
+        ),
+        Stage(
+            "analyse",
+            ("atlas", "orientation", "voxel_sizes"),
+            ("register", "classify"),
+            ("brainglobe-workflows", "brainglobe-utils"),
+            True,
+        ),
+        Stage(
+            "figures",
+            ("heatmap_smooth", "mask_figures"),
+            ("register", "analyse"),
+            ("brainglobe-workflows",),
+            True,
+        ),
+    )
+}
+
+
+def get_package_version(package: str) -> Optional[str]:
+    """Get the installed version of a package, or None if not installed."""
+    try:
+        return version(package)
+    except PackageNotFoundError:
+        return None
+
+
+def fingerprint_input_data(
+    data_path: Optional[Pathlike], sort_input_file: bool = False
+) -> Optional[str]:
+    """Compute a fingerprint of the files of an input image.
+
+    The sizes and modification times of the planes in a directory are read
+    from its cached file manifest (see `image_io.read_file_manifest`), so
+    the planes are not each read from storage. Planes modified in place,
+    without adding, removing or renaming any, are therefore not detected.
+
+    Parameters
+    ----------
+    data_path : Pathlike, optional
+        a directory of 2D TIFF planes, a text file listing them, a single
+        image file or a zarr store
+    sort_input_file : bool, optional
+        whether the paths in a text file are sorted naturally, by default
+        False
+
+    Returns
+    -------
+    str or None
+        the fingerprint, as a hexadecimal string, or None if `data_path`
+        is None
+    """
+    # imported here, as it imports the image libraries
+    from brainglobe_workflows.image_io import (
+        fingerprint_file_stats,
+        fingerprint_files,
+        list_tiff_file_stats,
+        list_zarr_store_files,
+    )
+
+    if data_path is None:
+        return None
+    if Path(data_path).suffix == ".zarr":
+        return fingerprint_files(list_zarr_store_files(data_path))
+    return fingerprint_file_stats(
+        list_tiff_file_stats(data_path, sort_input_file)
+    )
+
+
+def get_stage_outputs(name: str, args) -> List[str]:
+    """Get the paths of the outputs of a stage.
+
+    Parameters
+    ----------
+    name : str
+        name of the stage
+    args : argparse.Namespace
+        brainmapper arguments, with the channel specific paths for the
+        stages that run for each channel
+
+    Returns
+    -------
+    List[str]
+        the paths of the files (or directories) the stage writes
+    """
+    if name == "register":
+        brainreg_paths = args.brainreg_paths
+        return [
+            brainreg_paths.downsampled_brain_path,
+            brainreg_paths.boundaries_file_path,
+            brainreg_paths.registered_atlas,
+            brainreg_paths.registered_hemispheres,
+            brainreg_paths.deformation_field_0,
+            brainreg_paths.deformation_field_1,
+            brainreg_paths.deformation_field_2,
+            brainreg_paths.volume_csv_path,
+        ]
+
+    paths = args.paths
+    if name in ("detect", "classify"):
+        if name == "detect":
+            outputs = [paths.detected_points_arrays, paths.detected_points]
+        else:
+            outputs = [
+                paths.classified_points_arrays,
+                paths.classified_points,
+            ]
+        if getattr(args, "no_cells_xml", False):
+            outputs = outputs[:1]
+        return outputs
+    if name == "analyse":
+        return [
+            paths.downsampled_points,
+            paths.atlas_points,
+            paths.brainrender_points,
+            paths.all_points_csv,
+            paths.summary_csv,
+            paths.summary_hierarchy_csv,
+        ]
+    if name == "figures":
+        from brainglobe_workflows.brainmapper.heatmap import (
+            get_heatmap_paths,
+        )
+
+        smoothings = args.heatmap_smooth
+        if not isinstance(smoothings, (list, tuple)):
+            smoothings = [smoothings]
+        outputs = []
+        for idx, smoothing in enumerate(smoothings):
+            tiff_path, pyramid_path = get_heatmap_paths(
+                paths.heatmap, smoothing, first=idx == 0
+            )
+            outputs.append(str(tiff_path))
+            if getattr(args, "heatmap_pyramid", False):
+                outputs.append(str(pyramid_path))
+        return outputs
+    raise ValueError(f"Unknown brainmapper stage: {name}")
+
+
+def get_stage_record_path(name: str, args) -> str:
+    """Get the path of the record of a stage.
+
+    The records of the registration are saved in the stages directory of
+    the output directory, and those of the other stages in that of the
+    output directory of each channel.
+    """
+    if STAGES[name].channel_specific:
+        stages_directory = args.paths.channel_stages_directory
+    else:
+        stages_directory = args.paths.stages_directory
+    return os.path.join(stages_directory, name + STAGE_RECORD_SUFFIX)
+
+
+def get_stage_key(name: str, args, inputs: Dict[str, Optional[str]]) -> dict:
+    """Get what the outputs of a stage are computed from.
+
+    Parameters
+    ----------
+    name : str
+        name of the stage
+    args : argparse.Namespace
+        brainmapper arguments
+    inputs : Dict[str, Optional[str]]
+        the fingerprints of the input data, and of the stages, read by the
+        stage
+
+    Returns
+    -------
+    dict
+        the parameters, inputs and package versions of the stage
+    """
+    stage = STAGES[name]
+    return {
+        "parameters": {
+            param: getattr(args, param, None) for param in stage.parameters
+        },
+        "inputs": dict(inputs),
+        "versions": {
+            package: get_package_version(package) for package in stage.packages
+        },
+    }
+
+
+def get_fingerprint(key: dict) -> str:
+    """Compute the fingerprint of the key of a stage, as a hexadecimal
+    string."""
+    return hashlib.sha256(
+        json.dumps(key, sort_keys=True, default=str).encode()
+    ).hexdigest()[:16]
+
+
+def read_stage_record(name: str, args) -> Optional[dict]:
+    """Read the record of a stage, or return None if there is none."""
+    record_path = get_stage_record_path(name, args)
+    try:
+        with open(record_path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError, UnicodeDecodeError):
+        return None
+
+
+def is_stage_complete(record: Optional[dict], fingerprint: str) -> bool:
+    """Check whether a stage has completed with the given fingerprint,
+    and all its outputs still exist."""
+    return (
+        record is not None
+        and record.get("fingerprint") == fingerprint
+        and all(os.path.exists(path) for path in record.get("outputs", []))
+    )
+
+
+def get_changes(record: Optional[dict], key: dict) -> List[str]:
+    """List what changed since a stage last completed.
+
+    Parameters
+    ----------
+    record : dict, optional
+        the record of the stage, or None if it has not completed
+    key : dict
+        what the outputs of the stage are computed from in this run (see
+        `get_stage_key`)
+
+    Returns
+    -------
+    List[str]
+        the parameters, inputs and package versions that changed, e.g.
+        "parameter soma_diameter"
+    """
+    if record is None:
+        return []
+    # compare as saved to the record, e.g. with tuples as lists
+    key = json.loads(json.dumps(key, default=str))
+    changes = []
+    for group, label in (
+        ("parameters", "parameter"),
+        ("inputs", "input"),
+        ("versions", "version of"),
+    ):
+        recorded = record.get("key", {}).get(group, {})
+        for name in sorted(set(recorded) | set(key[group])):
+            if recorded.get(name) != key[group].get(name):
+                changes.append(f"{label} {name}")
+    return changes
+
+
+def save_stage_record(
+    name: str,
+    args,
+    key: dict,
+    outputs: Optional[List[str]] = None,
+):
+    """Save the record of a stage once it has completed.
+
+    Parameters
+    ----------
+    name : str
+        name of the stage
+    args : argparse.Namespace
+        brainmapper arguments
+    key : dict
+        what the outputs of the stage are computed from (see
+        `get_stage_key`)
+    outputs : List[str], optional
+        the outputs written by the stage, by default all its outputs (see
+        `get_stage_outputs`)
+    """
+    if outputs is None:
+        outputs = get_stage_outputs(name, args)
+    record_path = Path(get_stage_record_path(name, args))
+    record_path.parent.mkdir(parents=True, exist_ok=True)
+
+    # write to a temporary file first, so a partial record is never read
+    partial_path = record_path.with_name(record_path.name + ".partial")
+    with open(partial_path, "w") as f:
+        json.dump(
+            {
+                "stage": name,
+                "fingerprint": get_fingerprint(key),
+                "key": key,
+                "outputs": [str(path) for path in outputs],
+            },
+            f,
+            indent=2,
+            default=str,
+        )
+    os.replace(partial_path, record_path)
+
+
+def remove_stage_record(name: str, args):
+    """Remove the record of a stage, before it runs, so its outputs are not
+    reused if it is interrupted."""
+    record_path = get_stage_record_path(name, args)
+    if os.path.exists(record_path):
+        os.remove(record_path)
+
+
+def get_outputs_fingerprint(name: str, args) -> Optional[str]:
+    """Get the fingerprint of the outputs of a stage that does not run.
+
+    Parameters
+    ----------
+    name : str
+        name of the stage
+    args : argparse.Namespace
+        brainmapper arguments
+
+    Returns
+    -------
+    str or None
+        the fingerprint of the record of the stage, if its outputs exist,
+        or otherwise of its output files, or None if they do not exist
+    """
+    record = read_stage_record(name, args)
+    if record is not None and is_stage_complete(
+        record, record.get("fingerprint")
+    ):
+        return record["fingerprint"]
+
+    outputs = get_stage_outputs(name, args)
+    if not all(os.path.exists(path) for path in outputs):
+        return None
+
+    from brainglobe_workflows.image_io import fingerprint_files
+
+    return fingerprint_files([Path(path) for path in outputs])
+
+
+def log_stage_to_run(name: str, record: Optional[dict], key: dict):
+    """Log why a stage runs again, if it has completed before."""
+    changes = get_changes(record, key)
+    if changes:
+        logging.info(
+            f"Running the {name} stage again, as its "
+            f"{', '.join(changes)} changed"
+        )
+    elif record is not None:
+        logging.info(
+            f"Running the {name} stage again, as some of its outputs are "
+            "missing"
+        )
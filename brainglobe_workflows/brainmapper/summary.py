@@ -0,0 +1,372 @@
+"""Summarise cells by atlas region with array operations
+
+This is a vectorised version of
+`brainglobe_utils.brainmapper.analysis.summarise_points_by_atlas_region`,
+for millions of cells. Rather than looking up the structure and hemisphere
+of each cell in turn, and then counting the cells of each structure and
+hemisphere with a pass over all the cells:
+
+- the annotation and hemisphere of all the cells are looked up with one
+  indexing operation each,
+- the cells of each structure and hemisphere are counted with a single
+  `np.bincount`,
+- the counts are rolled up the structure hierarchy, so each structure also
+  counts the cells of its substructures, with a single `np.add.at` over
+  the (structure, ancestor) pairs of the atlas,
+- the table of all the cells is built column by column.
+
+The summary and table of all the cells are the same as those of
+brainglobe_utils.
+"""
+
+import os
+from pathlib import Path
+from typing import NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+Pathlike = Union[str, os.PathLike]
+
+HEMISPHERES = ("left", "right")
+# hemisphere values of the atlas hemispheres image
+LEFT_HEMISPHERE_VALUE = 1
+RIGHT_HEMISPHERE_VALUE = 2
+
+
+class StructureTable(NamedTuple):
+    """The structures of an atlas, as arrays indexed by structure.
+
+    Attributes
+    ----------
+    ids : np.ndarray
+        the (sorted) identifiers of the structures, as in the annotation
+    names, acronyms : np.ndarray
+        the names and acronyms of the structures
+    parent_ids : np.ndarray
+        the identifier of the parent of each structure, or -1 for the root
+    depths : np.ndarray
+        the depth of each structure in the hierarchy, 0 for the root
+    pair_structures, pair_ancestors : np.ndarray
+        the index of each structure and of each of its ancestors, including
+        itself, as pairs of arrays
+    """
+
+    ids: np.ndarray
+    names: np.ndarray
+    acronyms: np.ndarray
+    parent_ids: np.ndarray
+    depths: np.ndarray
+    pair_structures: np.ndarray
+    pair_ancestors: np.ndarray
+
+    @property
+    def n_structures(self) -> int:
+        """The number of structures."""
+        return len(self.ids)
+
+    def get_indices(self, structure_ids: np.ndarray) -> np.ndarray:
+        """Get the index of each structure identifier, or -1 for the
+        identifiers that are not structures of the atlas (e.g. 0, outside
+        the brain)."""
+        indices = np.searchsorted(self.ids, structure_ids)
+        indices = np.minimum(indices, self.n_structures - 1)
+        return np.where(self.ids[indices] == structure_ids, indices, -1)
+
+
+def get_structure_table(atlas) -> StructureTable:
+    """Get the structures of an atlas as arrays.
+
+    Parameters
+    ----------
+    atlas : BrainGlobeAtlas
+        the atlas
+
+    Returns
+    -------
+    StructureTable
+        the structures of the atlas
+    """
+    structures = sorted(atlas.structures.values(), key=lambda s: s["id"])
+    ids = np.array([s["id"] for s in structures], dtype=np.int64)
+    table = StructureTable(
+        ids=ids,
+        names=np.array([s["name"] for s in structures], dtype=object),
+        acronyms=np.array([s["acronym"] for s in structures], dtype=object),
+        parent_ids=np.array(
+            [
+                (
+                    s["structure_id_path"][-2]
+                    if len(s["structure_id_path"]) > 1
+                    else -1
+                )
+                for s in structures
+            ],
+            dtype=np.int64,
+        ),
+        depths=np.array(
+            [len(s["structure_id_path"]) - 1 for s in structures],
+            dtype=np.int64,
+        ),
+        pair_structures=np.repeat(
+            np.arange(len(structures)),
+            [len(s["structure_id_path"]) for s in structures],
+        ),
+        pair_ancestors=np.empty(0, dtype=np.int64),
+    )
+    ancestor_ids = np.array(
+        [i for s in structures for i in s["structure_id_path"]],
+        dtype=np.int64,
+    )
+    return table._replace(pair_ancestors=table.get_indices(ancestor_ids))
+
+
+def lookup_regions(
+    atlas_points: np.ndarray, atlas, structure_table: StructureTable
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Look up the structure and hemisphere of points in the atlas space.
+
+    Parameters
+    ----------
+    atlas_points : np.ndarray
+        (N, 3) array of points in the atlas space, in voxels of the atlas
+    atlas : BrainGlobeAtlas
+        the atlas
+    structure_table : StructureTable
+        the structures of the atlas
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, np.ndarray]
+        the index of the structure of each point in `structure_table`, the
+        index of its hemisphere in `HEMISPHERES`, and a boolean mask of the
+        points in a structure of the atlas. Points outside the annotation
+        (including at negative coordinates), outside the brain, or outside
+        both hemispheres are left out of the mask.
+    """
+    annotation = atlas.annotation
+    indices = np.asarray(atlas_points).astype(np.int64, copy=False)
+    in_volume = np.all((indices >= 0) & (indices < annotation.shape), axis=1)
+    indices = indices[in_volume].T
+
+    structure_indices = np.full(len(in_volume), -1, dtype=np.int64)
+    structure_indices[in_volume] = structure_table.get_indices(
+        annotation[tuple(indices)].astype(np.int64)
+    )
+    hemisphere_values = np.zeros(len(in_volume), dtype=np.int64)
+    hemisphere_values[in_volume] = atlas.hemispheres[tuple(indices)]
+
+    valid = (structure_indices >= 0) & (
+        (hemisphere_values == LEFT_HEMISPHERE_VALUE)
+        | (hemisphere_values == RIGHT_HEMISPHERE_VALUE)
+    )
+    hemisphere_indices = (hemisphere_values == RIGHT_HEMISPHERE_VALUE).astype(
+        np.int64
+    )
+    return structure_indices, hemisphere_indices, valid
+
+
+def count_points_per_region(
+    structure_indices: np.ndarray,
+    hemisphere_indices: np.ndarray,
+    n_structures: int,
+) -> np.ndarray:
+    """Count the points in each structure and hemisphere.
+
+    Parameters
+    ----------
+    structure_indices : np.ndarray
+        the index of the structure of each point
+    hemisphere_indices : np.ndarray
+        the index of the hemisphere of each point in `HEMISPHERES`
+    n_structures : int
+        the number of structures
+
+    Returns
+    -------
+    np.ndarray
+        (n_structures, 2) array of the number of points in the left and
+        right hemisphere of each structure
+    """
+    n_hemispheres = len(HEMISPHERES)
+    counts = np.bincount(
+        structure_indices * n_hemispheres + hemisphere_indices,
+        minlength=n_structures * n_hemispheres,
+    )
+    return counts.reshape(n_structures, n_hemispheres)
+
+
+def roll_up_counts(
+    counts: np.ndarray, structure_table: StructureTable
+) -> np.ndarray:
+    """Add the counts of each structure to those of all its ancestors.
+
+    Parameters
+    ----------
+    counts : np.ndarray
+        (n_structures, ...) array of counts in each structure
+    structure_table : StructureTable
+        the structures of the atlas
+
+    Returns
+    -------
+    np.ndarray
+        the counts in each structure and all its substructures
+    """
+    in_atlas = structure_table.pair_ancestors >= 0
+    rolled_up = np.zeros_like(counts)
+    np.add.at(
+        rolled_up,
+        structure_table.pair_ancestors[in_atlas],
+        counts[structure_table.pair_structures[in_atlas]],
+    )
+    return rolled_up
+
+
+def create_all_points_df(
+    points_in_raw_data_space: np.ndarray,
+    points_in_atlas_space: np.ndarray,
+    structure_names: np.ndarray,
+    hemispheres: np.ndarray,
+) -> pd.DataFrame:
+    """Create the table of all the points, column by column, with the
+    columns of brainglobe_utils."""
+    columns = {}
+    for space, points in (
+        ("raw", points_in_raw_data_space),
+        ("atlas", points_in_atlas_space),
+    ):
+        for axis in range(3):
+            columns[f"coordinate_{space}_axis_{axis}"] = points[:, axis]
+    columns["structure_name"] = structure_names
+    columns["hemisphere"] = hemispheres
+    return pd.DataFrame(columns)
+
+
+def create_summary_df(
+    counts: np.ndarray,
+    structure_table: StructureTable,
+    brainreg_volume_csv_path: Pathlike,
+) -> pd.DataFrame:
+    """Create the summary of the points in each structure, with their
+    density, as brainglobe_utils does.
+
+    Only the structures and hemispheres with points are counted, and the
+    per-structure processing is left to brainglobe_utils, so the summary
+    matches.
+    """
+    from brainglobe_utils.brainmapper.analysis import (
+        calculate_densities,
+        combine_df_hemispheres,
+    )
+    from brainglobe_utils.pandas.misc import sanitise_df
+
+    structures, hemispheres = np.nonzero(counts)
+    point_numbers = pd.DataFrame(
+        {
+            "structure_name": structure_table.names[structures],
+            "hemisphere": np.array(HEMISPHERES, dtype=object)[hemispheres],
+            "cell_count": counts[structures, hemispheres],
+        }
+    ).sort_values(by=["cell_count"], ascending=False)
+
+    combined_hemispheres = combine_df_hemispheres(point_numbers)
+    df = calculate_densities(combined_hemispheres, brainreg_volume_csv_path)
+    return sanitise_df(df)
+
+
+def create_hierarchy_summary_df(
+    counts: np.ndarray, structure_table: StructureTable
+) -> pd.DataFrame:
+    """Create the summary of the points in each structure and all its
+    substructures, for the structures with points."""
+    rolled_up = roll_up_counts(counts, structure_table)
+    with_points = np.flatnonzero(rolled_up.sum(axis=1))
+    return pd.DataFrame(
+        {
+            "structure_id": structure_table.ids[with_points],
+            "acronym": structure_table.acronyms[with_points],
+            "structure_name": structure_table.names[with_points],
+            "parent_structure_id": structure_table.parent_ids[with_points],
+            "depth": structure_table.depths[with_points],
+            "left_cell_count": rolled_up[with_points, 0],
+            "right_cell_count": rolled_up[with_points, 1],
+            "total_cells": rolled_up[with_points].sum(axis=1),
+        }
+    )
+
+
+def summarise_points_by_atlas_region(
+    points_in_raw_data_space: np.ndarray,
+    points_in_atlas_space: np.ndarray,
+    atlas,
+    brainreg_volume_csv_path: Pathlike,
+    points_list_output_filename: Optional[Pathlike] = None,
+    summary_filename: Optional[Pathlike] = None,
+    hierarchy_summary_filename: Optional[Pathlike] = None,
+    structure_table: Optional[StructureTable] = None,
+) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """Summarise points by atlas region.
+
+    Parameters
+    ----------
+    points_in_raw_data_space : np.ndarray
+        (N, 3) array of the points in the raw data space
+    points_in_atlas_space : np.ndarray
+        (N, 3) array of the same points in the atlas space, in voxels of
+        the atlas
+    atlas : BrainGlobeAtlas
+        the atlas
+    brainreg_volume_csv_path : Pathlike
+        path to the CSV file of the volume of each structure, from brainreg
+    points_list_output_filename : Pathlike, optional
+        CSV file to save the structure and hemisphere of each point to
+    summary_filename : Pathlike, optional
+        CSV file to save the number and density of points in each structure
+        to
+    hierarchy_summary_filename : Pathlike, optional
+        CSV file to save the number of points in each structure and all its
+        substructures to
+    structure_table : StructureTable, optional
+        the structures of the atlas, by default read from the atlas
+
+    Returns
+    -------
+    Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]
+        the table of all the points in a structure, the summary and the
+        hierarchy summary
+    """
+    from brainglobe_utils.general.system import ensure_directory_exists
+
+    if structure_table is None:
+        structure_table = get_structure_table(atlas)
+    structure_indices, hemisphere_indices, valid = lookup_regions(
+        points_in_atlas_space, atlas, structure_table
+    )
+    structure_indices = structure_indices[valid]
+    hemisphere_indices = hemisphere_indices[valid]
+    counts = count_points_per_region(
+        structure_indices, hemisphere_indices, structure_table.n_structures
+    )
+
+    all_points_df = create_all_points_df(
+        np.asarray(points_in_raw_data_space)[valid],
+        np.asarray(points_in_atlas_space)[valid],
+        structure_table.names[structure_indices],
+        np.array(HEMISPHERES, dtype=object)[hemisphere_indices],
+    )
+    summary_df = create_summary_df(
+        counts, structure_table, brainreg_volume_csv_path
+    )
+    hierarchy_summary_df = create_hierarchy_summary_df(counts, structure_table)
+
+    for df, filename in (
+        (all_points_df, points_list_output_filename),
+        (summary_df, summary_filename),
+        (hierarchy_summary_df, hierarchy_summary_filename),
+    ):
+        if filename is not None:
+            ensure_directory_exists(Path(filename).parent)
+            df.to_csv(filename, index=False)
+
+    return all_points_df, summary_df, hierarchy_summary_df
@@ -0,0 +1,417 @@
+"""Generate synthetic registration outputs for the brainmapper workflow
+
+The analysis and figure generation steps of brainmapper run on the outputs
+of the registration (the deformation fields, the registered atlas and the
+region volumes) and of the cell classification (the cells XML file). This
+module writes a small synthetic version of these outputs, so that those
+steps can be run and benchmarked offline.
+
+The synthetic atlas is a BrainGlobe atlas in the local atlas directory: an
+ellipsoidal brain split into regions along the anterior-posterior axis.
+The registration is the identity, so the deformation fields map each voxel
+of the downsampled space to the same voxel of the atlas.
+
+To generate the outputs with 10000 cells:
+
+    python -m brainglobe_workflows.brainmapper.synthetic \
+        --output-dir /path/to/synthetic --n-cells 10000
+
+and then run the analysis with brainmapper:
+
+    brainmapper -s /path/to/synthetic/signal.tif \
+        -b /path/to/synthetic/background.tif \
+        -o /path/to/synthetic -v 50 50 50 --orientation asr \
+        --atlas synthetic_mouse_100um
+"""
+
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+import ngff_zarr as nz
+import numpy as np
+import pandas as pd
+import tifffile
+from brainglobe_atlasapi import BrainGlobeAtlas, config, descriptors
+from brainglobe_utils.cells.cells import Cell
+from brainglobe_utils.IO.cells import save_cells
+from brainreg.core.paths import Paths as BrainRegPaths
+
+from brainglobe_workflows.brainmapper.cell_arrays import (
+    cells_to_arrays,
+    save_cell_arrays,
+)
+from brainglobe_workflows.brainmapper.parser import brainmapper_parser
+from brainglobe_workflows.brainmapper.prep import Paths, log_metadata
+
+Pathlike = Union[str, os.PathLike]
+
+SYNTHETIC_ATLAS_NAME = "synthetic_mouse"
+SYNTHETIC_ATLAS_VERSION = "1.0"
+SYNTHETIC_ORIENTATION = "asr"
+SYNTHETIC_SIGNAL_FILENAME = "signal.tif"
+SYNTHETIC_BACKGROUND_FILENAME = "background.tif"
+
+# identifier of the root structure, as in the Allen mouse atlas
+ROOT_ID = 997
+
+
+def get_synthetic_atlas_name(resolution: int) -> str:
+    """Return the name of the synthetic atlas at a resolution in microns"""
+    return f"{SYNTHETIC_ATLAS_NAME}_{resolution}um"
+
+
+def _write_ome_zarr(array: np.ndarray, path: Path, resolution: int):
+    """Write a single-scale OME-Zarr image, as read by the atlas API."""
+    image = nz.to_ngff_image(
+        array,
+        dims=["z", "y", "x"],
+        scale={dim: resolution / 1000 for dim in "zyx"},
+    )
+    nz.to_ngff_zarr(str(path), nz.to_multiscales(image, scale_factors=[]))
+
+
+def generate_synthetic_atlas(
+    brainglobe_dir: Optional[Pathlike] = None,
+    shape: Tuple[int, int, int] = (132, 80, 114),
+    resolution: int = 100,
+    n_regions: int = 10,
+) -> str:
+    """Write a synthetic BrainGlobe atlas to the local atlas directory.
+
+    The brain is an ellipsoid filling most of the volume, split into
+    `n_regions` slabs of equal thickness along the anterior-posterior
+    axis. Each slab is a child of the root structure.
+
+    Parameters
+    ----------
+    brainglobe_dir : Optional[Pathlike], optional
+        BrainGlobe directory to write the atlas to, by default the one in
+        the BrainGlobe config (usually `~/.brainglobe`)
+    shape : Tuple[int, int, int], optional
+        shape of the atlas in the BrainGlobe orientation ("asr"), by default
+        that of the 100 um Allen mouse atlas
+    resolution : int, optional
+        isotropic resolution of the atlas in microns, by default 100
+    n_regions : int, optional
+        number of regions, by default 10
+
+    Returns
+    -------
+    str
+        name of the atlas, to instantiate it with `BrainGlobeAtlas`
+    """
+    if brainglobe_dir is None:
+        brainglobe_dir = config.get_brainglobe_dir()
+    atlas_root = Path(brainglobe_dir) / "brainglobe-atlasapi"
+    version_dir = SYNTHETIC_ATLAS_VERSION.replace(".", "_")
+    locations = {
+        component: (
+            f"/{root_dir}/{SYNTHETIC_ATLAS_NAME}-{component}/{version_dir}"
+        )
+        for component, root_dir in (
+            ("template", descriptors.V3_TEMPLATE_ROOTDIR),
+            ("annotation", descriptors.V3_ANNOTATION_ROOTDIR),
+            ("terminology", descriptors.V3_TERMINOLOGY_ROOTDIR),
+        )
+    }
+    for location in locations.values():
+        (atlas_root / location[1:]).mkdir(parents=True, exist_ok=True)
+
+    # an ellipsoidal brain, clear of the edges of the volume, split into
+    # slabs along the first axis
+    grid = np.ogrid[tuple(slice(0, n) for n in shape)]
+    radius_sq = sum(
+        ((coord + 0.5) / (0.95 * n / 2) - 1 / 0.95) ** 2
+        for coord, n in zip(grid, shape)
+    )
+    region_ids = np.arange(1, n_regions + 1)
+    slab_index = (grid[0] * n_regions) // shape[0]
+    annotation = np.where(radius_sq < 1, region_ids[slab_index], 0).astype(
+        descriptors.ANNOTATION_DTYPE
+    )
+    template = (annotation > 0) * (100 + 10 * annotation)
+
+    _write_ome_zarr(
+        template.astype(descriptors.REFERENCE_DTYPE),
+        atlas_root / locations["template"][1:] / descriptors.V3_TEMPLATE_NAME,
+        resolution,
+    )
+    _write_ome_zarr(
+        annotation,
+        atlas_root
+        / locations["annotation"][1:]
+        / descriptors.V3_ANNOTATION_NAME,
+        resolution,
+    )
+
+    terminology = pd.DataFrame(
+        {
+            "identifier": [ROOT_ID, *region_ids],
+            "parent_identifier": ["", *[ROOT_ID] * n_regions],
+            "annotation_value": [ROOT_ID, *region_ids],
+            "name": ["root", *[f"region {idx}" for idx in region_ids]],
+            "abbreviation": ["root", *[f"R{idx}" for idx in region_ids]],
+            "color_hex_triplet": ["#FFFFFF"] * (n_regions + 1),
+            "root_identifier_path": [
+                f"[{ROOT_ID}]",
+                *[f"[{ROOT_ID}, {idx}]" for idx in region_ids],
+            ],
+        }
+    )
+    terminology.to_csv(
+        atlas_root
+        / locations["terminology"][1:]
+        / descriptors.V3_TERMINOLOGY_NAME,
+        index=False,
+    )
+
+    atlas_name = get_synthetic_atlas_name(resolution)
+    manifest_dir = (
+        atlas_root / descriptors.V3_ATLAS_ROOTDIR / atlas_name / version_dir
+    )
+    manifest_dir.mkdir(parents=True, exist_ok=True)
+    manifest = {
+        "name": SYNTHETIC_ATLAS_NAME,
+        "citation": "unpublished",
+        "species": "Mouse (Mus musculus)",
+        "symmetric": True,
+        "resolution": [float(resolution)] * 3,
+        "orientation": descriptors.ATLAS_ORIENTATION,
+        "version": SYNTHETIC_ATLAS_VERSION,
+        "shape": list(shape),
+        "additional_references": [],
+        "terminology": {"location": locations["terminology"]},
+        "annotation_set": {
+            "location": locations["annotation"],
+            "template": {"location": locations["template"]},
+        },
+    }
+    with open(manifest_dir / "manifest.json", "w") as f:
+        json.dump(manifest, f, indent=4)
+    return atlas_name
+
+
+def get_boundaries(annotation: np.ndarray) -> np.ndarray:
+    """Return an image of the boundaries between the regions.
+
+    Parameters
+    ----------
+    annotation : np.ndarray
+        annotation image
+
+    Returns
+    -------
+    np.ndarray
+        uint8 image, 255 at the voxels whose next voxel along any axis is
+        in a different region, and 0 elsewhere
+    """
+    boundaries = np.zeros(annotation.shape, dtype=bool)
+    for axis in range(annotation.ndim):
+        before_last = [slice(None)] * annotation.ndim
+        before_last[axis] = slice(0, -1)
+        boundaries[tuple(before_last)] |= np.diff(annotation, axis=axis) != 0
+    return boundaries.astype(np.uint8) * 255
+
+
+def generate_synthetic_registration(
+    output_dir: Pathlike,
+    atlas: BrainGlobeAtlas,
+    n_cells: int = 1000,
+    voxel_sizes: Tuple[float, float, float] = (50, 50, 50),
+    seed: int = 0,
+) -> Path:
+    """Write synthetic registration and classification outputs.
+
+    The outputs are written to `output_dir` as brainmapper writes them:
+    the registration outputs to `registration`, and the cells to
+    `points/cell_classification.xml` and `points/cell_classification.arrays`
+    (and the same cells as candidates in `points/cells.xml` and
+    `points/cells.arrays`), and the brainmapper arguments to
+    `brainmapper.json`. The raw data is in the atlas orientation ("asr"),
+    and only its shape matters to the analysis: the signal and background
+    images are empty stacks of that shape.
+
+    Parameters
+    ----------
+    output_dir : Pathlike
+        brainmapper output directory
+    atlas : BrainGlobeAtlas
+        atlas the data is registered to
+    n_cells : int, optional
+        number of cells, placed at random inside the brain, by default 1000
+    voxel_sizes : Tuple[float, float, float], optional
+        voxel sizes of the raw data in microns, by default (50, 50, 50)
+    seed : int, optional
+        seed of the random number generator, by default 0
+
+    Returns
+    -------
+    Path
+        the output directory
+    """
+    output_dir = Path(output_dir)
+    paths = Paths(str(output_dir))
+    paths.make_channel_specific_paths()
+    brainreg_paths = BrainRegPaths(paths.registration_output_folder)
+    for directory in (
+        paths.registration_output_folder,
+        paths.points_directory,
+    ):
+        Path(directory).mkdir(parents=True, exist_ok=True)
+
+    # the downsampled data is in the atlas space, registered with the
+    # identity transform
+    annotation = atlas.annotation
+    tifffile.imwrite(brainreg_paths.registered_atlas, annotation)
+    tifffile.imwrite(brainreg_paths.registered_hemispheres, atlas.hemispheres)
+    tifffile.imwrite(
+        brainreg_paths.boundaries_file_path, get_boundaries(annotation)
+    )
+    # the deformation fields hold the atlas coordinates in mm
+    for axis, resolution in enumerate(atlas.resolution):
+        field = np.indices(annotation.shape, dtype=np.float32)[axis]
+        tifffile.imwrite(
+            getattr(brainreg_paths, f"deformation_field_{axis}"),
+            field * resolution / 1000,
+        )
+
+    voxel_volume = np.prod(atlas.resolution) / 1e9  # mm3
+    volumes = []
+    for structure_id in np.unique(annotation[annotation > 0]):
+        in_structure = annotation == structure_id
+        left = np.count_nonzero(
+            in_structure & (atlas.hemispheres == atlas.left_hemisphere_value)
+        )
+        right = np.count_nonzero(in_structure) - left
+        volumes.append(
+            {
+                "structure_name": atlas.structures[structure_id]["name"],
+                "left_volume_mm3": left * voxel_volume,
+                "right_volume_mm3": right * voxel_volume,
+                "total_volume_mm3": (left + right) * voxel_volume,
+            }
+        )
+    pd.DataFrame(volumes).to_csv(brainreg_paths.volume_csv_path, index=False)
+
+    # empty raw data stacks, of the shape of the atlas at the raw voxel size
+    scales = np.array(atlas.resolution) / np.array(voxel_sizes)
+    raw_shape = tuple(
+        int(round(n * scale)) for n, scale in zip(annotation.shape, scales)
+    )
+    for filename in (SYNTHETIC_SIGNAL_FILENAME, SYNTHETIC_BACKGROUND_FILENAME):
+        tifffile.imwrite(
+            output_dir / filename, shape=raw_shape, dtype=np.uint16
+        )
+
+    # cells at random positions inside the brain, in the raw data space.
+    # Each cell is in the half of a brain voxel that rounds to that voxel
+    # in the downsampled space.
+    rng = np.random.default_rng(seed)
+    brain_voxels = np.argwhere(annotation > 0)
+    positions = (
+        brain_voxels[rng.integers(len(brain_voxels), size=n_cells)]
+        + rng.uniform(0, 0.5, size=(n_cells, 3))
+    ) * scales
+    cells = [Cell([x, y, z], Cell.CELL) for z, y, x in positions]
+    save_cells(cells, paths.detected_points)
+    save_cells(cells, paths.classified_points)
+    cell_arrays = cells_to_arrays(cells)
+    save_cell_arrays(cell_arrays, paths.detected_points_arrays)
+    save_cell_arrays(cell_arrays, paths.classified_points_arrays)
+
+    # the arguments brainmapper would have been run with
+    args = brainmapper_parser().parse_args(
+        [
+            "-s",
+            str(output_dir / SYNTHETIC_SIGNAL_FILENAME),
+            "-b",
+            str(output_dir / SYNTHETIC_BACKGROUND_FILENAME),
+            "-o",
+            str(output_dir),
+            "-v",
+            *[str(v) for v in voxel_sizes],
+            "--orientation",
+            SYNTHETIC_ORIENTATION,
+            "--atlas",
+            atlas.atlas_name,
+        ]
+    )
+    args.paths = paths
+    log_metadata(paths.metadata_path, args)
+    return output_dir
+
+
+def synthetic_parser(argv: List[str]) -> argparse.Namespace:
+    """Define argument parser for the synthetic registration generator.
+
+    Parameters
+    ----------
+    argv : List[str]
+        list of command line input arguments
+
+    Returns
+    -------
+    args : argparse.Namespace
+        command line input arguments parsed
+    """
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic atlas, and synthetic registration "
+        "outputs to run the brainmapper analysis on."
+    )
+    parser.add_argument(
+        "--output-dir",
+        required=True,
+        type=str,
+        help="brainmapper output directory to write the outputs to.",
+    )
+    parser.add_argument(
+        "--n-cells",
+        default=1000,
+        type=int,
+        help="Number of cells.",
+    )
+    parser.add_argument(
+        "--brainglobe-dir",
+        default=None,
+        type=str,
+        help="BrainGlobe directory to write the atlas to. "
+        "Defaults to the one in the BrainGlobe config.",
+    )
+    parser.add_argument(
+        "--seed",
+        default=0,
+        type=int,
+        help="Seed of the random number generator.",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str]) -> Path:
+    """Generate synthetic registration outputs from the command line.
+
+    Parameters
+    ----------
+    argv : List[str]
+        list of command line input arguments
+
+    Returns
+    -------
+    Path
+        the output directory
+    """
+    args = synthetic_parser(argv)
+    atlas_name = generate_synthetic_atlas(args.brainglobe_dir)
+    atlas = BrainGlobeAtlas(
+        atlas_name, brainglobe_dir=args.brainglobe_dir, check_latest=False
+    )
+    return generate_synthetic_registration(
+        args.output_dir, atlas, n_cells=args.n_cells, seed=args.seed
+    )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,152 @@
+"""Transform cell positions to the atlas space, in chunks
+
+This is a vectorised version of
+`brainglobe_utils.brainreg.transform.transform_points_to_atlas_space`, for
+millions of points. The deformation fields are memory-mapped rather than
+read in full, and the displacements of each chunk of points are gathered
+with a single indexing operation per field, in the order of the field
+data. The downsampled and atlas points are appended to their output files
+chunk by chunk, so the memory used does not depend on the size of the
+fields, and only the (integer) atlas coordinates are kept for all the
+points.
+"""
+
+import logging
+import os
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import tifffile
+
+Pathlike = Union[str, os.PathLike]
+
+DEFAULT_CHUNK_SIZE = 1_000_000
+
+
+def read_deformation_field(path: Pathlike) -> np.ndarray:
+    """Memory-map a deformation field, or read it if its TIFF file cannot
+    be memory-mapped (e.g. if it is compressed).
+
+    Parameters
+    ----------
+    path : Pathlike
+        path to the deformation field TIFF file
+
+    Returns
+    -------
+    np.ndarray
+        the deformation field
+    """
+    try:
+        return tifffile.memmap(path, mode="r")
+    except ValueError:
+        logging.debug(f"Cannot memory-map {path}, reading it instead")
+        return tifffile.imread(path)
+
+
+def _append_points(path: Pathlike, points: np.ndarray, first: bool) -> None:
+    pd.DataFrame(points).to_hdf(
+        path,
+        key="df",
+        mode="w" if first else "a",
+        format="table",
+        append=not first,
+    )
+
+
+def transform_points_to_atlas_space(
+    points: np.ndarray,
+    source_image_path: Pathlike,
+    orientation: str,
+    voxel_sizes: List[float],
+    downsampled_space,
+    atlas,
+    deformation_field_paths: List[Pathlike],
+    downsampled_points_path: Optional[Pathlike] = None,
+    atlas_points_path: Optional[Pathlike] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Transform points from the raw data space to the atlas space.
+
+    The points are first downsampled to the atlas resolution, and then
+    transformed to the atlas space with the deformation fields from
+    brainreg. Points that fall outside the deformation fields once rounded
+    are left out of the atlas points.
+
+    Parameters
+    ----------
+    points : np.ndarray
+        (N, 3) array of points in the raw data space, in z, y, x order. It
+        may be memory-mapped.
+    source_image_path : Pathlike
+        path to the raw data, used to get its shape
+    orientation : str
+        orientation of the raw data, in the brainglobe-space three letter
+        convention (e.g. 'asr')
+    voxel_sizes : List[float]
+        voxel sizes of the raw data (e.g. [5, 2, 2])
+    downsampled_space : bgs.AnatomicalSpace
+        the brainreg "downsampled" space
+    atlas : BrainGlobeAtlas
+        the atlas registered to
+    deformation_field_paths : List[Pathlike]
+        paths to the deformation fields of each axis, from brainreg
+    downsampled_points_path : Pathlike, optional
+        HDF file to save the downsampled points to
+    atlas_points_path : Pathlike, optional
+        HDF file to save the atlas points to
+    chunk_size : int, optional
+        number of points transformed at a time, by default 1,000,000
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        the points in the atlas space, in voxels of the atlas, and a
+        boolean mask of the input points they correspond to (those inside
+        the deformation fields)
+    """
+    from brainglobe_utils.brainreg.transform import (
+        get_anatomical_space_from_image_path,
+    )
+
+    source_space = get_anatomical_space_from_image_path(
+        source_image_path, orientation, voxel_sizes
+    )
+    deformation_fields = [
+        read_deformation_field(path) for path in deformation_field_paths
+    ]
+    field_shape = np.array(deformation_fields[0].shape)
+    # the fields are in mm, and the atlas coordinates in voxels
+    field_scales = [int(1000 / resolution) for resolution in atlas.resolution]
+
+    atlas_points = []
+    in_bounds = np.zeros(len(points), dtype=bool)
+    for start in range(0, max(len(points), 1), chunk_size):
+        chunk = np.asarray(points[start : start + chunk_size])
+        downsampled = source_space.map_points_to(downsampled_space, chunk)
+        if downsampled_points_path is not None:
+            _append_points(downsampled_points_path, downsampled, start == 0)
+
+        indices = np.rint(downsampled).astype(np.int64)
+        chunk_in_bounds = np.all((indices >= 0) & (indices < field_shape), 1)
+        in_bounds[start : start + len(chunk)] = chunk_in_bounds
+        # gather the displacements in the order of the field data, so each
+        # page of a memory-mapped field is read once
+        flat_indices = np.ravel_multi_index(
+            indices[chunk_in_bounds].T, tuple(field_shape)
+        )
+        order = np.argsort(flat_indices, kind="stable")
+        chunk_atlas_points = np.empty((len(flat_indices), 3), dtype=np.int32)
+        for axis, field in enumerate(deformation_fields):
+            displacements = np.empty(len(flat_indices), dtype=field.dtype)
+            displacements[order] = field.reshape(-1)[flat_indices[order]]
+            chunk_atlas_points[:, axis] = np.rint(
+                field_scales[axis] * displacements
+            )
+
+        if atlas_points_path is not None:
+            _append_points(atlas_points_path, chunk_atlas_points, start == 0)
+        atlas_points.append(chunk_atlas_points)
+
+    return np.concatenate(atlas_points), in_bounds
@@ -0,0 +1,371 @@
+"""Run the cellfinder workflow on a batch of samples
+
+It receives as a command line input the path to a batch manifest, a json
+file that defines the samples to process.
+
+    python -m brainglobe_workflows.cellfinder.batch --config manifest.json
+
+The manifest either lists one cellfinder config file per sample:
+
+    {"configs": ["path/to/config_1.json", "path/to/config_2.json"]}
+
+or one cellfinder config shared by all samples, plus the input data
+directory of each sample:
+
+    {
+        "config": "path/to/config.json",
+        "input_data_dirs": ["path/to/brain_1", "path/to/brain_2"]
+    }
+
+Optionally, the manifest can also define:
+- "output_parent_dir": the directory under which the output of every sample
+  and the batch summary are saved;
+- "n_cpus_per_sample": the number of CPU cores assigned to each sample;
+- "n_processes": the maximum number of samples processed concurrently.
+
+The samples are run in a pool of worker processes. Each worker process is
+reused across samples, so the interpreter, torch and cellfinder start-up
+cost is paid once per worker rather than once per sample.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing as mp
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import List, Optional
+
+import pandas as pd
+from brainglobe_utils.cells.cells import Cell
+from brainglobe_utils.general.system import get_cores_available
+
+from brainglobe_workflows.cellfinder.cellfinder import (
+    CellfinderConfig,
+    Pathlike,
+    run_workflow_from_cellfinder_run,
+)
+from brainglobe_workflows.utils import __name__ as LOGGER_NAME
+from brainglobe_workflows.utils import setup_logger
+
+DEFAULT_N_CPUS_PER_SAMPLE = 8
+BATCH_SUMMARY_BASENAME = "batch_summary_"
+
+
+def read_batch_manifest(manifest_path: Pathlike) -> dict:
+    """Read a batch manifest and expand it into one config per sample.
+
+    Parameters
+    ----------
+    manifest_path : Pathlike
+        path to the batch manifest json file
+
+    Returns
+    -------
+    dict
+        the manifest as a dictionary, with a "samples" key holding a
+        dictionary of cellfinder config dictionaries, indexed by sample name
+
+    Raises
+    ------
+    ValueError
+        if the manifest defines neither "configs" nor "config" and
+        "input_data_dirs"
+    """
+    with open(manifest_path) as mf:
+        manifest = json.load(mf)
+
+    samples = {}
+    if "configs" in manifest:
+        for config_path in manifest["configs"]:
+            with open(config_path) as cfg:
+                config_dict = json.load(cfg)
+            sample_name = _unique_sample_name(Path(config_path).stem, samples)
+            samples[sample_name] = config_dict
+
+    elif "config" in manifest and "input_data_dirs" in manifest:
+        with open(manifest["config"]) as cfg:
+            base_config_dict = json.load(cfg)
+        for input_data_dir in manifest["input_data_dirs"]:
+            config_dict = base_config_dict.copy()
+            config_dict["input_data_dir"] = str(input_data_dir)
+            sample_name = _unique_sample_name(
+                Path(input_data_dir).name, samples
+            )
+            samples[sample_name] = config_dict
+
+    else:
+        raise ValueError(
+            f"The batch manifest {manifest_path} must define either "
+            "'configs', or 'config' and 'input_data_dirs'"
+        )
+
+    # point the output of every sample to its own directory
+    for sample_name, config_dict in samples.items():
+        if "output_parent_dir" in manifest:
+            config_dict["output_parent_dir"] = manifest["output_parent_dir"]
+        config_dict["output_dir_basename"] = (
+            config_dict.get("output_dir_basename", "cellfinder_output_")
+            + f"{sample_name}_"
+        )
+
+    manifest["samples"] = samples
+    return manifest
+
+
+def _unique_sample_name(sample_name: str, samples: dict) -> str:
+    """Append a numeric suffix to the sample name if it is already in use."""
+    unique_name = sample_name
+    suffix = 1
+    while unique_name in samples:
+        unique_name = f"{sample_name}_{suffix}"
+        suffix += 1
+    return unique_name
+
+
+def compute_batch_resources(
+    n_samples: int,
+    n_free_cpus: int,
+    n_cpus_per_sample: int = DEFAULT_N_CPUS_PER_SAMPLE,
+    n_processes: Optional[int] = None,
+) -> tuple[int, int]:
+    """Size the process pool and the CPU share of each sample.
+
+    The cores available to the batch are all cores minus `n_free_cpus`.
+    These are split between the samples running concurrently, so that
+    the samples do not compete with each other for CPU time.
+
+    Parameters
+    ----------
+    n_samples : int
+        number of samples in the batch
+    n_free_cpus : int
+        number of CPU cores to leave free for the whole batch
+    n_cpus_per_sample : int, optional
+        number of CPU cores to assign to each sample,
+        by default DEFAULT_N_CPUS_PER_SAMPLE
+    n_processes : Optional[int], optional
+        maximum number of samples to run concurrently. If None, it is
+        computed from the available cores and `n_cpus_per_sample`.
+
+    Returns
+    -------
+    tuple[int, int]
+        the number of worker processes in the pool, and the value of
+        `n_free_cpus` to pass to cellfinder for each sample
+    """
+    n_cpu_cores = get_cores_available()
+    n_available_cpus = max(n_cpu_cores - n_free_cpus, 1)
+
+    if n_processes is None:
+        n_processes = n_available_cpus // max(n_cpus_per_sample, 1)
+    n_processes = max(min(n_processes, n_samples, n_available_cpus), 1)
+
+    # leave free all the cores not assigned to this sample
+    n_cpus_per_worker = n_available_cpus // n_processes
+    n_free_cpus_per_sample = n_cpu_cores - n_cpus_per_worker
+
+    return n_processes, n_free_cpus_per_sample
+
+
+def run_sample(sample_name: str, config_dict: dict) -> dict:
+    """Run the cellfinder workflow on one sample of the batch.
+
+    Any exception raised by the workflow is logged and recorded in the
+    returned summary, so that a failing sample does not stop the batch.
+
+    Parameters
+    ----------
+    sample_name : str
+        name of the sample
+    config_dict : dict
+        cellfinder config for the sample, as a dictionary
+
+    Returns
+    -------
+    dict
+        summary of the run for this sample
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.info(f"Processing sample {sample_name}")
+
+    summary = {
+        "sample": sample_name,
+        "input_data_dir": config_dict.get("input_data_dir"),
+        "output_path": None,
+        "wall_time_s": None,
+        "n_candidates": None,
+        "n_cells": None,
+        "error": None,
+    }
+
+    start_time = time.perf_counter()
+    try:
+        cfg = CellfinderConfig(**config_dict)
+        summary["output_path"] = str(cfg._output_path)
+
+        detected_cells = run_workflow_from_cellfinder_run(cfg)
+        summary["n_candidates"] = len(detected_cells)
+        summary["n_cells"] = sum(
+            cell.type == Cell.CELL for cell in detected_cells
+        )
+    except Exception as e:
+        logger.exception(f"Sample {sample_name} failed")
+        summary["error"] = repr(e)
+    summary["wall_time_s"] = time.perf_counter() - start_time
+
+    logger.info(
+        f"Finished sample {sample_name} in {summary['wall_time_s']:.1f} s"
+    )
+    return summary
+
+
+def run_batch(manifest: dict) -> pd.DataFrame:
+    """Run the cellfinder workflow on all samples of a batch manifest.
+
+    Parameters
+    ----------
+    manifest : dict
+        a batch manifest, as returned by `read_batch_manifest`
+
+    Returns
+    -------
+    pd.DataFrame
+        the batch summary, with one row per sample
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    samples = manifest["samples"]
+
+    # the cores to leave free are defined for the whole batch
+    n_free_cpus = min(
+        config_dict["n_free_cpus"] for config_dict in samples.values()
+    )
+    n_processes, n_free_cpus_per_sample = compute_batch_resources(
+        len(samples),
+        n_free_cpus,
+        n_cpus_per_sample=manifest.get(
+            "n_cpus_per_sample", DEFAULT_N_CPUS_PER_SAMPLE
+        ),
+        n_processes=manifest.get("n_processes"),
+    )
+    logger.info(
+        f"Running {len(samples)} samples in {n_processes} processes, "
+        f"leaving {n_free_cpus_per_sample} CPU cores free per sample"
+    )
+
+    summaries = []
+    # use "spawn" so that workers do not inherit torch state from the parent
+    with ProcessPoolExecutor(
+        max_workers=n_processes,
+        mp_context=mp.get_context("spawn"),
+        initializer=setup_logger,
+    ) as executor:
+        futures = [
+            executor.submit(
+                run_sample,
+                sample_name,
+                {**config_dict, "n_free_cpus": n_free_cpus_per_sample},
+            )
+            for sample_name, config_dict in samples.items()
+        ]
+        for future in as_completed(futures):
+            summaries.append(future.result())
+
+    # keep the order of the manifest in the summary
+    summary_df = pd.DataFrame(summaries).set_index("sample")
+    return summary_df.loc[list(samples.keys())].reset_index()
+
+
+def save_batch_summary(
+    summary_df: pd.DataFrame, output_parent_dir: Pathlike
+) -> Path:
+    """Save the batch summary as a timestamped csv file.
+
+    Parameters
+    ----------
+    summary_df : pd.DataFrame
+        the batch summary, as returned by `run_batch`
+    output_parent_dir : Pathlike
+        directory to save the batch summary to
+
+    Returns
+    -------
+    Path
+        path to the saved batch summary
+    """
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    summary_path = Path(output_parent_dir) / (
+        BATCH_SUMMARY_BASENAME + timestamp + ".csv"
+    )
+    summary_path.parent.mkdir(parents=True, exist_ok=True)
+    summary_df.to_csv(summary_path, index=False)
+    return summary_path
+
+
+def batch_parser(argv: List[str]) -> argparse.Namespace:
+    """Define argument parser for the batch cellfinder workflow.
+
+    Parameters
+    ----------
+    argv : List[str]
+        list of command line input arguments
+
+    Returns
+    -------
+    args : argparse.Namespace
+        command line input arguments parsed
+    """
+    parser = argparse.ArgumentParser(
+        description="Run the cellfinder workflow on the batch of samples "
+        "defined in a batch manifest."
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        required=True,
+        type=str,
+        metavar="MANIFEST",
+        help="Path to the batch manifest json file.",
+    )
+    return parser.parse_args(argv)
+
+
+def main(manifest_path: str) -> pd.DataFrame:
+    """Setup and run the cellfinder workflow on a batch of samples.
+
+    Parameters
+    ----------
+    manifest_path : str
+        path to the batch manifest json file
+
+    Returns
+    -------
+    pd.DataFrame
+        the batch summary, with one row per sample
+    """
+    logger = setup_logger()
+
+    manifest = read_batch_manifest(manifest_path)
+    summary_df = run_batch(manifest)
+
+    summary_path = save_batch_summary(
+        summary_df,
+        manifest.get(
+            "output_parent_dir",
+            CellfinderConfig.__dataclass_fields__["_install_path"].default,
+        ),
+    )
+    logger.info(f"Batch summary saved to {summary_path}")
+
+    return summary_df
+
+
+if __name__ == "__main__":
+    # parse CLI arguments
+    args = batch_parser(sys.argv[1:])
+
+    # run batch
+    _ = main(args.config)
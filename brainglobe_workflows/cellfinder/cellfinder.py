@@ -14,21 +14,35 @@ is used.
 """
 
 import datetime
+import hashlib
 import json
 import logging
 import os
 import sys
 from dataclasses import dataclass
+from importlib.metadata import version
 from pathlib import Path
 from typing import Optional, Union
 
-import pooch
-from brainglobe_utils.IO.cells import save_cells
-from brainglobe_utils.IO.image.load import read_with_dask
+import dask.array as da
+from brainglobe_utils.cells.cells import MissingCellsError
+from brainglobe_utils.IO.cells import get_cells, save_cells
 from cellfinder.core.main import main as cellfinder_run
 from cellfinder.core.train.train_yaml import depth_type
 
+from brainglobe_workflows.fetch import fetch_and_extract_archive
+from brainglobe_workflows.image_io import (
+    convert_to_tiff_stack,
+    fingerprint_files,
+    list_files,
+    list_tiff_files,
+    list_zarr_store_files,
+    read_tiff_with_dask,
+    read_zarr_with_dask,
+)
+from brainglobe_workflows.metrics import RunMetrics
 from brainglobe_workflows.utils import (
+    CONVERTED_DIRNAME,
     DEFAULT_JSON_CONFIG_PATH_CELLFINDER,
     config_parser,
     setup_logger,
@@ -37,6 +51,28 @@ from brainglobe_workflows.utils import __name__ as LOGGER_NAME
 
 Pathlike = Union[str, os.PathLike]
 
+DETECTION_CACHE_DIRNAME = "detection_cache"
+
+# parameters of the config that determine the detected cell candidates
+DETECTION_PARAMETERS = (
+    "voxel_sizes",
+    "start_plane",
+    "end_plane",
+    "soma_diameter",
+    "ball_xy_size",
+    "ball_z_size",
+    "ball_overlap_fraction",
+    "log_sigma_size",
+    "n_sds_above_mean_thresh",
+    "n_sds_above_mean_tiled_thresh",
+    "tiled_thresh_tile_size",
+    "soma_spread_factor",
+    "max_cluster_size",
+    "input_data_format",
+    "zarr_array_path",
+    "zarr_resolution_level",
+)
+
 
 @dataclass
 class CellfinderConfig:
@@ -93,6 +129,35 @@ class CellfinderConfig:
     signal_subdir: Pathlike = "signal"
     background_subdir: Pathlike = "background"
 
+    # input data format
+    # "tiff": the signal and background subdirs are directories of
+    # 2D TIFF planes;
+    # "zarr": the signal and background subdirs are zarr or OME-Zarr
+    # stores. The array is read from `zarr_array_path` within the store
+    # if specified, otherwise from the `zarr_resolution_level` of the
+    # OME-Zarr multiscales (the voxel sizes should match that level).
+    input_data_format: str = "tiff"
+    zarr_array_path: Optional[str] = None
+    zarr_resolution_level: int = 0
+
+    # if True, "tiff" input data is converted once into a single 3D TIFF
+    # stack per channel, cached under `output_parent_dir`/converted and
+    # reused while the input files are unchanged
+    convert_input: bool = False
+
+    # if True, the detected cell candidates are cached under
+    # `output_parent_dir`/detection_cache, keyed by the input data and the
+    # detection parameters. A later run with the same key skips detection
+    # and only runs classification.
+    cache_detection: bool = False
+
+    # detection parameter combinations evaluated by the threshold sweep
+    # (see brainglobe_workflows/cellfinder/sweep.py). Each combination is
+    # a dictionary with any of "n_sds_above_mean_thresh",
+    # "n_sds_above_mean_tiled_thresh" and "max_cluster_size"; parameters
+    # not in a combination take their value from the config.
+    threshold_sweep: Optional[list] = None
+
     # output data paths
     # Note: if output_parent_dir is not specified,
     # it is assumed to be under _install_path
@@ -115,6 +180,7 @@ class CellfinderConfig:
     _list_background_files: Optional[list] = None
     _detected_cells_path: Pathlike = ""
     _output_path: Pathlike = ""
+    _prepared: bool = False
 
     def __post_init__(self: "CellfinderConfig"):
         """Executed after __init__ function.
@@ -123,7 +189,10 @@ class CellfinderConfig:
         as a function of other attributes.
         See https://peps.python.org/pep-0557/#post-init-processing
 
-        The attributes added are input and output data paths
+        The attributes added are input and output data paths. These are
+        only computed here, without accessing the file system, so that
+        configs are cheap to create. The input data is listed (or fetched)
+        and the output directory is created in `prepare`.
 
         Parameters
         ----------
@@ -137,12 +206,39 @@ class CellfinderConfig:
         # Add output paths to config
         self.add_output_paths()
 
+    def prepare(self):
+        """Fetch the input data and create the output directory.
+
+        This is run once per config; later calls have no effect.
+
+        Parameters
+        ----------
+        self : CellfinderConfig
+            a CellfinderConfig instance
+        """
+        if self._prepared:
+            return
+
+        # Add lists of input data files to config,
+        # fetching the data if required
+        self.fetch_input_data()
+
+        # Create the timestamped output directory
+        Path(self._output_path).mkdir(
+            parents=True,  # create any missing parents
+            exist_ok=True,  # ignore FileExistsError exceptions
+        )
+
+        self._prepared = True
+
     def add_output_paths(self):
         """Adds output paths to the config
 
         Specifically, it adds:
         - output_parent_dir: set to a a timestamped output directory if not
           set in __init__();
+        - _output_path: path to the timestamped output directory, which is
+          created in `prepare`;
         - _detected_cells_path: path to the output file
 
         Parameters
@@ -161,10 +257,6 @@ class CellfinderConfig:
         self._output_path = Path(self.output_parent_dir) / (
             str(self.output_dir_basename) + timestamp_formatted
         )
-        self._output_path.mkdir(
-            parents=True,  # create any missing parents
-            exist_ok=True,  # ignore FileExistsError exceptions
-        )
 
         # Add to config the path to the output file
         self._detected_cells_path = (
@@ -179,6 +271,28 @@ class CellfinderConfig:
         - _signal_dir_path: full path to the directory with the signal files
         - _background_dir_path: full path to the directory with the
           background files.
+
+        Parameters
+        ----------
+        config : CellfinderConfig
+            a cellfinder config
+        """
+        # Fill in input data directory if not specified
+        if self.input_data_dir is None:
+            self.input_data_dir = (
+                Path(self._install_path) / "cellfinder_test_data"
+            )
+
+        # Fill in signal and background paths derived from 'input_data_dir'
+        self._signal_dir_path = self.input_data_dir / Path(self.signal_subdir)
+        self._background_dir_path = self.input_data_dir / Path(
+            self.background_subdir
+        )
+
+    def fetch_input_data(self):
+        """Adds the lists of input data files to the config.
+
+        Specifically, it adds:
         - _list_signal_files: list of signal files
         - _list_background_files: list of background files
 
@@ -205,18 +319,6 @@ class CellfinderConfig:
         # Fetch logger
         logger = logging.getLogger(LOGGER_NAME)
 
-        # Fill in input data directory if not specified
-        if self.input_data_dir is None:
-            self.input_data_dir = (
-                Path(self._install_path) / "cellfinder_test_data"
-            )
-
-        # Fill in signal and background paths derived from 'input_data_dir'
-        self._signal_dir_path = self.input_data_dir / Path(self.signal_subdir)
-        self._background_dir_path = self.input_data_dir / Path(
-            self.background_subdir
-        )
-
         # Check if input data directories (signal and background) exist
         # locally.
         # If both directories exist, get list of signal and background files
@@ -226,16 +328,8 @@ class CellfinderConfig:
         ):
             logger.info("Fetching input data from the local directories")
 
-            self._list_signal_files = [
-                f
-                for f in Path(self._signal_dir_path).resolve().iterdir()
-                if f.is_file()
-            ]
-            self._list_background_files = [
-                f
-                for f in Path(self._background_dir_path).resolve().iterdir()
-                if f.is_file()
-            ]
+            self._list_signal_files = list_files(self._signal_dir_path)
+            self._list_background_files = list_files(self._background_dir_path)
 
         # If exactly one of the input data directories is missing, print error
         elif (
@@ -257,19 +351,16 @@ class CellfinderConfig:
         else:
             # Check if GIN URL and hash are defined (log error otherwise)
             if self.data_url and self.data_hash:
-                # get list of files in GIN archive with pooch.retrieve
-                list_files_archive = pooch.retrieve(
+                # download and extract the GIN archive, and get the list
+                # of extracted files
+                list_files_archive = fetch_and_extract_archive(
                     url=self.data_url,
                     known_hash=self.data_hash,
-                    path=Path(
-                        self.input_data_dir
-                    ).parent,  # zip will be downloaded here
-                    progressbar=True,
-                    processor=pooch.Unzip(
-                        extract_dir=Path(self.input_data_dir).stem,
-                        # files are unpacked here, a dir
-                        # *relative* to the path set in 'path'
-                    ),
+                    # zip will be downloaded here
+                    archive_dir=Path(self.input_data_dir).parent,
+                    # files are unpacked here
+                    extract_dir=Path(self.input_data_dir).parent
+                    / Path(self.input_data_dir).stem,
                 )
                 logger.info(
                     "Fetching input data from the provided GIN repository"
@@ -347,35 +438,84 @@ def setup(input_config_path: str) -> CellfinderConfig:
     # read config
     cfg = read_cellfinder_config(input_config_path)
 
+    # fetch input data and create output directory
+    cfg.prepare()
+
     return cfg
 
 
-def run_workflow_from_cellfinder_run(cfg: CellfinderConfig):
-    """Run workflow based on the cellfinder.core.main.main()
-    function.
+def read_input_data(cfg: CellfinderConfig) -> tuple[da.Array, da.Array]:
+    """Read the input signal and background data as Dask arrays.
 
-    The steps are:
-    1. Read the input signal and background data as two separate
-       Dask arrays.
-    2. Run the main cellfinder pipeline on the input Dask arrays,
-       with the parameters defined in the input configuration (cfg).
-    3. Save the detected cells as an xml file to the location specified in
-       the input configuration (cfg).
+    The data is read lazily, either from directories of 2D TIFF planes
+    or from zarr stores, depending on the input data format in the config.
+    If `convert_input` is set, TIFF planes are first converted into cached
+    3D TIFF stacks (see `convert_to_tiff_stack`).
 
     Parameters
     ----------
     cfg : CellfinderConfig
         a class with the required setup methods and parameters for
         the cellfinder workflow
+
+    Returns
+    -------
+    tuple[da.Array, da.Array]
+        the signal and background arrays
+
+    Raises
+    ------
+    ValueError
+        if the input data format is not supported
     """
-    # Read input data as Dask arrays
-    signal_array = read_with_dask(str(cfg._signal_dir_path))
-    background_array = read_with_dask(str(cfg._background_dir_path))
+    cfg.prepare()
 
-    # Run main analysis using `cellfinder_run`
-    detected_cells = cellfinder_run(
-        signal_array=signal_array,
-        background_array=background_array,
+    if cfg.input_data_format == "tiff" and cfg.convert_input:
+        cache_dir = Path(cfg.output_parent_dir) / CONVERTED_DIRNAME
+        signal_array = read_tiff_with_dask(
+            str(convert_to_tiff_stack(cfg._signal_dir_path, cache_dir))
+        )
+        background_array = read_tiff_with_dask(
+            str(convert_to_tiff_stack(cfg._background_dir_path, cache_dir))
+        )
+    elif cfg.input_data_format == "tiff":
+        signal_array = read_tiff_with_dask(cfg._signal_dir_path)
+        background_array = read_tiff_with_dask(cfg._background_dir_path)
+    elif cfg.input_data_format == "zarr":
+        signal_array = read_zarr_with_dask(
+            cfg._signal_dir_path,
+            cfg.zarr_array_path,
+            cfg.zarr_resolution_level,
+        )
+        background_array = read_zarr_with_dask(
+            cfg._background_dir_path,
+            cfg.zarr_array_path,
+            cfg.zarr_resolution_level,
+        )
+    else:
+        raise ValueError(
+            f"Input data format {cfg.input_data_format} not supported. "
+            "Please use 'tiff' or 'zarr'."
+        )
+    return signal_array, background_array
+
+
+def get_cellfinder_run_kwargs(cfg: CellfinderConfig) -> dict:
+    """Collect the `cellfinder_run` parameters defined in the config.
+
+    Parameters
+    ----------
+    cfg : CellfinderConfig
+        a class with the required setup methods and parameters for
+        the cellfinder workflow
+
+    Returns
+    -------
+    dict
+        keyword arguments to pass to `cellfinder_run`, excluding the
+        input data arrays
+    """
+    return dict(
         voxel_sizes=cfg.voxel_sizes,
         start_plane=cfg.start_plane,
         end_plane=cfg.end_plane,
@@ -404,13 +544,212 @@ def run_workflow_from_cellfinder_run(cfg: CellfinderConfig):
         pin_memory=cfg.pin_memory,
     )
 
-    # Save results to xml file
-    save_cells(
-        detected_cells,
-        cfg._detected_cells_path,
+
+def get_input_fingerprint(cfg: CellfinderConfig) -> str:
+    """Compute a fingerprint of the signal and background input files.
+
+    Parameters
+    ----------
+    cfg : CellfinderConfig
+        a class with the required setup methods and parameters for
+        the cellfinder workflow
+
+    Returns
+    -------
+    str
+        the fingerprint, as a hexadecimal string
+    """
+    input_files = []
+    for data_path in [cfg._signal_dir_path, cfg._background_dir_path]:
+        if cfg.input_data_format == "zarr":
+            input_files += list_zarr_store_files(data_path)
+        else:
+            input_files += list_tiff_files(data_path)
+    return fingerprint_files(input_files)
+
+
+def get_detection_cache_key(cfg: CellfinderConfig) -> str:
+    """Compute the key of the detected cell candidates in the cache.
+
+    The key is a hash of the fingerprint of the input files, the
+    detection parameters in the config and the cellfinder version.
+
+    Parameters
+    ----------
+    cfg : CellfinderConfig
+        a class with the required setup methods and parameters for
+        the cellfinder workflow
+
+    Returns
+    -------
+    str
+        the cache key, as a hexadecimal string
+    """
+    key = {
+        "input_data": get_input_fingerprint(cfg),
+        "cellfinder_version": version("cellfinder"),
+        **{param: getattr(cfg, param) for param in DETECTION_PARAMETERS},
+    }
+    return hashlib.sha256(
+        json.dumps(key, sort_keys=True, default=str).encode()
+    ).hexdigest()[:16]
+
+
+def detect_cell_candidates(
+    cfg: CellfinderConfig,
+    signal_array: da.Array,
+    background_array: da.Array,
+) -> list:
+    """Run the detection step of the cellfinder pipeline.
+
+    If `cache_detection` is set in the config, the cell candidates are
+    read from the cache if they were detected in a previous run with the
+    same cache key, and saved to the cache otherwise.
+
+    Parameters
+    ----------
+    cfg : CellfinderConfig
+        a class with the required setup methods and parameters for
+        the cellfinder workflow
+    signal_array : da.Array
+        the signal data
+    background_array : da.Array
+        the background data
+
+    Returns
+    -------
+    list
+        the cell candidates
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+
+    if cfg.cache_detection:
+        cache_path = (
+            Path(cfg.output_parent_dir)
+            / DETECTION_CACHE_DIRNAME
+            / f"candidates_{get_detection_cache_key(cfg)}.xml"
+        )
+        if cache_path.exists():
+            logger.info(f"Reusing cell candidates from {cache_path}")
+            try:
+                return get_cells(str(cache_path))
+            except MissingCellsError:
+                return []
+
+    candidates = cellfinder_run(
+        signal_array=signal_array,
+        background_array=background_array,
+        **get_cellfinder_run_kwargs(cfg),
+        skip_classification=True,
+    )
+
+    if cfg.cache_detection:
+        # write to a temporary file first, so that an interrupted run
+        # does not leave an incomplete entry in the cache
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        partial_path = cache_path.with_suffix(".partial.xml")
+        save_cells(candidates, partial_path)
+        os.replace(partial_path, cache_path)
+        logger.info(f"Cell candidates cached at {cache_path}")
+
+    return candidates
+
+
+def classify_cell_candidates(
+    cfg: CellfinderConfig,
+    signal_array: da.Array,
+    background_array: da.Array,
+    candidates: list,
+) -> list:
+    """Run the classification step of the cellfinder pipeline.
+
+    Parameters
+    ----------
+    cfg : CellfinderConfig
+        a class with the required setup methods and parameters for
+        the cellfinder workflow
+    signal_array : da.Array
+        the signal data
+    background_array : da.Array
+        the background data
+    candidates : list
+        the cell candidates to classify
+
+    Returns
+    -------
+    list
+        the classified cells
+    """
+    return cellfinder_run(
+        signal_array=signal_array,
+        background_array=background_array,
+        **get_cellfinder_run_kwargs(cfg),
+        skip_detection=True,
+        detected_cells=candidates,
+        # `cellfinder_run` calls this even if detection is skipped
+        detect_finished_callback=lambda points: None,
     )
 
 
+def run_workflow_from_cellfinder_run(cfg: CellfinderConfig) -> list:
+    """Run workflow based on the cellfinder.core.main.main()
+    function.
+
+    The steps are:
+    1. Read the input signal and background data as two separate
+       Dask arrays, from TIFF directories or zarr stores.
+    2. Detect cell candidates in the input Dask arrays, with the
+       parameters defined in the input configuration (cfg). If enabled in
+       the configuration, the candidates are read from or saved to a cache.
+    3. Classify the cell candidates, with the parameters defined in the
+       input configuration (cfg).
+    4. Save the detected cells as an xml file to the location specified in
+       the input configuration (cfg).
+
+    The wall time, CPU time, peak memory and I/O of each step are saved to
+    `run_metrics.json` in the output directory. Note that the input data is
+    read lazily, so most of the reading time is included in the detection
+    and classification steps.
+
+    Parameters
+    ----------
+    cfg : CellfinderConfig
+        a class with the required setup methods and parameters for
+        the cellfinder workflow
+
+    Returns
+    -------
+    list
+        the cells detected and classified by cellfinder
+    """
+    metrics = RunMetrics()
+
+    # Read input data as Dask arrays
+    with metrics.stage("read"):
+        signal_array, background_array = read_input_data(cfg)
+
+    # Run main analysis using `cellfinder_run`, in two steps
+    with metrics.stage("detect"):
+        candidates = detect_cell_candidates(
+            cfg, signal_array, background_array
+        )
+    with metrics.stage("classify"):
+        detected_cells = classify_cell_candidates(
+            cfg, signal_array, background_array, candidates
+        )
+
+    # Save results to xml file
+    with metrics.stage("save"):
+        save_cells(
+            detected_cells,
+            cfg._detected_cells_path,
+        )
+
+    metrics.save(cfg._output_path)
+
+    return detected_cells
+
+
 def main(
     input_config: str = str(DEFAULT_JSON_CONFIG_PATH_CELLFINDER),
 ) -> CellfinderConfig:
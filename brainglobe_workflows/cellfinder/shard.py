@@ -0,0 +1,534 @@
+"""Run the cellfinder workflow on one volume split into z-slabs
+
+The volume is split into shards of consecutive planes. Each shard is
+processed by `cellfinder_run` on an overlapping slab of planes: the planes
+owned by the shard (its core) plus a halo of neighbouring planes on each
+side. The halo gives the 3D filter and the cell detection enough context
+at the shard boundaries. The results are then merged, keeping only the
+cells in each shard's core and removing cells detected twice across a
+shard boundary.
+
+To run all shards locally in a pool of worker processes:
+
+    python -m brainglobe_workflows.cellfinder.shard --config config.json \
+        --n-shards 8
+
+To run each shard on a different node, run every shard index with a shared
+shard directory, and then merge the results:
+
+    python -m brainglobe_workflows.cellfinder.shard --config config.json \
+        --n-shards 8 --shard-index 0 --shard-dir /shared/shards
+    ...
+    python -m brainglobe_workflows.cellfinder.shard --config config.json \
+        --n-shards 8 --merge --shard-dir /shared/shards
+"""
+
+import argparse
+import logging
+import math
+import multiprocessing as mp
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, NamedTuple, Optional
+
+import numpy as np
+from brainglobe_utils.cells.cells import Cell, MissingCellsError
+from brainglobe_utils.IO.cells import get_cells, save_cells
+from cellfinder.core.main import main as cellfinder_run
+from scipy.spatial import cKDTree
+
+from brainglobe_workflows.cellfinder.batch import compute_batch_resources
+from brainglobe_workflows.cellfinder.cellfinder import (
+    CellfinderConfig,
+    Pathlike,
+    get_cellfinder_run_kwargs,
+    read_cellfinder_config,
+    read_input_data,
+)
+from brainglobe_workflows.utils import (
+    DEFAULT_JSON_CONFIG_PATH_CELLFINDER,
+    setup_logger,
+)
+from brainglobe_workflows.utils import __name__ as LOGGER_NAME
+
+SHARD_FILENAME_TEMPLATE = "shard_{index:04d}.xml"
+# the fewest CPU cores a shard runs on: one for the cellfinder main process
+# and at least one for its detection workers
+MIN_N_CPUS_PER_SHARD = 2
+
+
+class Shard(NamedTuple):
+    """A range of planes processed by one worker.
+
+    The shard owns the planes in [core_start, core_end), and is processed
+    on the slab of planes [start_plane, end_plane), which includes the halo.
+    """
+
+    core_start: int
+    core_end: int
+    start_plane: int
+    end_plane: int
+
+
+def compute_halo(cfg: CellfinderConfig) -> int:
+    """Compute the number of halo planes on each side of a shard.
+
+    The halo covers the axial extent of the 3D ball filter, so that the
+    filter output in the shard's core does not depend on the slab edges,
+    plus one soma diameter, so that cells crossing a shard boundary are
+    fully contained in both slabs.
+
+    Parameters
+    ----------
+    cfg : CellfinderConfig
+        a cellfinder config
+
+    Returns
+    -------
+    int
+        number of halo planes
+    """
+    z_voxel_size = float(cfg.voxel_sizes[0])
+    ball_z_planes = math.ceil(cfg.ball_z_size / z_voxel_size)
+    soma_z_planes = math.ceil(cfg.soma_diameter / z_voxel_size)
+    return ball_z_planes + soma_z_planes
+
+
+def compute_shards(
+    start_plane: int, end_plane: int, n_shards: int, halo: int
+) -> List[Shard]:
+    """Split a range of planes into overlapping shards.
+
+    Parameters
+    ----------
+    start_plane : int
+        first plane to process (inclusive)
+    end_plane : int
+        last plane to process (exclusive)
+    n_shards : int
+        number of shards. It is reduced if there are fewer planes
+        than shards.
+    halo : int
+        number of halo planes on each side of a shard
+
+    Returns
+    -------
+    List[Shard]
+        the shards, in increasing z order
+    """
+    n_planes = end_plane - start_plane
+    n_shards = max(min(n_shards, n_planes), 1)
+    boundaries = np.linspace(start_plane, end_plane, n_shards + 1).astype(int)
+
+    return [
+        Shard(
+            core_start=int(core_start),
+            core_end=int(core_end),
+            start_plane=int(max(core_start - halo, start_plane)),
+            end_plane=int(min(core_end + halo, end_plane)),
+        )
+        for core_start, core_end in zip(boundaries[:-1], boundaries[1:])
+    ]
+
+
+def get_shards(cfg: CellfinderConfig, n_shards: int) -> List[Shard]:
+    """Compute the shards for the planes range defined in the config.
+
+    Parameters
+    ----------
+    cfg : CellfinderConfig
+        a cellfinder config
+    n_shards : int
+        number of shards
+
+    Returns
+    -------
+    List[Shard]
+        the shards, in increasing z order
+    """
+    signal_array, _ = read_input_data(cfg)
+    n_planes = signal_array.shape[0]
+    end_plane = n_planes if cfg.end_plane < 0 else cfg.end_plane
+    end_plane = min(end_plane, n_planes)
+    return compute_shards(
+        cfg.start_plane, end_plane, n_shards, compute_halo(cfg)
+    )
+
+
+def run_shard(
+    cfg: CellfinderConfig, shard: Shard, n_free_cpus: Optional[int] = None
+) -> List[Cell]:
+    """Run `cellfinder_run` on the slab of one shard.
+
+    Parameters
+    ----------
+    cfg : CellfinderConfig
+        a cellfinder config
+    shard : Shard
+        the shard to process
+    n_free_cpus : Optional[int], optional
+        number of CPU cores to leave free. If None, the value in the
+        config is used.
+
+    Returns
+    -------
+    List[Cell]
+        the cells whose centre is in the shard's core
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.info(
+        f"Processing planes {shard.core_start}-{shard.core_end} "
+        f"(slab {shard.start_plane}-{shard.end_plane})"
+    )
+
+    signal_array, background_array = read_input_data(cfg)
+
+    cellfinder_run_kwargs = get_cellfinder_run_kwargs(cfg)
+    cellfinder_run_kwargs["start_plane"] = shard.start_plane
+    cellfinder_run_kwargs["end_plane"] = shard.end_plane
+    if n_free_cpus is not None:
+        cellfinder_run_kwargs["n_free_cpus"] = n_free_cpus
+
+    cells = cellfinder_run(
+        signal_array=signal_array,
+        background_array=background_array,
+        **cellfinder_run_kwargs,
+    )
+
+    # keep only the cells owned by this shard
+    return [
+        cell for cell in cells if shard.core_start <= cell.z < shard.core_end
+    ]
+
+
+def merge_shard_cells(
+    shard_cells: List[List[Cell]],
+    shards: List[Shard],
+    voxel_sizes: tuple[float, float, float],
+    soma_diameter: float,
+) -> List[Cell]:
+    """Merge the cells detected in each shard.
+
+    Each shard only holds the cells in its core, but a cell crossing a
+    shard boundary may have its centre estimated on different sides of the
+    boundary by the two shards. Near each boundary, the cells of the upper
+    shard that are closer than a soma radius to a cell of the lower shard
+    are therefore removed as duplicates.
+
+    Parameters
+    ----------
+    shard_cells : List[List[Cell]]
+        the cells in the core of each shard
+    shards : List[Shard]
+        the shards, in increasing z order
+    voxel_sizes : tuple[float, float, float]
+        voxel sizes in microns, in z, y, x order
+    soma_diameter : float
+        the expected soma diameter in microns
+
+    Returns
+    -------
+    List[Cell]
+        the merged cells
+    """
+    voxel_sizes_zyx = np.asarray(voxel_sizes, dtype=float)
+    soma_radius = soma_diameter / 2
+    tolerance_planes = soma_diameter / voxel_sizes_zyx[0]
+
+    def positions_um(cells: List[Cell]) -> np.ndarray:
+        zyx = np.array([[c.z, c.y, c.x] for c in cells], dtype=float)
+        return zyx.reshape(-1, 3) * voxel_sizes_zyx
+
+    merged = list(shard_cells[0]) if shard_cells else []
+    for lower_cells, upper_cells, upper_shard in zip(
+        shard_cells[:-1], shard_cells[1:], shards[1:]
+    ):
+        boundary = upper_shard.core_start
+        lower_near = [
+            c for c in lower_cells if c.z >= boundary - tolerance_planes
+        ]
+        if not lower_near:
+            merged.extend(upper_cells)
+            continue
+
+        tree = cKDTree(positions_um(lower_near))
+        for cell in upper_cells:
+            if cell.z < boundary + tolerance_planes:
+                distance, _ = tree.query(positions_um([cell])[0])
+                if distance < soma_radius:
+                    continue
+            merged.append(cell)
+
+    return merged
+
+
+def compute_shard_resources(
+    n_shards: int, n_free_cpus: int, n_processes: Optional[int] = None
+) -> tuple[int, int]:
+    """Size the process pool and the CPU share of each shard.
+
+    The cores available after leaving `n_free_cpus` free are split across
+    the shards, so that as many shards as possible run concurrently, each
+    on at least `MIN_N_CPUS_PER_SHARD` cores.
+
+    Parameters
+    ----------
+    n_shards : int
+        number of shards
+    n_free_cpus : int
+        number of CPU cores to leave free for the whole workflow
+    n_processes : Optional[int], optional
+        maximum number of shards to run concurrently. If None, it is
+        computed from the available cores and `MIN_N_CPUS_PER_SHARD`.
+
+    Returns
+    -------
+    tuple[int, int]
+        the number of worker processes in the pool, and the value of
+        `n_free_cpus` to pass to cellfinder for each shard
+    """
+    return compute_batch_resources(
+        n_shards,
+        n_free_cpus,
+        n_cpus_per_sample=MIN_N_CPUS_PER_SHARD,
+        n_processes=n_processes,
+    )
+
+
+def _run_shard_worker(
+    cfg: CellfinderConfig, shard: Shard, n_free_cpus: int
+) -> List[Cell]:
+    """Run one shard in a worker process."""
+    return run_shard(cfg, shard, n_free_cpus=n_free_cpus)
+
+
+def run_sharded_workflow(
+    cfg: CellfinderConfig,
+    n_shards: int,
+    n_processes: Optional[int] = None,
+) -> List[Cell]:
+    """Run all shards in a pool of worker processes and merge the results.
+
+    Parameters
+    ----------
+    cfg : CellfinderConfig
+        a cellfinder config
+    n_shards : int
+        number of shards
+    n_processes : Optional[int], optional
+        maximum number of shards to run concurrently. If None, the cores
+        available after leaving `n_free_cpus` free are split across the
+        shards (see `compute_shard_resources`).
+
+    Returns
+    -------
+    List[Cell]
+        the merged cells, also saved to the detected cells file in the config
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    shards = get_shards(cfg, n_shards)
+
+    n_processes, n_free_cpus_per_shard = compute_shard_resources(
+        len(shards), cfg.n_free_cpus, n_processes=n_processes
+    )
+    logger.info(f"Running {len(shards)} shards in {n_processes} processes")
+
+    # use "spawn" so that workers do not inherit torch state from the parent
+    with ProcessPoolExecutor(
+        max_workers=n_processes,
+        mp_context=mp.get_context("spawn"),
+        initializer=setup_logger,
+    ) as executor:
+        shard_cells = list(
+            executor.map(
+                _run_shard_worker,
+                [cfg] * len(shards),
+                shards,
+                [n_free_cpus_per_shard] * len(shards),
+            )
+        )
+
+    cells = merge_shard_cells(
+        shard_cells, shards, cfg.voxel_sizes, cfg.soma_diameter
+    )
+    save_cells(cells, cfg._detected_cells_path)
+    return cells
+
+
+def run_single_shard(
+    cfg: CellfinderConfig, n_shards: int, shard_index: int, shard_dir: Path
+) -> Path:
+    """Run one shard and save its cells to the shard directory.
+
+    Parameters
+    ----------
+    cfg : CellfinderConfig
+        a cellfinder config
+    n_shards : int
+        number of shards
+    shard_index : int
+        index of the shard to run
+    shard_dir : Path
+        directory shared by all shards, where the shard results are saved
+
+    Returns
+    -------
+    Path
+        path to the saved shard cells
+    """
+    shard = get_shards(cfg, n_shards)[shard_index]
+    cells = run_shard(cfg, shard)
+
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    shard_path = shard_dir / SHARD_FILENAME_TEMPLATE.format(index=shard_index)
+    save_cells(cells, shard_path)
+    return shard_path
+
+
+def _read_shard_cells(shard_path: Path) -> List[Cell]:
+    """Read the cells of one shard, which may have none."""
+    try:
+        return get_cells(str(shard_path))
+    except MissingCellsError:
+        return []
+
+
+def merge_shard_files(
+    cfg: CellfinderConfig, n_shards: int, shard_dir: Pathlike
+) -> List[Cell]:
+    """Merge the shard results saved in the shard directory.
+
+    Parameters
+    ----------
+    cfg : CellfinderConfig
+        a cellfinder config
+    n_shards : int
+        number of shards
+    shard_dir : Pathlike
+        directory where the shard results were saved
+
+    Returns
+    -------
+    List[Cell]
+        the merged cells, also saved to the detected cells file in the config
+
+    Raises
+    ------
+    FileNotFoundError
+        if the results of any shard are missing
+    """
+    shards = get_shards(cfg, n_shards)
+    shard_paths = [
+        Path(shard_dir) / SHARD_FILENAME_TEMPLATE.format(index=idx)
+        for idx in range(len(shards))
+    ]
+    missing = [str(p) for p in shard_paths if not p.exists()]
+    if missing:
+        raise FileNotFoundError(f"Missing shard results: {missing}")
+
+    shard_cells = [_read_shard_cells(p) for p in shard_paths]
+    cells = merge_shard_cells(
+        shard_cells, shards, cfg.voxel_sizes, cfg.soma_diameter
+    )
+    save_cells(cells, cfg._detected_cells_path)
+    return cells
+
+
+def shard_parser(argv: List[str]) -> argparse.Namespace:
+    """Define argument parser for the sharded cellfinder workflow.
+
+    Parameters
+    ----------
+    argv : List[str]
+        list of command line input arguments
+
+    Returns
+    -------
+    args : argparse.Namespace
+        command line input arguments parsed
+    """
+    parser = argparse.ArgumentParser(
+        description="Run the cellfinder workflow on one volume split into "
+        "overlapping z-slabs."
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        default=str(DEFAULT_JSON_CONFIG_PATH_CELLFINDER),
+        type=str,
+        metavar="CONFIG",
+        help="Path to the cellfinder config json file.",
+    )
+    parser.add_argument(
+        "--n-shards",
+        required=True,
+        type=int,
+        help="Number of shards to split the volume into.",
+    )
+    parser.add_argument(
+        "--n-processes",
+        default=None,
+        type=int,
+        help="Maximum number of shards to run concurrently.",
+    )
+    parser.add_argument(
+        "--shard-index",
+        default=None,
+        type=int,
+        help="Run only this shard, and save its results to the shard "
+        "directory.",
+    )
+    parser.add_argument(
+        "--merge",
+        action="store_true",
+        help="Merge the shard results saved in the shard directory.",
+    )
+    parser.add_argument(
+        "--shard-dir",
+        default=None,
+        type=str,
+        help="Directory shared by all shards to save their results. "
+        "Required with --shard-index and --merge.",
+    )
+    args = parser.parse_args(argv)
+
+    if (args.shard_index is not None or args.merge) and not args.shard_dir:
+        parser.error("--shard-dir is required with --shard-index and --merge")
+
+    return args
+
+
+def main(argv: List[str]) -> CellfinderConfig:
+    """Setup and run the sharded cellfinder workflow.
+
+    Parameters
+    ----------
+    argv : List[str]
+        list of command line input arguments
+
+    Returns
+    -------
+    cfg : CellfinderConfig
+        a class with the required setup methods and parameters for
+        the cellfinder workflow
+    """
+    args = shard_parser(argv)
+    _ = setup_logger()
+    cfg = read_cellfinder_config(args.config, log_on=True)
+    cfg.prepare()
+
+    if args.shard_index is not None:
+        run_single_shard(
+            cfg, args.n_shards, args.shard_index, Path(args.shard_dir)
+        )
+    elif args.merge:
+        merge_shard_files(cfg, args.n_shards, args.shard_dir)
+    else:
+        run_sharded_workflow(cfg, args.n_shards, args.n_processes)
+
+    return cfg
+
+
+if __name__ == "__main__":
+    _ = main(sys.argv[1:])
@@ -0,0 +1,603 @@
+"""Evaluate several detection thresholds on one volume in one pass
+
+Choosing the detection thresholds for a brain usually takes several runs
+of the cellfinder workflow that only differ in `n_sds_above_mean_thresh`,
+`n_sds_above_mean_tiled_thresh` or `max_cluster_size`. Each run repeats
+the 2D filtering of every plane, although it does not depend on these
+parameters.
+
+The threshold sweep runs the 2D filtering (clipping, in/out of brain tile
+mask and Laplacian of Gaussian peak enhancement) once, and caches the
+filtered planes as memory-mapped arrays under
+`output_parent_dir`/sweep_cache, keyed by the input data and the filter
+parameters. Each threshold combination then only thresholds the cached
+planes and runs the 3D ball filter and the cell detection. Combinations
+that only differ in `max_cluster_size` also share the 3D filtering, and
+only repeat the splitting of cell clusters.
+
+The combinations are listed in the config under "threshold_sweep", e.g.
+
+    "threshold_sweep": [
+        {"n_sds_above_mean_thresh": 8},
+        {"n_sds_above_mean_thresh": 10},
+        {"n_sds_above_mean_thresh": 10, "max_cluster_size": 50000}
+    ]
+
+and the sweep is run with:
+
+    python -m brainglobe_workflows.cellfinder.sweep --config config.json
+
+The cell candidates of each combination are saved to a separate file in
+the output directory, and the number of cell candidates and artifacts of
+each combination are saved to a count table (threshold_sweep.csv).
+
+The sweep reuses internals of the cellfinder detection, which are not part
+of its public API and may change between releases, so it is only tested
+with the cellfinder versions in `TESTED_CELLFINDER_VERSIONS`.
+"""
+
+import argparse
+import csv
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+from importlib.metadata import version
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Tuple
+
+import dask.array as da
+import numpy as np
+import torch
+from brainglobe_utils.cells.cells import Cell
+from brainglobe_utils.IO.cells import save_cells
+from packaging.specifiers import SpecifierSet
+from packaging.version import Version
+
+from brainglobe_workflows.cellfinder.cellfinder import (
+    CellfinderConfig,
+    get_input_fingerprint,
+    read_cellfinder_config,
+    read_input_data,
+)
+from brainglobe_workflows.utils import (
+    DEFAULT_JSON_CONFIG_PATH_CELLFINDER,
+    setup_logger,
+)
+from brainglobe_workflows.utils import __name__ as LOGGER_NAME
+
+# the cellfinder versions whose detection internals the sweep is tested
+# with. Only the sweep is restricted to these, so other versions only log a
+# warning when it is imported
+TESTED_CELLFINDER_VERSIONS = ">=1.10.1,<1.11"
+
+try:
+    from cellfinder.core.detect.filters.plane import TileProcessor
+    from cellfinder.core.detect.filters.plane.plane_filter import (
+        _threshold_planes,
+    )
+    from cellfinder.core.detect.filters.setup_filters import (
+        DetectionSettings,
+    )
+    from cellfinder.core.detect.filters.volume.volume_filter import (
+        VolumeFilter,
+    )
+    from cellfinder.core.tools.tools import inference_wrapper
+except ImportError as error:
+    raise ImportError(
+        "The threshold sweep uses internals of the cellfinder detection that "
+        f"are not in the installed cellfinder {version('cellfinder')}: "
+        f"{error}. Install a tested version with "
+        f"`pip install 'cellfinder{TESTED_CELLFINDER_VERSIONS}'`."
+    ) from error
+
+if Version(version("cellfinder")) not in SpecifierSet(
+    TESTED_CELLFINDER_VERSIONS
+):
+    logging.getLogger(LOGGER_NAME).warning(
+        f"The threshold sweep is not tested with cellfinder "
+        f"{version('cellfinder')}, and may fail or give different results. "
+        f"Tested versions: cellfinder{TESTED_CELLFINDER_VERSIONS}."
+    )
+
+SWEEP_CACHE_DIRNAME = "sweep_cache"
+SWEEP_CELLS_FILENAME_TEMPLATE = "detected_cells_sweep_{index:03d}.xml"
+SWEEP_TABLE_FILENAME = "threshold_sweep.csv"
+
+# parameters of the config that can be swept
+SWEEP_PARAMETERS = (
+    "n_sds_above_mean_thresh",
+    "n_sds_above_mean_tiled_thresh",
+    "max_cluster_size",
+)
+
+# parameters of the config that determine the 2D filtered planes
+FILTER_PARAMETERS = (
+    "voxel_sizes",
+    "start_plane",
+    "end_plane",
+    "soma_diameter",
+    "log_sigma_size",
+    "input_data_format",
+    "zarr_array_path",
+    "zarr_resolution_level",
+)
+
+# 3D filter parameters for splitting cell clusters. These are cellfinder's
+# defaults, which the workflow does not override.
+SPLITTING_PARAMETERS = {
+    "ball_xy_size_um": 6,
+    "ball_z_size_um": 15,
+    "ball_overlap_fraction": 0.8,
+}
+
+
+class FilteredPlanes(NamedTuple):
+    """The 2D filtered planes of a volume, before thresholding.
+
+    `enhanced_planes` are the planes after the Laplacian of Gaussian peak
+    enhancement, and `inside_brain_tiles` the mask of the tiles of each
+    plane that are inside the brain.
+    """
+
+    enhanced_planes: np.ndarray
+    inside_brain_tiles: np.ndarray
+
+
+def get_sweep_combinations(cfg: CellfinderConfig) -> List[dict]:
+    """Get the parameter combinations of the threshold sweep.
+
+    Parameters
+    ----------
+    cfg : CellfinderConfig
+        a cellfinder config
+
+    Returns
+    -------
+    List[dict]
+        the combinations, with a value for every swept parameter
+
+    Raises
+    ------
+    ValueError
+        if the config has no combinations, or a combination has a
+        parameter that cannot be swept
+    """
+    if not cfg.threshold_sweep:
+        raise ValueError(
+            "The config does not define any combinations in "
+            "'threshold_sweep'"
+        )
+
+    combinations = []
+    for combination in cfg.threshold_sweep:
+        unknown = set(combination) - set(SWEEP_PARAMETERS)
+        if unknown:
+            raise ValueError(
+                f"Parameters {sorted(unknown)} cannot be swept. "
+                f"Please use any of {list(SWEEP_PARAMETERS)}."
+            )
+        combinations.append(
+            {
+                param: combination.get(param, getattr(cfg, param))
+                for param in SWEEP_PARAMETERS
+            }
+        )
+    return combinations
+
+
+def get_detection_settings(
+    cfg: CellfinderConfig, signal_array: da.Array, **overrides
+) -> Tuple[DetectionSettings, DetectionSettings]:
+    """Build the cellfinder detection settings for the config.
+
+    This mirrors the settings built by cellfinder's detection, always
+    running on the CPU.
+
+    Parameters
+    ----------
+    cfg : CellfinderConfig
+        a cellfinder config
+    signal_array : da.Array
+        the signal data
+    **overrides
+        values of the swept parameters that replace those in the config
+
+    Returns
+    -------
+    Tuple[DetectionSettings, DetectionSettings]
+        the detection settings, and the settings for splitting clusters
+    """
+    params = {
+        param: overrides.get(param, getattr(cfg, param))
+        for param in SWEEP_PARAMETERS
+    }
+    n_planes = len(signal_array)
+    end_plane = n_planes if cfg.end_plane < 0 else min(cfg.end_plane, n_planes)
+
+    settings = DetectionSettings(
+        plane_shape=signal_array.shape[1:],
+        plane_original_np_dtype=signal_array.dtype,
+        voxel_sizes=list(map(float, cfg.voxel_sizes)),
+        soma_spread_factor=cfg.soma_spread_factor,
+        soma_diameter_um=cfg.soma_diameter,
+        max_cluster_size_um3=params["max_cluster_size"],
+        ball_xy_size_um=cfg.ball_xy_size,
+        ball_z_size_um=cfg.ball_z_size,
+        start_plane=cfg.start_plane,
+        end_plane=end_plane,
+        n_free_cpus=cfg.n_free_cpus,
+        ball_overlap_fraction=cfg.ball_overlap_fraction,
+        log_sigma_size=cfg.log_sigma_size,
+        n_sds_above_mean_thresh=params["n_sds_above_mean_thresh"],
+        n_sds_above_mean_tiled_thresh=params["n_sds_above_mean_tiled_thresh"],
+        tiled_thresh_tile_size=cfg.tiled_thresh_tile_size,
+        batch_size=max(cfg.detection_batch_size or 4, 1),
+        torch_device="cpu",
+    )
+
+    # the splitting settings are copied before accessing any cached
+    # property of the detection settings, as cellfinder does
+    kwargs = dataclasses.asdict(settings)
+    kwargs.update(SPLITTING_PARAMETERS)
+    kwargs["plane_original_np_dtype"] = np.float32
+    splitting_settings = DetectionSettings(**kwargs)
+
+    return settings, splitting_settings
+
+
+def get_filter_cache_key(cfg: CellfinderConfig) -> str:
+    """Compute the key of the 2D filtered planes in the cache.
+
+    The key is a hash of the fingerprint of the input files, the
+    filter parameters in the config and the cellfinder version.
+
+    Parameters
+    ----------
+    cfg : CellfinderConfig
+        a cellfinder config
+
+    Returns
+    -------
+    str
+        the cache key, as a hexadecimal string
+    """
+    key = {
+        "input_data": get_input_fingerprint(cfg),
+        "cellfinder_version": version("cellfinder"),
+        **{param: getattr(cfg, param) for param in FILTER_PARAMETERS},
+    }
+    return hashlib.sha256(
+        json.dumps(key, sort_keys=True, default=str).encode()
+    ).hexdigest()[:16]
+
+
+@inference_wrapper
+def _filter_planes(
+    signal_array: da.Array,
+    settings: DetectionSettings,
+    cache_dir: Path,
+) -> None:
+    """Run the 2D filtering and save the filtered planes to `cache_dir`.
+
+    Parameters
+    ----------
+    signal_array : da.Array
+        the signal data
+    settings : DetectionSettings
+        the detection settings
+    cache_dir : Path
+        directory to save the filtered planes to
+    """
+    tile_processor = TileProcessor(
+        plane_shape=settings.plane_shape,
+        clipping_value=settings.clipping_value,
+        threshold_value=settings.threshold_value,
+        n_sds_above_mean_thresh=settings.n_sds_above_mean_thresh,
+        n_sds_above_mean_tiled_thresh=settings.n_sds_above_mean_tiled_thresh,
+        tiled_thresh_tile_size=settings.tiled_thresh_tile_size,
+        log_sigma_size=settings.log_sigma_size,
+        soma_diameter=settings.soma_diameter,
+        torch_device="cpu",
+        dtype=settings.filtering_dtype.__name__,
+        use_scipy=True,
+    )
+    tile_walker = tile_processor.tile_walker
+
+    cache_dir.mkdir(parents=True)
+    enhanced_planes = np.lib.format.open_memmap(
+        cache_dir / "enhanced_planes.npy",
+        mode="w+",
+        dtype=settings.filtering_dtype,
+        shape=(settings.n_planes, *settings.plane_shape),
+    )
+    inside_brain_tiles = np.lib.format.open_memmap(
+        cache_dir / "inside_brain_tiles.npy",
+        mode="w+",
+        dtype=bool,
+        shape=(
+            settings.n_planes,
+            tile_walker.n_tiles_height,
+            tile_walker.n_tiles_width,
+        ),
+    )
+
+    start_plane = settings.start_plane
+    for z in range(start_plane, settings.end_plane, settings.batch_size):
+        batch = np.asarray(signal_array[z : z + settings.batch_size])
+        planes = torch.from_numpy(settings.filter_data_converter_func(batch))
+        torch.clip_(planes, 0, settings.clipping_value)
+
+        i = z - start_plane
+        inside_brain_tiles[i : i + len(planes)] = tile_walker.get_bright_tiles(
+            planes
+        ).numpy()
+        enhanced_planes[i : i + len(planes)] = (
+            tile_processor.peak_enhancer.enhance_peaks(planes).numpy()
+        )
+
+    enhanced_planes.flush()
+    inside_brain_tiles.flush()
+
+
+def compute_filtered_planes(
+    cfg: CellfinderConfig, signal_array: da.Array
+) -> FilteredPlanes:
+    """Compute the 2D filtered planes of the signal data, using the cache.
+
+    The filtered planes are saved as memory-mapped arrays under
+    `output_parent_dir`/sweep_cache, and reused while the input data and
+    the filter parameters are unchanged.
+
+    Parameters
+    ----------
+    cfg : CellfinderConfig
+        a cellfinder config
+    signal_array : da.Array
+        the signal data
+
+    Returns
+    -------
+    FilteredPlanes
+        the filtered planes, memory-mapped from the cache
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    cache_dir = (
+        Path(cfg.output_parent_dir)
+        / SWEEP_CACHE_DIRNAME
+        / get_filter_cache_key(cfg)
+    )
+
+    if cache_dir.exists():
+        logger.info(f"Reusing filtered planes from {cache_dir}")
+    else:
+        settings, _ = get_detection_settings(cfg, signal_array)
+        logger.info(
+            f"Filtering {settings.n_planes} planes, " f"cached at {cache_dir}"
+        )
+
+        # write to a temporary directory first, so that an interrupted run
+        # does not leave incomplete planes in the cache
+        partial_dir = cache_dir.with_name(cache_dir.name + ".partial")
+        shutil.rmtree(partial_dir, ignore_errors=True)
+
+        orig_n_threads = torch.get_num_threads()
+        torch.set_num_threads(settings.n_torch_comp_threads)
+        try:
+            _filter_planes(signal_array, settings, partial_dir)
+        finally:
+            torch.set_num_threads(orig_n_threads)
+        os.replace(partial_dir, cache_dir)
+
+    return FilteredPlanes(
+        enhanced_planes=np.load(
+            cache_dir / "enhanced_planes.npy", mmap_mode="r"
+        ),
+        inside_brain_tiles=np.load(
+            cache_dir / "inside_brain_tiles.npy", mmap_mode="r"
+        ),
+    )
+
+
+@inference_wrapper
+def detect_structures(
+    filtered_planes: FilteredPlanes, settings: DetectionSettings
+) -> VolumeFilter:
+    """Threshold the filtered planes, and run the 3D filter and detection.
+
+    Parameters
+    ----------
+    filtered_planes : FilteredPlanes
+        the 2D filtered planes
+    settings : DetectionSettings
+        the detection settings, with the thresholds to apply
+
+    Returns
+    -------
+    VolumeFilter
+        the volume filter holding the detected structures. The cells are
+        obtained from its `get_results` method.
+    """
+    volume_filter = VolumeFilter(settings=settings)
+    ball_filter = volume_filter.ball_filter
+    cell_detector = volume_filter.cell_detector
+    detection_converter = settings.detection_data_converter_func
+
+    tile_size = settings.tiled_thresh_tile_size
+    local_threshold_tile_size_px = (
+        int(round(settings.soma_diameter * tile_size)) if tile_size else 0
+    )
+
+    previous_plane = None
+    for i in range(0, settings.n_planes, settings.batch_size):
+        enhanced = torch.from_numpy(
+            np.array(
+                filtered_planes.enhanced_planes[i : i + settings.batch_size]
+            )
+        )
+        planes = torch.empty_like(enhanced)
+        _threshold_planes(
+            planes,
+            enhanced,
+            settings.n_sds_above_mean_thresh,
+            settings.n_sds_above_mean_tiled_thresh,
+            local_threshold_tile_size_px,
+            settings.threshold_value,
+            "cpu",
+        )
+        masks = torch.from_numpy(
+            np.array(
+                filtered_planes.inside_brain_tiles[i : i + settings.batch_size]
+            )
+        )
+
+        ball_filter.append(planes, masks)
+        if ball_filter.ready:
+            ball_filter.walk()
+            middle_planes = ball_filter.get_processed_planes()
+            for detection_plane in detection_converter(middle_planes):
+                previous_plane = cell_detector.process(
+                    detection_plane, previous_plane
+                )
+
+    return volume_filter
+
+
+def run_threshold_sweep(cfg: CellfinderConfig) -> List[dict]:
+    """Evaluate every combination of the threshold sweep.
+
+    The 2D filtered planes are computed once (or read from the cache), and
+    thresholded for each combination. Combinations that only differ in
+    `max_cluster_size` share the 3D filtering and cell detection.
+
+    Parameters
+    ----------
+    cfg : CellfinderConfig
+        a cellfinder config, with the combinations in `threshold_sweep`
+
+    Returns
+    -------
+    List[dict]
+        the rows of the count table, one per combination, with the
+        parameters, the number of cell candidates and artifacts, and the
+        path to the cells file
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    combinations = get_sweep_combinations(cfg)
+
+    signal_array, _ = read_input_data(cfg)
+    filtered_planes = compute_filtered_planes(cfg, signal_array)
+
+    # group the combinations that share the thresholds
+    groups: Dict[tuple, List[int]] = {}
+    for index, combination in enumerate(combinations):
+        thresholds = (
+            combination["n_sds_above_mean_thresh"],
+            combination["n_sds_above_mean_tiled_thresh"],
+        )
+        groups.setdefault(thresholds, []).append(index)
+
+    rows = []
+    for indices in groups.values():
+        volume_filter = None
+        for index in indices:
+            settings, splitting_settings = get_detection_settings(
+                cfg, signal_array, **combinations[index]
+            )
+            if volume_filter is None:
+                logger.info(f"Detecting structures for {combinations[index]}")
+                orig_n_threads = torch.get_num_threads()
+                torch.set_num_threads(settings.n_torch_comp_threads)
+                try:
+                    volume_filter = detect_structures(
+                        filtered_planes, settings
+                    )
+                finally:
+                    torch.set_num_threads(orig_n_threads)
+
+            cells = volume_filter.get_results(splitting_settings)
+            cells_path = Path(cfg._output_path) / (
+                SWEEP_CELLS_FILENAME_TEMPLATE.format(index=index)
+            )
+            save_cells(cells, str(cells_path))
+
+            rows.append(
+                {
+                    "index": index,
+                    **combinations[index],
+                    "n_cell_candidates": sum(
+                        c.type == Cell.UNKNOWN for c in cells
+                    ),
+                    "n_artifacts": sum(c.type == Cell.ARTIFACT for c in cells),
+                    "cells_file": cells_path.name,
+                }
+            )
+
+    rows.sort(key=lambda row: row["index"])
+    table_path = Path(cfg._output_path) / SWEEP_TABLE_FILENAME
+    with open(table_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    logger.info(f"Threshold sweep results saved to {table_path}")
+
+    return rows
+
+
+def sweep_parser(argv: List[str]) -> argparse.Namespace:
+    """Define argument parser for the threshold sweep.
+
+    Parameters
+    ----------
+    argv : List[str]
+        list of command line input arguments
+
+    Returns
+    -------
+    args : argparse.Namespace
+        command line input arguments parsed
+    """
+    parser = argparse.ArgumentParser(
+        description="Evaluate the detection threshold combinations listed "
+        "in a cellfinder config, reusing the 2D filtered planes."
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        default=str(DEFAULT_JSON_CONFIG_PATH_CELLFINDER),
+        type=str,
+        metavar="CONFIG",
+        help="Path to the cellfinder config json file.",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str]) -> CellfinderConfig:
+    """Setup and run the threshold sweep.
+
+    Parameters
+    ----------
+    argv : List[str]
+        list of command line input arguments
+
+    Returns
+    -------
+    cfg : CellfinderConfig
+        a class with the required setup methods and parameters for
+        the cellfinder workflow
+    """
+    args = sweep_parser(argv)
+    _ = setup_logger()
+    cfg = read_cellfinder_config(args.config, log_on=True)
+    cfg.prepare()
+
+    run_threshold_sweep(cfg)
+
+    return cfg
+
+
+if __name__ == "__main__":
+    _ = main(sys.argv[1:])
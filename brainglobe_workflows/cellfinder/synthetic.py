@@ -0,0 +1,449 @@
+"""Generate synthetic input data for the cellfinder workflow
+
+The synthetic data is a signal volume with a known number of bright,
+blob-like cells on a noisy background, and a background volume with the
+noise only. It is deterministic for a given seed, so it can be used to run
+the benchmarks and tests offline, and to measure how the workflow scales
+with the size of the data.
+
+Along with the data, a cellfinder config JSON file pointing to it is
+written, and the true cell positions are saved to an XML file.
+
+To generate the data at 4 times the default size:
+
+    python -m brainglobe_workflows.cellfinder.synthetic \
+        --output-dir /path/to/synthetic --scale 4
+
+and then run the workflow or the benchmarks with the generated config:
+
+    CELLFINDER_CONFIG_PATH=/path/to/synthetic/cellfinder_config.json \
+        asv run --config asv.bg-requirements.conf.json
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+from pathlib import Path
+from typing import List, Tuple, Union
+
+import numpy as np
+import tifffile
+import zarr
+from brainglobe_utils.cells.cells import Cell
+from brainglobe_utils.IO.cells import save_cells
+
+from brainglobe_workflows.utils import (
+    DEFAULT_JSON_CONFIG_PATH_CELLFINDER,
+    setup_logger,
+)
+
+Pathlike = Union[str, os.PathLike]
+
+SYNTHETIC_CONFIG_FILENAME = "cellfinder_config.json"
+SYNTHETIC_CELLS_FILENAME = "true_cells.xml"
+
+# number of planes written at once
+N_PLANES_PER_BLOCK = 16
+
+
+def sample_cell_positions(
+    shape: Tuple[int, int, int],
+    n_cells: int,
+    min_spacing: Tuple[float, float, float],
+    rng: np.random.Generator,
+) -> np.ndarray:
+    """Sample cell positions that are at least `min_spacing` apart.
+
+    The volume is divided into a grid of slots of size `min_spacing`, and
+    each cell is placed at a random position within the central half of a
+    different slot, so that no two cells touch.
+
+    Parameters
+    ----------
+    shape : Tuple[int, int, int]
+        shape of the volume, in z, y, x order
+    n_cells : int
+        number of cells
+    min_spacing : Tuple[float, float, float]
+        minimum spacing between cell centres in voxels, in z, y, x order
+    rng : np.random.Generator
+        random number generator
+
+    Returns
+    -------
+    np.ndarray
+        the cell positions in voxels, as an (n_cells, 3) array in
+        z, y, x order
+
+    Raises
+    ------
+    ValueError
+        if the volume is too small to fit `n_cells` cells
+    """
+    slot_size = np.array([math.ceil(s) for s in min_spacing])
+    n_slots = np.array(shape) // slot_size
+    if n_cells > np.prod(n_slots):
+        raise ValueError(
+            f"A volume of shape {shape} fits at most {np.prod(n_slots)} "
+            f"cells, but {n_cells} were requested"
+        )
+
+    slots = rng.choice(np.prod(n_slots), size=n_cells, replace=False)
+    slot_origins = np.stack(np.unravel_index(slots, n_slots), axis=1)
+    jitter = rng.uniform(0.25, 0.75, size=(n_cells, 3))
+    return (slot_origins + jitter) * slot_size
+
+
+def render_planes(
+    z_start: int,
+    z_end: int,
+    plane_shape: Tuple[int, int],
+    cell_positions: np.ndarray,
+    cell_radii: Tuple[float, float, float],
+    cell_intensity: float,
+    background_level: float,
+    noise_sd: float,
+    dtype: np.dtype,
+    seed: int,
+) -> np.ndarray:
+    """Render a block of planes of a synthetic volume.
+
+    The noise of each plane is drawn from a generator seeded by the plane
+    index, so the volume does not depend on how it is split into blocks.
+
+    Parameters
+    ----------
+    z_start : int
+        first plane of the block (inclusive)
+    z_end : int
+        last plane of the block (exclusive)
+    plane_shape : Tuple[int, int]
+        shape of each plane
+    cell_positions : np.ndarray
+        the cell positions in voxels, as an (n_cells, 3) array in
+        z, y, x order
+    cell_radii : Tuple[float, float, float]
+        the radii of the ellipsoidal cells in voxels, in z, y, x order
+    cell_intensity : float
+        intensity of the voxels in a cell
+    background_level : float
+        mean intensity of the background
+    noise_sd : float
+        standard deviation of the background noise
+    dtype : np.dtype
+        data type of the volume
+    seed : int
+        seed of the noise
+
+    Returns
+    -------
+    np.ndarray
+        the block of planes
+    """
+    planes = np.empty((z_end - z_start, *plane_shape), dtype=np.float32)
+    for z in range(z_start, z_end):
+        rng = np.random.default_rng((seed, z))
+        planes[z - z_start] = rng.normal(
+            background_level, noise_sd, size=plane_shape
+        )
+
+    radius_z, radius_y, radius_x = cell_radii
+    in_block = np.abs(cell_positions[:, 0] - (z_start + z_end - 1) / 2) < (
+        radius_z + (z_end - z_start) / 2
+    )
+    for cz, cy, cx in cell_positions[in_block]:
+        # bounding box of the cell within the block
+        z0 = max(z_start, int(cz - radius_z))
+        z1 = min(z_end, int(cz + radius_z) + 1)
+        y0, y1 = max(0, int(cy - radius_y)), int(cy + radius_y) + 1
+        x0, x1 = max(0, int(cx - radius_x)), int(cx + radius_x) + 1
+        zz, yy, xx = np.ogrid[z0:z1, y0:y1, x0:x1]
+        inside = (
+            ((zz - cz) / radius_z) ** 2
+            + ((yy - cy) / radius_y) ** 2
+            + ((xx - cx) / radius_x) ** 2
+        ) < 1
+        box = planes[z0 - z_start : z1 - z_start, y0:y1, x0:x1]
+        box[inside[:, : box.shape[1], : box.shape[2]]] = cell_intensity
+
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        np.clip(planes, info.min, info.max, out=planes)
+        planes = np.rint(planes)
+    return planes.astype(dtype)
+
+
+def generate_synthetic_data(
+    output_dir: Pathlike,
+    shape: Tuple[int, int, int] = (32, 256, 256),
+    scale: int = 1,
+    n_cells: int = 40,
+    voxel_sizes: Tuple[float, float, float] = (5, 2, 2),
+    soma_diameter: float = 16,
+    dtype: str = "uint16",
+    background_level: float = 100,
+    noise_sd: float = 5,
+    cell_intensity: float = 1000,
+    data_format: str = "tiff",
+    seed: int = 0,
+) -> Path:
+    """Generate synthetic input data and a cellfinder config for it.
+
+    The data is written to `output_dir`, in a `signal` and a `background`
+    directory of 2D TIFF planes, or `signal.zarr` and `background.zarr`
+    chunked stores. The config is written to `cellfinder_config.json`, and
+    the true cell positions to `true_cells.xml`.
+
+    Parameters
+    ----------
+    output_dir : Pathlike
+        directory to write the data to
+    shape : Tuple[int, int, int], optional
+        shape of the volumes at scale 1, in z, y, x order
+    scale : int, optional
+        factor by which the number of planes and the number of cells are
+        multiplied, by default 1. The density of cells and the size of
+        each plane do not depend on the scale.
+    n_cells : int, optional
+        number of cells at scale 1, by default 40
+    voxel_sizes : Tuple[float, float, float], optional
+        voxel sizes in microns, in z, y, x order, by default (5, 2, 2)
+    soma_diameter : float, optional
+        diameter of the cells in microns, by default 16
+    dtype : str, optional
+        data type of the volumes, by default "uint16"
+    background_level : float, optional
+        mean intensity of the background, by default 100
+    noise_sd : float, optional
+        standard deviation of the background noise, by default 5
+    cell_intensity : float, optional
+        intensity of the voxels in a cell, by default 1000
+    data_format : str, optional
+        "tiff" to write directories of 2D TIFF planes, or "zarr" to write
+        zarr stores chunked by blocks of planes, by default "tiff"
+    seed : int, optional
+        seed of the random number generator, by default 0
+
+    Returns
+    -------
+    Path
+        path to the cellfinder config file
+
+    Raises
+    ------
+    ValueError
+        if the data format is not supported, or the volume is too small to
+        fit the cells
+    """
+    if data_format not in ("tiff", "zarr"):
+        raise ValueError(
+            f"Data format {data_format} not supported. "
+            "Please use 'tiff' or 'zarr'."
+        )
+
+    output_dir = Path(output_dir)
+    shape = (shape[0] * scale, shape[1], shape[2])
+    n_cells = n_cells * scale
+    dtype = np.dtype(dtype)
+
+    # keep the cells at least two diameters apart, and out of the tiles at
+    # the edges of each plane: cellfinder takes the corner tile to be
+    # outside the brain, to estimate the background intensity
+    cell_radii = tuple(soma_diameter / 2 / v for v in voxel_sizes)
+    margin = np.array([0, *(math.ceil(4 * r) for r in cell_radii[1:])])
+    rng = np.random.default_rng(seed)
+    cell_positions = margin + sample_cell_positions(
+        tuple(np.array(shape) - 2 * margin),
+        n_cells,
+        tuple(4 * r for r in cell_radii),
+        rng,
+    )
+
+    channels = {
+        "signal": dict(cell_positions=cell_positions, seed=seed),
+        # the background has no cells, and independent noise
+        "background": dict(cell_positions=np.empty((0, 3)), seed=seed + 1),
+    }
+    for channel, channel_kwargs in channels.items():
+        write_block = _get_block_writer(
+            output_dir, channel, shape, dtype, data_format
+        )
+        for z in range(0, shape[0], N_PLANES_PER_BLOCK):
+            z_end = min(z + N_PLANES_PER_BLOCK, shape[0])
+            write_block(
+                z,
+                render_planes(
+                    z,
+                    z_end,
+                    shape[1:],
+                    cell_radii=cell_radii,
+                    cell_intensity=cell_intensity,
+                    background_level=background_level,
+                    noise_sd=noise_sd,
+                    dtype=dtype,
+                    **channel_kwargs,
+                ),
+            )
+
+    save_cells(
+        [Cell([x, y, z], Cell.CELL) for z, y, x in cell_positions],
+        str(output_dir / SYNTHETIC_CELLS_FILENAME),
+    )
+
+    with open(DEFAULT_JSON_CONFIG_PATH_CELLFINDER) as cfg:
+        config_dict = json.load(cfg)
+    suffix = ".zarr" if data_format == "zarr" else ""
+    config_dict.update(
+        input_data_dir=str(output_dir.resolve()),
+        signal_subdir=f"signal{suffix}",
+        background_subdir=f"background{suffix}",
+        input_data_format=data_format,
+        voxel_sizes=list(voxel_sizes),
+        soma_diameter=soma_diameter,
+        data_url=None,
+        data_hash=None,
+    )
+    config_path = output_dir / SYNTHETIC_CONFIG_FILENAME
+    with open(config_path, "w") as js:
+        json.dump(config_dict, js, indent=4)
+    return config_path
+
+
+def _get_block_writer(
+    output_dir: Path,
+    channel: str,
+    shape: Tuple[int, int, int],
+    dtype: np.dtype,
+    data_format: str,
+):
+    """Return a function that writes a block of planes of a channel."""
+    if data_format == "zarr":
+        store = zarr.open_array(
+            str(output_dir / f"{channel}.zarr"),
+            mode="w",
+            shape=shape,
+            chunks=(N_PLANES_PER_BLOCK, *shape[1:]),
+            dtype=dtype,
+        )
+
+        def write_block(z: int, planes: np.ndarray):
+            store[z : z + len(planes)] = planes
+
+    else:
+        channel_dir = output_dir / channel
+        channel_dir.mkdir(parents=True, exist_ok=True)
+        n_digits = len(str(shape[0] - 1))
+
+        def write_block(z: int, planes: np.ndarray):
+            for offset, plane in enumerate(planes):
+                tifffile.imwrite(
+                    channel_dir / f"plane_{z + offset:0{n_digits}d}.tif",
+                    plane,
+                )
+
+    return write_block
+
+
+def synthetic_parser(argv: List[str]) -> argparse.Namespace:
+    """Define argument parser for the synthetic data generator.
+
+    Parameters
+    ----------
+    argv : List[str]
+        list of command line input arguments
+
+    Returns
+    -------
+    args : argparse.Namespace
+        command line input arguments parsed
+    """
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic input data for the cellfinder "
+        "workflow, and a config to run it."
+    )
+    parser.add_argument(
+        "--output-dir",
+        required=True,
+        type=str,
+        help="Directory to write the data and config to.",
+    )
+    parser.add_argument(
+        "--shape",
+        default=[32, 256, 256],
+        nargs=3,
+        type=int,
+        metavar=("Z", "Y", "X"),
+        help="Shape of the volumes at scale 1.",
+    )
+    parser.add_argument(
+        "--scale",
+        default=1,
+        type=int,
+        help="Factor by which the number of planes and cells are multiplied.",
+    )
+    parser.add_argument(
+        "--n-cells",
+        default=40,
+        type=int,
+        help="Number of cells at scale 1.",
+    )
+    parser.add_argument(
+        "--dtype",
+        default="uint16",
+        type=str,
+        help="Data type of the volumes.",
+    )
+    parser.add_argument(
+        "--noise-sd",
+        default=5,
+        type=float,
+        help="Standard deviation of the background noise.",
+    )
+    parser.add_argument(
+        "--data-format",
+        default="tiff",
+        choices=["tiff", "zarr"],
+        help="Write directories of 2D TIFF planes, or chunked zarr stores.",
+    )
+    parser.add_argument(
+        "--seed",
+        default=0,
+        type=int,
+        help="Seed of the random number generator.",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str]) -> Path:
+    """Generate synthetic input data from the command line.
+
+    Parameters
+    ----------
+    argv : List[str]
+        list of command line input arguments
+
+    Returns
+    -------
+    Path
+        path to the cellfinder config file
+    """
+    args = synthetic_parser(argv)
+    logger = setup_logger()
+    config_path = generate_synthetic_data(
+        args.output_dir,
+        shape=tuple(args.shape),
+        scale=args.scale,
+        n_cells=args.n_cells,
+        dtype=args.dtype,
+        noise_sd=args.noise_sd,
+        data_format=args.data_format,
+        seed=args.seed,
+    )
+    logger.info(f"Synthetic data config saved to {config_path}")
+    return config_path
+
+
+if __name__ == "__main__":
+    _ = main(sys.argv[1:])
@@ -0,0 +1,474 @@
+"""Fetch and extract zip archives of test data
+
+The archive is downloaded and extracted in a single pass: the zip members
+are extracted from the stream of downloaded bytes, while the bytes are
+written to disk and hashed. If the connection drops, the download resumes
+from the bytes already on disk with an HTTP range request.
+
+Once the archive hash has been verified, it is recorded in a sidecar file
+next to the archive, together with the archive size and modification time.
+An unchanged archive is then not hashed again.
+"""
+
+import hashlib
+import http.client
+import json
+import logging
+import os
+import shutil
+import struct
+import time
+import urllib.error
+import urllib.request
+import zipfile
+import zlib
+from pathlib import Path
+from typing import Iterator, List, Optional, Union
+
+from brainglobe_workflows.utils import __name__ as LOGGER_NAME
+
+Pathlike = Union[str, os.PathLike]
+
+CHUNK_SIZE = 1024 * 1024
+HASH_SIDECAR_SUFFIX = ".verified.json"
+PARTIAL_SUFFIX = ".partial"
+
+_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+_DATA_DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+_ZIP64_EXTRA_FIELD_ID = 0x0001
+
+
+class _StreamingNotSupportedError(Exception):
+    """Raised for zip members that cannot be extracted from a stream."""
+
+
+def parse_known_hash(known_hash: str) -> tuple[str, str]:
+    """Split a hash in pooch format into the algorithm and the hex digest.
+
+    Parameters
+    ----------
+    known_hash : str
+        the hash, as "<algorithm>:<digest>" or as a sha256 digest
+
+    Returns
+    -------
+    tuple[str, str]
+        the name of the hash algorithm and the hex digest, in lower case
+    """
+    algorithm, _, digest = known_hash.rpartition(":")
+    return (algorithm or "sha256").lower(), digest.lower()
+
+
+def hash_file(file_path: Pathlike, algorithm: str = "sha256") -> str:
+    """Compute the hash of a file.
+
+    Parameters
+    ----------
+    file_path : Pathlike
+        path to the file
+    algorithm : str, optional
+        name of the hash algorithm, by default "sha256"
+
+    Returns
+    -------
+    str
+        the hex digest of the file
+    """
+    file_hash = hashlib.new(algorithm)
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def get_hash_sidecar_path(archive_path: Pathlike) -> Path:
+    """Get the path to the verified-hash sidecar of an archive."""
+    return Path(str(archive_path) + HASH_SIDECAR_SUFFIX)
+
+
+def write_hash_sidecar(archive_path: Pathlike, known_hash: str):
+    """Record that the archive matches the known hash.
+
+    Parameters
+    ----------
+    archive_path : Pathlike
+        path to the verified archive
+    known_hash : str
+        the hash the archive was verified against
+    """
+    stat = os.stat(archive_path)
+    with open(get_hash_sidecar_path(archive_path), "w") as f:
+        json.dump(
+            {
+                "hash": known_hash,
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+            },
+            f,
+        )
+
+
+def is_verified(archive_path: Pathlike, known_hash: str) -> bool:
+    """Check if an archive matches the known hash.
+
+    The hash is only computed if the archive has no verified-hash sidecar,
+    or if the archive changed since the sidecar was written.
+
+    Parameters
+    ----------
+    archive_path : Pathlike
+        path to the archive
+    known_hash : str
+        the expected hash of the archive
+
+    Returns
+    -------
+    bool
+        whether the archive exists and matches the known hash
+    """
+    if not Path(archive_path).exists():
+        return False
+
+    stat = os.stat(archive_path)
+    try:
+        with open(get_hash_sidecar_path(archive_path)) as f:
+            sidecar = json.load(f)
+        if sidecar == {
+            "hash": known_hash,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }:
+            return True
+    except (OSError, ValueError):
+        pass
+
+    algorithm, digest = parse_known_hash(known_hash)
+    if hash_file(archive_path, algorithm) != digest:
+        return False
+    write_hash_sidecar(archive_path, known_hash)
+    return True
+
+
+class _ChunkReader:
+    """A file-like reader over an iterator of byte chunks."""
+
+    def __init__(self, chunks: Iterator[bytes]):
+        self._chunks = chunks
+        self._buffer = bytearray()
+
+    def read(self, size: int) -> bytes:
+        """Read up to `size` bytes, fewer only at the end of the stream."""
+        while len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def read_chunk(self, max_size: int) -> bytes:
+        """Read the buffered bytes, or the next chunk, up to `max_size`."""
+        if not self._buffer:
+            self._buffer += next(self._chunks, b"")
+        data = bytes(self._buffer[:max_size])
+        del self._buffer[:max_size]
+        return data
+
+    def unread(self, data: bytes):
+        """Push bytes back to the front of the stream."""
+        self._buffer[:0] = data
+
+    def drain(self):
+        """Consume the rest of the stream."""
+        self._buffer.clear()
+        for _ in self._chunks:
+            pass
+
+
+def _get_member_path(extract_dir: Path, name: str) -> Path:
+    """Get the path of a zip member, ensuring it is in `extract_dir`."""
+    member_path = (extract_dir / name).resolve()
+    if not member_path.is_relative_to(extract_dir.resolve()):
+        raise ValueError(f"Zip member {name} is outside the extract dir")
+    return member_path
+
+
+def _stream_extract_zip(reader: _ChunkReader, extract_dir: Path):
+    """Extract the members of a zip archive from a stream of bytes.
+
+    The members are read from their local headers, in the order they are
+    stored in the archive. The stream is consumed until its end.
+
+    Raises
+    ------
+    _StreamingNotSupportedError
+        if a member is encrypted, or compressed with a method other than
+        deflate, or is stored uncompressed with unknown size
+    """
+    while True:
+        signature = reader.read(4)
+        if len(signature) < 4:
+            raise EOFError("Zip archive ended before its central directory")
+        if signature != _LOCAL_HEADER_SIGNATURE:
+            break
+
+        header = reader.read(26)
+        if len(header) < 26:
+            raise EOFError("Truncated zip member header")
+        (
+            _,  # version needed to extract
+            flags,
+            method,
+            _,  # modification time
+            _,  # modification date
+            _,  # crc-32
+            compressed_size,
+            _,  # uncompressed size
+            name_length,
+            extra_length,
+        ) = struct.unpack("<HHHHHIIIHH", header)
+        name = reader.read(name_length).decode(
+            "utf-8" if flags & 0x800 else "cp437"
+        )
+        extra = reader.read(extra_length)
+
+        # zip64 members store their sizes in an extra field
+        zip64 = False
+        offset = 0
+        while offset + 4 <= len(extra):
+            field_id, field_length = struct.unpack_from("<HH", extra, offset)
+            if field_id == _ZIP64_EXTRA_FIELD_ID:
+                zip64 = True
+                if compressed_size == 0xFFFFFFFF:
+                    (compressed_size,) = struct.unpack_from(
+                        "<Q", extra, offset + 12
+                    )
+            offset += 4 + field_length
+
+        has_data_descriptor = bool(flags & 0x8)
+        if (
+            flags & 0x1
+            or method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)
+            or (has_data_descriptor and method == zipfile.ZIP_STORED)
+        ):
+            raise _StreamingNotSupportedError(name)
+
+        member_path = _get_member_path(extract_dir, name)
+        if name.endswith("/"):
+            member_path.mkdir(parents=True, exist_ok=True)
+        else:
+            member_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(member_path, "wb") as f:
+                if method == zipfile.ZIP_STORED:
+                    remaining = compressed_size
+                    while remaining > 0:
+                        data = reader.read_chunk(min(remaining, CHUNK_SIZE))
+                        if not data:
+                            raise EOFError(f"Truncated zip member {name}")
+                        f.write(data)
+                        remaining -= len(data)
+                else:
+                    # the deflate stream marks its own end, so the
+                    # compressed size is not needed
+                    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                    while not decompressor.eof:
+                        data = reader.read_chunk(CHUNK_SIZE)
+                        if not data:
+                            raise EOFError(f"Truncated zip member {name}")
+                        f.write(decompressor.decompress(data))
+                    reader.unread(decompressor.unused_data)
+
+        if has_data_descriptor:
+            # skip the crc-32 and sizes, with an optional signature
+            signature = reader.read(4)
+            if signature != _DATA_DESCRIPTOR_SIGNATURE:
+                reader.unread(signature)
+            reader.read(20 if zip64 else 12)
+
+    # consume the central directory
+    reader.drain()
+
+
+def _download_chunks(
+    url: str, partial_path: Path, timeout: float
+) -> Iterator[bytes]:
+    """Yield the bytes of the archive, resuming from a partial download.
+
+    The bytes already downloaded are read from disk first, then the rest
+    are downloaded with a range request and appended to the partial file.
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    offset = partial_path.stat().st_size if partial_path.exists() else 0
+    request = urllib.request.Request(url)
+    if offset:
+        request.add_header("Range", f"bytes={offset}-")
+
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        # the partial download is already complete
+        if e.code == 416 and offset:
+            response = None
+        else:
+            raise
+
+    if response is not None and offset and response.status != 206:
+        # the server ignored the range request: start again
+        logger.info(f"Server does not support resuming, restarting {url}")
+        offset = 0
+        partial_path.unlink()
+    elif offset:
+        logger.info(f"Resuming download of {url} from byte {offset}")
+
+    # yield the bytes downloaded in previous attempts
+    if offset:
+        with open(partial_path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                yield chunk
+
+    if response is None:
+        return
+    with response, open(partial_path, "ab") as f:
+        for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+            f.write(chunk)
+            yield chunk
+
+
+def _extract_archive(archive_path: Path, extract_dir: Path):
+    """Extract a local zip archive, checking member paths."""
+    with zipfile.ZipFile(archive_path) as archive:
+        for name in archive.namelist():
+            _get_member_path(extract_dir, name)
+        archive.extractall(extract_dir)
+
+
+def _move_extracted_files(src_dir: Path, dest_dir: Path) -> List[str]:
+    """Move extracted files to their destination, and list them."""
+    file_paths = []
+    for src_path in sorted(src_dir.rglob("*")):
+        if src_path.is_file():
+            dest_path = dest_dir / src_path.relative_to(src_dir)
+            dest_path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(src_path, dest_path)
+            file_paths.append(str(dest_path.resolve()))
+    shutil.rmtree(src_dir)
+    return file_paths
+
+
+def fetch_and_extract_archive(
+    url: str,
+    known_hash: str,
+    archive_dir: Pathlike,
+    extract_dir: Pathlike,
+    max_retries: int = 5,
+    timeout: float = 60,
+    archive_name: Optional[str] = None,
+) -> List[str]:
+    """Download a zip archive and extract it, resuming interrupted downloads.
+
+    The archive is extracted while it is downloaded, to a temporary
+    directory next to `extract_dir`. The extracted files are only moved to
+    `extract_dir` after the hash of the archive is verified.
+
+    If the archive was already downloaded and verified, it is not
+    downloaded or hashed again, and it is only extracted.
+
+    Parameters
+    ----------
+    url : str
+        URL of the zip archive
+    known_hash : str
+        expected hash of the archive, as "<algorithm>:<digest>" or as a
+        sha256 digest
+    archive_dir : Pathlike
+        directory where the archive is saved
+    extract_dir : Pathlike
+        directory where the archive is extracted
+    max_retries : int, optional
+        maximum number of times to resume the download after a connection
+        error, by default 5
+    timeout : float, optional
+        timeout in seconds of the connection to the server, by default 60
+    archive_name : Optional[str], optional
+        file name of the archive. If None, the last part of the URL is used.
+
+    Returns
+    -------
+    List[str]
+        absolute paths to the extracted files
+
+    Raises
+    ------
+    ValueError
+        if the downloaded archive does not match the known hash
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    archive_dir = Path(archive_dir)
+    extract_dir = Path(extract_dir)
+    archive_path = archive_dir / (
+        archive_name or url.rstrip("/").split("/")[-1]
+    )
+    partial_path = Path(str(archive_path) + PARTIAL_SUFFIX)
+    tmp_extract_dir = extract_dir.with_name(extract_dir.name + PARTIAL_SUFFIX)
+    archive_dir.mkdir(parents=True, exist_ok=True)
+
+    if is_verified(archive_path, known_hash):
+        logger.info(f"Extracting verified archive {archive_path}")
+        shutil.rmtree(tmp_extract_dir, ignore_errors=True)
+        _extract_archive(archive_path, tmp_extract_dir)
+        return _move_extracted_files(tmp_extract_dir, extract_dir)
+
+    logger.info(f"Downloading {url} to {archive_path}")
+    algorithm, digest = parse_known_hash(known_hash)
+    for attempt in range(max_retries + 1):
+        # extraction restarts from the first byte at each attempt, reading
+        # the bytes downloaded in previous attempts from disk
+        shutil.rmtree(tmp_extract_dir, ignore_errors=True)
+        archive_hash = hashlib.new(algorithm)
+
+        def hashed_chunks():
+            for chunk in _download_chunks(url, partial_path, timeout):
+                archive_hash.update(chunk)
+                yield chunk
+
+        reader = _ChunkReader(hashed_chunks())
+        try:
+            try:
+                _stream_extract_zip(reader, tmp_extract_dir)
+                extracted = True
+            except _StreamingNotSupportedError as e:
+                logger.info(
+                    f"Zip member {e} cannot be extracted while downloading"
+                )
+                reader.drain()
+                extracted = False
+            break
+        except (
+            urllib.error.URLError,
+            http.client.HTTPException,
+            ConnectionError,
+            TimeoutError,
+            EOFError,
+        ) as e:
+            if attempt == max_retries:
+                raise
+            logger.warning(f"Download of {url} interrupted ({e}), resuming")
+            time.sleep(min(2**attempt, 30))
+
+    if archive_hash.hexdigest() != digest:
+        partial_path.unlink(missing_ok=True)
+        shutil.rmtree(tmp_extract_dir, ignore_errors=True)
+        raise ValueError(
+            f"{algorithm.upper()} hash of downloaded file ({url}) does not "
+            f"match the known hash: expected {digest}, got "
+            f"{archive_hash.hexdigest()}"
+        )
+
+    os.replace(partial_path, archive_path)
+    write_hash_sidecar(archive_path, known_hash)
+
+    if not extracted:
+        shutil.rmtree(tmp_extract_dir, ignore_errors=True)
+        _extract_archive(archive_path, tmp_extract_dir)
+    return _move_extracted_files(tmp_extract_dir, extract_dir)
@@ -0,0 +1,569 @@
+"""Read input image data for the workflows
+
+The workflows accept input data as directories of 2D TIFF planes, or as
+chunked zarr / OME-Zarr stores. Both are read lazily as dask arrays.
+
+Directories of 2D TIFF planes can also be converted once into a single
+memory-mappable 3D TIFF stack, cached under the output directory and keyed
+by a fingerprint of the source files, so that the per-file metadata and
+decoding cost is paid once rather than by every stage that reads the data.
+
+Listing the files of large input directories (e.g. on network file systems)
+is slow, so the listing is cached in a manifest file next to each directory
+(or, if that cannot be written, e.g. for a read-only or shared input tree,
+in a cache directory under the home directory), and rescanned only when the
+directory modification time changes.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+import dask.array as da
+import tifffile
+import zarr
+from brainglobe_utils.IO.image.load import (
+    get_tiff_meta,
+    lazy_imread,
+    read_with_dask,
+)
+from natsort import natsorted
+
+from brainglobe_workflows.utils import __name__ as LOGGER_NAME
+
+Pathlike = Union[str, os.PathLike]
+# the path, size and modification time (in ns) of a file
+FileStat = Tuple[Path, int, int]
+
+FILE_MANIFEST_SUFFIX = ".manifest.json"
+# where the file manifests are cached if they cannot be saved next to their
+# directory
+FILE_MANIFEST_CACHE_DIR = (
+    Path.home() / ".brainglobe" / "workflows" / "file_manifests"
+)
+N_PLANES_PER_CONVERSION_BLOCK = 64
+
+
+def get_ome_zarr_array_path(
+    store_path: Pathlike, resolution_level: int
+) -> str:
+    """Get the path to the array of a resolution level in an OME-Zarr store.
+
+    Parameters
+    ----------
+    store_path : Pathlike
+        path to the OME-Zarr store
+    resolution_level : int
+        resolution level, where 0 is the full resolution
+
+    Returns
+    -------
+    str
+        path to the array within the store
+
+    Raises
+    ------
+    ValueError
+        if the store has no multiscales metadata, or the resolution level
+        is not in the store
+    """
+    attrs = zarr.open_group(str(store_path), mode="r").attrs.asdict()
+
+    # OME-Zarr v0.5 nests the metadata under the "ome" key
+    multiscales = attrs.get("ome", attrs).get("multiscales")
+    if not multiscales:
+        raise ValueError(
+            f"The zarr store {store_path} has no OME-Zarr multiscales "
+            "metadata. Please specify the path to the array in the store."
+        )
+
+    datasets = multiscales[0]["datasets"]
+    if not 0 <= resolution_level < len(datasets):
+        raise ValueError(
+            f"Resolution level {resolution_level} not found in {store_path}, "
+            f"which has {len(datasets)} resolution levels"
+        )
+    return datasets[resolution_level]["path"]
+
+
+def read_zarr_with_dask(
+    store_path: Pathlike,
+    array_path: Optional[str] = None,
+    resolution_level: int = 0,
+) -> da.Array:
+    """Read a 3D array from a zarr or OME-Zarr store as a dask array.
+
+    The array is opened lazily with the chunking of the store, so no data
+    is read or copied until it is computed.
+
+    Parameters
+    ----------
+    store_path : Pathlike
+        path to the zarr store
+    array_path : Optional[str], optional
+        path to the array within the store. If None, the store is read as
+        an OME-Zarr store, or as a single array if it is not a group.
+    resolution_level : int, optional
+        resolution level to read from an OME-Zarr store, by default 0
+        (full resolution). Ignored if `array_path` is specified.
+
+    Returns
+    -------
+    da.Array
+        the 3D array, in z, y, x order
+
+    Raises
+    ------
+    ValueError
+        if the array has more than 3 non-singleton dimensions
+    """
+    if array_path is None and isinstance(
+        zarr.open(str(store_path), mode="r"), zarr.Group
+    ):
+        array_path = get_ome_zarr_array_path(store_path, resolution_level)
+
+    array = da.from_zarr(str(store_path), component=array_path)
+
+    # OME-Zarr arrays may have leading singleton (t, c) dimensions
+    while array.ndim > 3 and array.shape[0] == 1:
+        array = array[0]
+    if array.ndim != 3:
+        raise ValueError(
+            f"Expected a 3D array in {store_path}, but got an array "
+            f"of shape {array.shape}"
+        )
+    return array
+
+
+def get_file_manifest_path(dir_path: Pathlike) -> Path:
+    """Get the path to the file manifest of a directory.
+
+    The manifest is saved next to the directory rather than inside it, so
+    that writing it does not change the directory modification time.
+
+    Parameters
+    ----------
+    dir_path : Pathlike
+        path to the directory
+
+    Returns
+    -------
+    Path
+        path to the manifest file
+    """
+    dir_path = Path(dir_path).resolve()
+    return dir_path.parent / f".{dir_path.name}{FILE_MANIFEST_SUFFIX}"
+
+
+def get_fallback_file_manifest_path(dir_path: Pathlike) -> Path:
+    """Get the path to the file manifest of a directory in the cache
+    directory, used if it cannot be saved next to the directory.
+
+    Parameters
+    ----------
+    dir_path : Pathlike
+        path to the directory
+
+    Returns
+    -------
+    Path
+        path to the manifest file, named after a hash of the resolved path
+        of the directory
+    """
+    dir_path = Path(dir_path).resolve()
+    path_hash = hashlib.sha256(str(dir_path).encode()).hexdigest()[:16]
+    return FILE_MANIFEST_CACHE_DIR / (
+        f"{dir_path.name}-{path_hash}{FILE_MANIFEST_SUFFIX}"
+    )
+
+
+def _read_cached_file_manifest(
+    manifest_path: Path, dir_mtime_ns: int
+) -> Optional[List[dict]]:
+    """Read the files of a cached manifest, or return None if it does not
+    exist or is out of date."""
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest["dir_mtime_ns"] == dir_mtime_ns:
+            return manifest["files"]
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def _save_file_manifest(manifest_path: Path, manifest: dict) -> bool:
+    """Save a manifest, and return whether it could be saved."""
+    # write to a temporary file first, so a partial manifest is never read
+    partial_path = manifest_path.with_name(
+        f"{manifest_path.name}.{os.getpid()}.partial"
+    )
+    try:
+        manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(partial_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(partial_path, manifest_path)
+    except OSError:
+        return False
+    return True
+
+
+def read_file_manifest(dir_path: Pathlike) -> List[dict]:
+    """Read the manifest of the files in a directory.
+
+    The manifest lists the name, size and modification time of each file
+    in the directory, sorted naturally by name. It is cached in a file next
+    to the directory, or, if that cannot be written (e.g. the parent
+    directory is read-only), in `FILE_MANIFEST_CACHE_DIR`. It is reused
+    while the directory modification time is unchanged, i.e. while no files
+    are added, removed or renamed. Otherwise, the directory is scanned again
+    and the manifest is updated.
+
+    Note that modifying a file in place does not change the modification
+    time of its directory, so the sizes and modification times in a cached
+    manifest may be out of date.
+
+    Parameters
+    ----------
+    dir_path : Pathlike
+        path to the directory
+
+    Returns
+    -------
+    List[dict]
+        the manifest entries, with "name", "size" and "mtime_ns" keys
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    manifest_paths = [
+        get_file_manifest_path(dir_path),
+        get_fallback_file_manifest_path(dir_path),
+    ]
+    # stat before scanning, so changes during the scan invalidate the cache
+    dir_mtime_ns = os.stat(dir_path).st_mtime_ns
+
+    for manifest_path in manifest_paths:
+        files = _read_cached_file_manifest(manifest_path, dir_mtime_ns)
+        if files is not None:
+            return files
+
+    logger.debug(f"Scanning files in {dir_path}")
+    files = []
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stat = entry.stat()
+                files.append(
+                    {
+                        "name": entry.name,
+                        "size": stat.st_size,
+                        "mtime_ns": stat.st_mtime_ns,
+                    }
+                )
+    files = natsorted(files, key=lambda f: f["name"])
+
+    manifest = {"dir_mtime_ns": dir_mtime_ns, "files": files}
+    if not any(
+        _save_file_manifest(manifest_path, manifest)
+        for manifest_path in manifest_paths
+    ):
+        logger.warning(
+            f"Could not save the file manifest of {dir_path}, so the "
+            "directory will be scanned again next time"
+        )
+
+    return files
+
+
+def list_files(dir_path: Pathlike) -> List[Path]:
+    """List the files in a directory, using its cached file manifest.
+
+    Parameters
+    ----------
+    dir_path : Pathlike
+        path to the directory
+
+    Returns
+    -------
+    List[Path]
+        the resolved paths to the files in the directory, sorted naturally
+    """
+    dir_path = Path(dir_path).resolve()
+    return [dir_path / f["name"] for f in read_file_manifest(dir_path)]
+
+
+def read_tiff_with_dask(path: Pathlike) -> da.Array:
+    """Read TIFF data as a dask array.
+
+    Directories of 2D TIFF planes are listed using their cached file
+    manifest. Otherwise, this is equivalent to `read_with_dask`.
+
+    Parameters
+    ----------
+    path : Pathlike
+        a directory of 2D TIFF planes, a text file listing them, or a
+        single 3D TIFF file
+
+    Returns
+    -------
+    da.Array
+        the 3D array, in z, y, x order
+    """
+    if not Path(path).is_dir():
+        return read_with_dask(str(path))
+
+    file_paths = [str(f) for f in list_tiff_files(path)]
+    shape, dtype = get_tiff_meta(file_paths[0])
+    return da.stack(
+        [
+            da.from_delayed(
+                lazy_imread(f, is_ome=False), shape=shape, dtype=dtype
+            )
+            for f in file_paths
+        ],
+        axis=0,
+    )
+
+
+def list_tiff_files(
+    source_path: Pathlike, sort_input_file: bool = False
+) -> List[Path]:
+    """List the TIFF files that make up an input image.
+
+    Parameters
+    ----------
+    source_path : Pathlike
+        a directory of 2D TIFF planes, a text file listing the paths to the
+        2D TIFF planes, or a single 3D TIFF file
+    sort_input_file : bool, optional
+        whether to sort the paths in a text file naturally, by default False.
+        The files in a directory are always sorted naturally, and listed
+        using the directory's cached file manifest.
+
+    Returns
+    -------
+    List[Path]
+        the TIFF files, in z order
+
+    Raises
+    ------
+    ValueError
+        if a directory does not contain any TIFF files
+    """
+    source_path = Path(source_path)
+    if source_path.suffix == ".txt":
+        with open(source_path) as f:
+            file_paths = [line.strip() for line in f if line.strip()]
+        if sort_input_file:
+            file_paths = natsorted(file_paths)
+    elif source_path.is_dir():
+        file_paths = [path for path, _, _ in list_tiff_file_stats(source_path)]
+    else:
+        file_paths = [str(source_path)]
+
+    return [Path(f) for f in file_paths]
+
+
+def list_tiff_file_stats(
+    source_path: Pathlike, sort_input_file: bool = False
+) -> List[FileStat]:
+    """List the TIFF files that make up an input image, with their size and
+    modification time.
+
+    The sizes and modification times of the files in a directory are taken
+    from its cached file manifest, rather than read from each file, so they
+    may be out of date if a file was modified in place (see
+    `read_file_manifest`).
+
+    Parameters
+    ----------
+    source_path : Pathlike
+        a directory of 2D TIFF planes, a text file listing the paths to the
+        2D TIFF planes, or a single 3D TIFF file
+    sort_input_file : bool, optional
+        whether to sort the paths in a text file naturally, by default False
+
+    Returns
+    -------
+    List[FileStat]
+        the resolved path, size and modification time of the TIFF files, in
+        z order
+
+    Raises
+    ------
+    ValueError
+        if a directory does not contain any TIFF files
+    """
+    source_path = Path(source_path)
+    if source_path.suffix == ".txt" or not source_path.is_dir():
+        return get_file_stats(list_tiff_files(source_path, sort_input_file))
+
+    dir_path = source_path.resolve()
+    file_stats = [
+        (dir_path / f["name"], f["size"], f["mtime_ns"])
+        for f in read_file_manifest(dir_path)
+        if Path(f["name"]).suffix in (".tif", ".tiff")
+    ]
+    if not file_stats:
+        raise ValueError(
+            f"Folder {source_path} does not contain any .tif or .tiff files"
+        )
+    return file_stats
+
+
+def list_zarr_store_files(store_path: Pathlike) -> List[Path]:
+    """List the files of a zarr store, including metadata and chunks.
+
+    Parameters
+    ----------
+    store_path : Pathlike
+        path to the zarr store
+
+    Returns
+    -------
+    List[Path]
+        the files in the store, sorted by path
+    """
+    return sorted(f for f in Path(store_path).rglob("*") if f.is_file())
+
+
+def get_file_stats(file_paths: List[Pathlike]) -> List[FileStat]:
+    """Get the resolved path, size and modification time of files.
+
+    Parameters
+    ----------
+    file_paths : List[Pathlike]
+        the files
+
+    Returns
+    -------
+    List[FileStat]
+        the resolved path, size and modification time of each file
+    """
+    file_stats = []
+    for file_path in file_paths:
+        stat = os.stat(file_path)
+        file_stats.append(
+            (Path(file_path).resolve(), stat.st_size, stat.st_mtime_ns)
+        )
+    return file_stats
+
+
+def fingerprint_file_stats(file_stats: List[FileStat]) -> str:
+    """Compute a fingerprint of files from their path, size and
+    modification time (see `fingerprint_files`).
+
+    Parameters
+    ----------
+    file_stats : List[FileStat]
+        the resolved path, size and modification time of each file
+
+    Returns
+    -------
+    str
+        the fingerprint, as a hexadecimal string
+    """
+    fingerprint = hashlib.sha256()
+    for file_path, size, mtime_ns in file_stats:
+        fingerprint.update(f"{file_path}:{size}:{mtime_ns}\n".encode())
+    return fingerprint.hexdigest()[:16]
+
+
+def fingerprint_files(file_paths: List[Pathlike]) -> str:
+    """Compute a fingerprint of a list of files.
+
+    The fingerprint is based on the path, size and modification time of
+    each file (and their order), so it is cheap to compute and changes if
+    any file is added, removed, reordered or modified.
+
+    Parameters
+    ----------
+    file_paths : List[Pathlike]
+        the files to fingerprint
+
+    Returns
+    -------
+    str
+        the fingerprint, as a hexadecimal string
+    """
+    return fingerprint_file_stats(get_file_stats(file_paths))
+
+
+def convert_to_tiff_stack(
+    source_path: Pathlike,
+    cache_dir: Pathlike,
+    sort_input_file: bool = False,
+    n_threads: int = 8,
+) -> Path:
+    """Convert 2D TIFF planes into a single memory-mappable 3D TIFF stack.
+
+    The stack is saved uncompressed and contiguous in `cache_dir`, with
+    its name keyed by the fingerprint of the source files. If a stack with
+    the same fingerprint already exists, it is reused without reading the
+    source files. The stack is written to a temporary file first, so an
+    interrupted conversion is never reused.
+
+    Parameters
+    ----------
+    source_path : Pathlike
+        a directory of 2D TIFF planes, or a text file listing them. A
+        single 3D TIFF file is returned as is.
+    cache_dir : Pathlike
+        directory where the converted stacks are saved
+    sort_input_file : bool, optional
+        whether to sort the paths in a text file naturally, by default False
+    n_threads : int, optional
+        number of threads used to read the planes, by default 8
+
+    Returns
+    -------
+    Path
+        path to the 3D TIFF stack
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    file_paths = list_tiff_files(source_path, sort_input_file)
+    if len(file_paths) == 1 and Path(source_path).is_file():
+        return Path(source_path)
+
+    # each file is read, rather than the file manifest, so that planes
+    # modified in place are converted again
+    stack_path = Path(cache_dir) / (
+        f"{Path(source_path).stem}_{fingerprint_files(file_paths)}.tif"
+    )
+    if stack_path.exists():
+        logger.info(f"Reusing converted input data at {stack_path}")
+        return stack_path
+
+    logger.info(
+        f"Converting {len(file_paths)} planes from {source_path} "
+        f"to {stack_path}"
+    )
+    with tifffile.TiffFile(file_paths[0]) as tiff:
+        plane_shape = tiff.pages[0].shape
+        dtype = tiff.pages[0].dtype
+
+    stack_path.parent.mkdir(parents=True, exist_ok=True)
+    partial_path = stack_path.with_name(stack_path.name + ".partial")
+    stack = tifffile.memmap(
+        partial_path,
+        shape=(len(file_paths), *plane_shape),
+        dtype=dtype,
+        photometric="minisblack",
+        bigtiff=True,
+    )
+    # read the planes in blocks, to bound the number of planes in memory
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for start in range(0, len(file_paths), N_PLANES_PER_CONVERSION_BLOCK):
+            block = file_paths[start : start + N_PLANES_PER_CONVERSION_BLOCK]
+            for offset, plane in enumerate(
+                executor.map(tifffile.imread, block)
+            ):
+                stack[start + offset] = plane
+    stack.flush()
+    del stack
+
+    os.replace(partial_path, stack_path)
+    return stack_path
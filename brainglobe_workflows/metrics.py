@@ -0,0 +1,255 @@
+"""Record the resources used by each stage of a workflow run
+
+For each stage (e.g. read, detect, classify, save), the wall time, the CPU
+time, the peak resident memory (RSS) and the bytes read from and written to
+storage are recorded, and saved to a `run_metrics.json` file in the output
+directory. This is used to plan capacity and to spot regressions between
+releases.
+
+The instrumentation is cheap enough to leave on: the CPU time and I/O
+counters are read once at the start and end of each stage, and the peak
+memory is sampled by a background thread at a fixed interval.
+
+The CPU time, I/O and memory are measured for the whole process, not for
+the thread running a stage, as the stages run their work in other threads
+and processes (e.g. the worker threads of the classification, or the
+NiftyReg processes of the registration). So when stages run at the same
+time (e.g. with `--n-parallel-channels` or `--concurrent-registration` in
+brainmapper), the metrics of each stage include the work of the others: the
+stages running at the same time as a stage are listed in its
+"overlapping_stages", and its metrics are only its own when that is empty.
+The CPU time of child processes is only known once they exit, so it is
+recorded separately, in "children_cpu_time_s", for the stage during which
+they exit.
+"""
+
+import datetime
+import itertools
+import json
+import logging
+import os
+import platform
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import psutil
+
+Pathlike = Union[str, os.PathLike]
+
+RUN_METRICS_FILENAME = "run_metrics.json"
+RSS_SAMPLING_INTERVAL = 0.5  # seconds
+
+
+def _get_cpu_times() -> Tuple[float, float]:
+    """Get the CPU time used by this process and by its terminated children.
+
+    Returns
+    -------
+    Tuple[float, float]
+        user and system CPU time in seconds of all the threads of this
+        process, and of its children that have exited and been waited for
+    """
+    times = os.times()
+    return (
+        times.user + times.system,
+        times.children_user + times.children_system,
+    )
+
+
+def _get_io_counters(process: psutil.Process) -> Optional[tuple]:
+    """Get the bytes read from and written to storage by a process.
+
+    Returns
+    -------
+    Optional[tuple]
+        bytes read and written, or None if not supported on this platform
+    """
+    try:
+        counters = process.io_counters()
+    except (AttributeError, psutil.Error):
+        return None
+    return counters.read_bytes, counters.write_bytes
+
+
+def _get_total_rss(process: psutil.Process) -> int:
+    """Get the resident memory of a process and all its children.
+
+    Parameters
+    ----------
+    process : psutil.Process
+        the process
+
+    Returns
+    -------
+    int
+        resident memory in bytes
+    """
+    rss = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            rss += child.memory_info().rss
+        except psutil.Error:
+            # the child exited since it was listed
+            pass
+    return rss
+
+
+class _PeakRSSSampler(threading.Thread):
+    """A thread sampling the peak resident memory of a process tree.
+
+    The memory of child processes (e.g. the worker processes of cellfinder)
+    is added to that of the process.
+    """
+
+    def __init__(self, process: psutil.Process, interval: float):
+        super().__init__(daemon=True)
+        self.process = process
+        self.interval = interval
+        self.peak_rss = _get_total_rss(process)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, _get_total_rss(self.process))
+
+    def stop(self) -> int:
+        """Stop sampling and return the peak resident memory in bytes"""
+        self._stop_event.set()
+        self.join()
+        return max(self.peak_rss, _get_total_rss(self.process))
+
+
+class RunMetrics:
+    """Record the resources used by each stage of a workflow run.
+
+    Examples
+    --------
+    >>> metrics = RunMetrics()
+    >>> with metrics.stage("detect"):
+    ...     detect()
+    >>> metrics.save(output_dir)
+
+    Parameters
+    ----------
+    sampling_interval : float, optional
+        interval in seconds between the samples of the resident memory,
+        by default 0.5 s. Memory peaks shorter than this may be missed.
+    """
+
+    def __init__(self, sampling_interval: float = RSS_SAMPLING_INTERVAL):
+        self.sampling_interval = sampling_interval
+        self.stages: List[dict] = []
+        self._process = psutil.Process()
+        # the stages running, with the stages that overlapped each of them
+        self._running: Dict[int, Tuple[dict, List[dict]]] = {}
+        self._running_lock = threading.Lock()
+        self._stage_ids = itertools.count()
+
+    @contextmanager
+    def stage(self, name: str, **labels) -> Iterator[None]:
+        """Record the resources used by a stage.
+
+        The stage is only recorded if it completes without an exception.
+        The stages that run at the same time, in other threads, are saved
+        in its "overlapping_stages".
+
+        Parameters
+        ----------
+        name : str
+            name of the stage
+        **labels
+            additional fields to save with the stage metrics, e.g. the
+            signal channel
+        """
+        logger = logging.getLogger(__name__)
+        description = {"stage": name, **labels}
+        overlapping_stages: List[dict] = []
+        with self._running_lock:
+            for other_description, other_overlapping in self._running.values():
+                other_overlapping.append(description)
+                overlapping_stages.append(other_description)
+            stage_id = next(self._stage_ids)
+            self._running[stage_id] = (description, overlapping_stages)
+
+        sampler = _PeakRSSSampler(self._process, self.sampling_interval)
+        sampler.start()
+        start_io = _get_io_counters(self._process)
+        start_cpu_time, start_children_cpu_time = _get_cpu_times()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - start_time
+            end_cpu_time, end_children_cpu_time = _get_cpu_times()
+            end_io = _get_io_counters(self._process)
+            peak_rss = sampler.stop()
+            with self._running_lock:
+                del self._running[stage_id]
+
+        cpu_time = end_cpu_time - start_cpu_time
+        children_cpu_time = end_children_cpu_time - start_children_cpu_time
+
+        read_bytes, write_bytes = (
+            (end_io[0] - start_io[0], end_io[1] - start_io[1])
+            if start_io and end_io
+            else (None, None)
+        )
+        self.stages.append(
+            {
+                **description,
+                "wall_time_s": wall_time,
+                "cpu_time_s": cpu_time,
+                "children_cpu_time_s": children_cpu_time,
+                "peak_rss_bytes": peak_rss,
+                "read_bytes": read_bytes,
+                "write_bytes": write_bytes,
+                "overlapping_stages": overlapping_stages,
+            }
+        )
+        logger.debug(
+            f"Stage {name} took {wall_time:.2f} s "
+            f"(CPU time {cpu_time:.2f} s, "
+            f"children CPU time {children_cpu_time:.2f} s, "
+            f"peak RSS {peak_rss / 2**20:.0f} MiB)"
+        )
+
+    def to_dict(self) -> dict:
+        """Return the recorded metrics, with information about the host.
+
+        Returns
+        -------
+        dict
+            the metrics of each stage, under the "stages" key
+        """
+        return {
+            "created": datetime.datetime.now().isoformat(),
+            "host": {
+                "platform": platform.platform(),
+                "python_version": platform.python_version(),
+                "n_cpus": os.cpu_count(),
+                "total_memory_bytes": psutil.virtual_memory().total,
+            },
+            "stages": self.stages,
+        }
+
+    def save(self, output_dir: Pathlike) -> Path:
+        """Save the recorded metrics to `run_metrics.json`.
+
+        Parameters
+        ----------
+        output_dir : Pathlike
+            directory to save the metrics to
+
+        Returns
+        -------
+        Path
+            path to the saved metrics
+        """
+        metrics_path = Path(output_dir) / RUN_METRICS_FILENAME
+        metrics_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(metrics_path, "w") as f:
+            json.dump(self.to_dict(), f, indent=4)
+        return metrics_path
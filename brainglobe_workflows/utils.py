@@ -2,7 +2,7 @@ import argparse
 import logging
 import sys
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 
 DEFAULT_JSON_CONFIGS_PATH = Path(__file__).resolve().parent / "configs"
 
@@ -10,6 +10,11 @@ DEFAULT_JSON_CONFIG_PATH_CELLFINDER = (
     DEFAULT_JSON_CONFIGS_PATH / "cellfinder.json"
 )
 
+# name of the directory the input data is converted to 3D TIFF stacks in.
+# Defined here rather than in `image_io`, so that it can be used without
+# importing the image libraries.
+CONVERTED_DIRNAME = "converted"
+
 
 def setup_logger() -> logging.Logger:
     """Setup a logger for workflow runs
@@ -42,7 +47,7 @@ def setup_logger() -> logging.Logger:
 
 def config_parser(
     argv: List[str],
-    default_config: str,
+    default_config: Optional[str],
 ) -> argparse.Namespace:
     """Define argument parser for a workflow script.
 
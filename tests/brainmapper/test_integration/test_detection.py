@@ -1,4 +1,5 @@
 import os
+import shutil
 import sys
 from math import isclose
 from pathlib import Path
@@ -13,8 +14,7 @@ from brainglobe_workflows.brainmapper.main import (
 data_dir = Path(__file__).parents[3] / Path(
     "tests", "data", "integration", "detection"
 )
-signal_data = os.path.join(data_dir, "crop_planes", "ch0")
-background_data = os.path.join(data_dir, "crop_planes", "ch1")
+crop_planes_dir = os.path.join(data_dir, "crop_planes")
 cells_validation_xml = os.path.join(data_dir, "cell_classification.xml")
 
 x_pix = "2"
@@ -29,14 +29,19 @@ DETECTION_TOLERANCE = 2
 
 @pytest.mark.slow
 def test_detection_full(tmpdir):
+    # a copy of the data, as brainmapper caches the listing of the input
+    # directories next to them
+    input_dir = tmpdir / "crop_planes"
+    shutil.copytree(crop_planes_dir, input_dir)
+    output_dir = tmpdir / "output"
     cellfinder_args = [
         "cellfinder",
         "-s",
-        signal_data,
+        str(input_dir / "ch0"),
         "-b",
-        background_data,
+        str(input_dir / "ch1"),
         "-o",
-        str(tmpdir),
+        str(output_dir),
         "-v",
         z_pix,
         y_pix,
@@ -51,7 +56,7 @@ def test_detection_full(tmpdir):
     sys.argv = cellfinder_args
     cellfinder_run()
 
-    cells_test_xml = tmpdir / "points" / "cell_classification.xml"
+    cells_test_xml = output_dir / "points" / "cell_classification.xml"
 
     cells_validation = cell_io.get_cells(cells_validation_xml)
     cells_test = cell_io.get_cells(str(cells_test_xml))
@@ -75,5 +80,5 @@ def test_detection_full(tmpdir):
     # Check that planes are saved
     for i in range(2, 30):
         assert (
-            tmpdir / "processed_planes" / f"plane_{str(i).zfill(4)}.tif"
+            output_dir / "processed_planes" / f"plane_{str(i).zfill(4)}.tif"
         ).exists()
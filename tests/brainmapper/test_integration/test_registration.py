@@ -1,5 +1,6 @@
 import os
 import platform
+import shutil
 import sys
 
 import numpy as np
@@ -34,13 +35,17 @@ check_less_precise_pd = 1
 @pytest.mark.xfail(reason="Issues across machines")
 @pytest.mark.slow
 def test_registration_niftyreg(tmpdir):
+    # a copy of the data, as brainmapper caches the listing of the input
+    # directories next to them
+    input_dir = os.path.join(str(tmpdir), "brain")
+    shutil.copytree(data_dir, input_dir)
     output_directory = os.path.join(str(tmpdir), "output")
     cellfinder_args = [
         "cellfinder",
         "-s",
-        data_dir,
+        input_dir,
         "-b",
-        data_dir,
+        input_dir,
         "-o",
         output_directory,
         "-v",
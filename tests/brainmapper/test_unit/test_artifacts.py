@@ -0,0 +1,121 @@
+import os
+
+import numpy as np
+import tifffile
+from brainglobe_utils.cells.cells import Cell
+from brainglobe_utils.IO.cells import get_cells, save_cells
+
+from brainglobe_workflows.brainmapper.artifacts import (
+    ArtifactStore,
+    get_image_shape,
+)
+
+
+def test_artifact_store_eviction(tmp_path):
+    """
+    Test the least recently used artifacts are evicted once the store is
+    full, and artifacts larger than the store are not kept
+
+    Parameters
+    ----------
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    """
+    artifacts = ArtifactStore(max_bytes=250)
+    paths = []
+    for idx in range(3):
+        paths.append(tmp_path / f"{idx}.npy")
+        np.save(paths[-1], np.full(100, idx, dtype=np.uint8))
+    np.save(tmp_path / "large.npy", np.zeros(300, dtype=np.uint8))
+
+    n_loads = []
+
+    def load(path):
+        n_loads.append(path)
+        return np.load(path)
+
+    for path in [paths[0], paths[1], paths[0], paths[2], paths[0]]:
+        artifacts.get("array", path, lambda: load(path))
+    assert n_loads == [paths[0], paths[1], paths[2]]
+    assert artifacts.nbytes == 200
+
+    # paths[1] was the least recently used
+    artifacts.get("array", paths[1], lambda: load(paths[1]))
+    assert n_loads[-1] == paths[1]
+
+    artifacts.get("array", tmp_path / "large.npy", lambda: np.zeros(300))
+    assert artifacts.nbytes == 200
+
+
+def test_artifact_store_reloads_modified_files(tmp_path):
+    """
+    Test an artifact is read again once its file is modified
+
+    Parameters
+    ----------
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    """
+    artifacts = ArtifactStore()
+    image_path = tmp_path / "image.tif"
+
+    def load():
+        return tifffile.imread(image_path)
+
+    tifffile.imwrite(image_path, np.zeros((2, 3, 4), dtype=np.uint8))
+    assert artifacts.get("image", image_path, load).max() == 0
+
+    tifffile.imwrite(image_path, np.ones((2, 3, 4), dtype=np.uint8))
+    os.utime(image_path, ns=(0, 0))
+    assert artifacts.get("image", image_path, load).max() == 1
+
+
+def test_artifact_store_cells(tmp_path):
+    """
+    Test the cells are read from the saved file once, and the cells only
+    are selected from them
+
+    Parameters
+    ----------
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    """
+    cells = [
+        Cell((idx, 2 * idx, 3 * idx), [Cell.NO_CELL, Cell.CELL][idx % 3 == 0])
+        for idx in range(1, 10)
+    ]
+    cells_path = tmp_path / "cells.xml"
+    save_cells(cells, cells_path)
+
+    artifacts = ArtifactStore()
+
+    assert artifacts.get_cells(cells_path) == get_cells(str(cells_path))
+    assert artifacts.nbytes > 0
+    assert artifacts.get_cells(cells_path, cells_only=True) == get_cells(
+        str(cells_path), cells_only=True
+    )
+
+
+def test_get_image_shape(tmp_path):
+    """
+    Test the shape of an image is read from the TIFF header, for a 3D TIFF
+    file and a directory of 2D TIFF planes
+
+    Parameters
+    ----------
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    """
+    image = np.zeros((5, 6, 7), dtype=np.uint16)
+    tifffile.imwrite(tmp_path / "image.tiff", image)
+    (tmp_path / "planes").mkdir()
+    for idx, plane in enumerate(image):
+        tifffile.imwrite(tmp_path / "planes" / f"plane_{idx}.tif", plane)
+
+    assert get_image_shape(tmp_path / "image.tiff") == (5, 6, 7)
+    assert get_image_shape(tmp_path / "planes") == (5, 6, 7)
+    assert ArtifactStore().get_image_shape(tmp_path / "image.tiff") == (
+        5,
+        6,
+        7,
+    )
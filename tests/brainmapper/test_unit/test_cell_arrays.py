@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+from brainglobe_utils.cells.cells import Cell
+from brainglobe_utils.IO.cells import get_cells, save_cells
+
+from brainglobe_workflows.brainmapper.cell_arrays import (
+    CellArrays,
+    arrays_to_cells,
+    cells_to_arrays,
+    deal_with_artifacts,
+    export_cell_arrays_to_xml,
+    read_cell_arrays,
+    save_cell_arrays,
+)
+
+
+@pytest.fixture()
+def cells():
+    """
+    Cells of each type
+
+    Returns
+    -------
+    List[Cell]
+        the cells
+    """
+    cell_types = [Cell.CELL, Cell.NO_CELL, Cell.ARTIFACT]
+    return [
+        Cell((idx, 2 * idx, 3 * idx), cell_types[idx % 3])
+        for idx in range(1, 10)
+    ]
+
+
+@pytest.mark.parametrize("mmap", [False, True])
+def test_save_and_read_cell_arrays(tmp_path, cells, mmap):
+    """
+    Test cells saved as arrays are read back unchanged, with and without
+    memory-mapping, and the score column is optional
+
+    Parameters
+    ----------
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    cells : List[Cell]
+        the cells
+    mmap : bool
+        whether to memory-map the arrays
+    """
+    cell_arrays = cells_to_arrays(cells)
+    save_cell_arrays(cell_arrays, tmp_path / "cells.arrays")
+    read_arrays = read_cell_arrays(tmp_path / "cells.arrays", mmap=mmap)
+
+    assert read_arrays.score is None
+    assert isinstance(read_arrays.x, np.memmap) == mmap
+    assert arrays_to_cells(read_arrays) == cells
+    np.testing.assert_array_equal(
+        read_arrays.cells_only().zyx(),
+        [[c.z, c.y, c.x] for c in cells if c.type == Cell.CELL],
+    )
+
+    scores = np.linspace(0, 1, len(cells), dtype=np.float32)
+    save_cell_arrays(
+        cell_arrays._replace(score=scores), tmp_path / "cells.arrays"
+    )
+    np.testing.assert_array_equal(
+        read_cell_arrays(tmp_path / "cells.arrays").score, scores
+    )
+
+
+@pytest.mark.parametrize("artifact_keep", [True, False])
+def test_export_cell_arrays_to_xml(tmp_path, cells, artifact_keep):
+    """
+    Test the cells exported to XML are the same as those saved to XML
+    with brainglobe_utils (in any order), with the artifacts converted or
+    removed
+
+    Parameters
+    ----------
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    cells : List[Cell]
+        the cells
+    artifact_keep : bool
+        whether to keep the artifacts
+    """
+    save_cells(cells, tmp_path / "expected.xml", artifact_keep=artifact_keep)
+
+    cell_arrays = deal_with_artifacts(
+        cells_to_arrays(cells), artifact_keep=artifact_keep
+    )
+    save_cell_arrays(cell_arrays, tmp_path / "cells.arrays")
+    export_cell_arrays_to_xml(
+        tmp_path / "cells.arrays", tmp_path / "cells.xml"
+    )
+
+    def read_sorted(xml_path):
+        return sorted(
+            (c.x, c.y, c.z, c.type) for c in get_cells(str(xml_path))
+        )
+
+    assert read_sorted(tmp_path / "cells.xml") == read_sorted(
+        tmp_path / "expected.xml"
+    )
+    assert isinstance(cell_arrays, CellArrays)
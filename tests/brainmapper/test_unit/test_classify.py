@@ -0,0 +1,103 @@
+from argparse import Namespace
+
+import numpy as np
+import pytest
+from brainglobe_utils.cells.cells import Cell
+from cellfinder.core.classify import classify
+from cellfinder.core.classify.tools import get_model
+from cellfinder.core.train.train_yaml import models
+
+from brainglobe_workflows.brainmapper.cell_arrays import (
+    arrays_to_cells,
+    cells_to_arrays,
+)
+from brainglobe_workflows.brainmapper.classify import (
+    SharedClassificationInputs,
+    classify_points,
+)
+
+CLASSIFICATION_PARAMS = {
+    "n_free_cpus": 0,
+    "voxel_sizes": (5, 2, 2),
+    "network_voxel_sizes": (5, 1, 1),
+    "cube_height": 50,
+    "cube_width": 50,
+    "cube_depth": 20,
+}
+
+
+@pytest.fixture()
+def trained_model(tmp_path):
+    """
+    Save an untrained classification network, so that the tests do not
+    need to download the model weights
+
+    Parameters
+    ----------
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+
+    Returns
+    -------
+    Path
+        path to the saved network
+    """
+    model_path = tmp_path / "model.keras"
+    get_model(network_depth=models["18"]).save(model_path)
+    return model_path
+
+
+def test_classify_points(tmp_path, trained_model):
+    """
+    Test classifying with the shared background image and model gives the
+    same cells as cellfinder, and the model is only loaded once
+
+    Parameters
+    ----------
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    trained_model : Path
+        path to the saved network
+    """
+    rng = np.random.default_rng(0)
+    signal_array = rng.integers(0, 1000, (40, 100, 100), dtype=np.uint16)
+    background_array = rng.integers(0, 1000, (40, 100, 100), dtype=np.uint16)
+    points = [
+        Cell((int(x), int(y), int(z)), Cell.UNKNOWN)
+        for x, y, z in rng.integers((30, 30, 12), (70, 70, 28), (20, 3))
+    ]
+
+    expected_points = classify.main(
+        points,
+        signal_array,
+        background_array,
+        batch_size=8,
+        trained_model=trained_model,
+        model_weights=None,
+        network_depth="18",
+        **CLASSIFICATION_PARAMS,
+    )
+
+    args = Namespace(
+        background_planes_path=[str(tmp_path / "background")],
+        model_weights=trained_model,
+        install_path=None,
+        model="resnet50_tv",
+        trained_model=trained_model,
+        network_depth="18",
+        classification_batch_size=8,
+        pin_memory=False,
+        **CLASSIFICATION_PARAMS,
+    )
+    shared_inputs = SharedClassificationInputs(args)
+    shared_inputs._background_array = background_array
+    classified_points = classify_points(
+        cells_to_arrays(points), signal_array, shared_inputs, args
+    )
+
+    assert arrays_to_cells(classified_points) == expected_points
+    assert np.all(
+        (classified_points.score >= 0.5)
+        == (classified_points.type == Cell.CELL)
+    )
+    assert shared_inputs.get_network() is shared_inputs.get_network()
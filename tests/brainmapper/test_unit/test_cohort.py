@@ -0,0 +1,98 @@
+import json
+
+import pandas as pd
+import pytest
+from brainglobe_atlasapi import BrainGlobeAtlas
+
+from brainglobe_workflows.brainmapper.cohort import (
+    REGION_COUNTS_FILENAME,
+    run_cohort_analysis,
+)
+from brainglobe_workflows.brainmapper.prep import Paths
+from brainglobe_workflows.brainmapper.synthetic import (
+    ROOT_ID,
+    generate_synthetic_atlas,
+    generate_synthetic_registration,
+)
+
+N_CELLS = [50, 80, 120]
+
+
+@pytest.fixture()
+def atlas(tmp_path):
+    atlas_name = generate_synthetic_atlas(
+        tmp_path / "brainglobe", shape=(20, 12, 16), n_regions=3
+    )
+    return BrainGlobeAtlas(
+        atlas_name, brainglobe_dir=tmp_path / "brainglobe", check_latest=False
+    )
+
+
+@pytest.fixture()
+def brain_dirs(tmp_path, atlas):
+    return [
+        generate_synthetic_registration(
+            tmp_path / f"brain_{idx}", atlas, n_cells=n_cells, seed=idx
+        )
+        for idx, n_cells in enumerate(N_CELLS)
+    ]
+
+
+@pytest.mark.parametrize("n_processes", [1, 2])
+def test_run_cohort_analysis(tmp_path, atlas, brain_dirs, n_processes):
+    """
+    Test the cohort analysis counts the cells of each brain in each region,
+    as the analysis of each brain, with the brains analysed in turn and in
+    parallel processes
+
+    Parameters
+    ----------
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    n_processes : int
+        number of brains analysed at the same time
+    """
+    region_counts = run_cohort_analysis(
+        brain_dirs, tmp_path / "cohort", atlas, n_processes=n_processes
+    )
+
+    names = [brain_dir.name for brain_dir in brain_dirs]
+    pd.testing.assert_frame_equal(
+        pd.read_csv(tmp_path / "cohort" / REGION_COUNTS_FILENAME),
+        region_counts,
+        check_dtype=False,
+    )
+    # the temporary atlas index is removed
+    assert [p.name for p in (tmp_path / "cohort").iterdir()] == [
+        REGION_COUNTS_FILENAME
+    ]
+    root = region_counts[region_counts.structure_id == ROOT_ID]
+    assert root[names].values.tolist() == [N_CELLS]
+
+    for brain_dir, name in zip(brain_dirs, names):
+        brain_paths = Paths(str(brain_dir))
+        brain_paths.make_channel_specific_paths()
+        summary = pd.read_csv(brain_paths.summary_csv)
+        hierarchy_summary = pd.read_csv(brain_paths.summary_hierarchy_csv)
+        assert summary.total_cells.sum() == N_CELLS[names.index(name)]
+        assert (
+            region_counts.set_index("structure_id")[name]
+            .loc[hierarchy_summary.structure_id]
+            .tolist()
+            == hierarchy_summary.total_cells.tolist()
+        )
+
+
+def test_run_cohort_analysis_other_atlas(tmp_path, atlas, brain_dirs):
+    """
+    Test the cohort analysis fails for brains registered to another atlas
+    """
+    metadata_path = Paths(str(brain_dirs[1])).metadata_path
+    with open(metadata_path) as f:
+        metadata = json.load(f)
+    metadata["atlas"] = "allen_mouse_25um"
+    with open(metadata_path, "w") as f:
+        json.dump(metadata, f)
+
+    with pytest.raises(ValueError, match="allen_mouse_25um"):
+        run_cohort_analysis(brain_dirs, tmp_path / "cohort", atlas)
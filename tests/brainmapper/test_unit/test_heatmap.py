@@ -0,0 +1,154 @@
+from pathlib import Path
+
+import ngff_zarr as nz
+import numpy as np
+import pandas as pd
+import pytest
+import tifffile
+from brainglobe_utils.image.heatmap import heatmap_from_points
+
+from brainglobe_workflows.brainmapper.heatmap import (
+    generate_heatmaps,
+    get_heatmap_paths,
+)
+
+IMAGE_SHAPE = (40, 36, 33)
+RESOLUTION = 25
+
+
+@pytest.fixture()
+def points():
+    rng = np.random.default_rng(0)
+    # some points fall outside the image, or on its far edges
+    points = rng.uniform(-0.05, 1.05, (2000, 3)) * IMAGE_SHAPE
+    points[:10] = IMAGE_SHAPE
+    return points
+
+
+@pytest.fixture()
+def mask_image():
+    mask_image = np.zeros(IMAGE_SHAPE, dtype=np.uint32)
+    mask_image[5:35, 4:30, 3:30] = 7
+    return mask_image
+
+
+@pytest.mark.parametrize("table", [True, False])
+@pytest.mark.parametrize("mask_shape", [None, IMAGE_SHAPE, (20, 18, 11)])
+@pytest.mark.parametrize("max_bytes", [None, 0])
+def test_generate_heatmaps(
+    tmp_path, points, mask_image, table, mask_shape, max_bytes
+):
+    """
+    Test the heatmaps generated in memory, or in slabs, are the same as
+    those of brainglobe_utils, to within rounding, for several smoothing
+    values, with and without a mask (of the shape of the heatmap or not),
+    and from points saved as an HDF table or not
+
+    Parameters
+    ----------
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    table : bool
+        whether the points are saved as an HDF table
+    mask_shape : tuple or None
+        shape of the mask image, or None for no mask
+    max_bytes : int or None
+        memory budget, None to generate the heatmaps in memory and 0 to
+        generate them in slabs
+    """
+    points_path = tmp_path / "downsampled.points"
+    pd.DataFrame(points).to_hdf(
+        points_path, key="df", format="table" if table else "fixed"
+    )
+    if mask_shape is None:
+        mask_image = None
+        mask_image_path = None
+    else:
+        mask_image = mask_image[tuple(slice(0, n) for n in mask_shape)]
+        mask_image_path = tmp_path / "registered_atlas.tiff"
+        tifffile.imwrite(mask_image_path, mask_image)
+    smoothings = [100, None, 50]
+
+    tiff_paths = generate_heatmaps(
+        points_path,
+        RESOLUTION,
+        IMAGE_SHAPE,
+        tmp_path / "figures" / "heatmap.tiff",
+        smoothings,
+        mask_image_path=mask_image_path,
+        max_bytes=max_bytes,
+        points_chunk_size=300,
+        slab_size=4,
+        stripe_size=16,
+    )
+
+    assert [path.name for path in tiff_paths] == [
+        "heatmap.tiff",
+        "heatmap_no_smoothing.tiff",
+        "heatmap_smoothing_50um.tiff",
+    ]
+    for smoothing, tiff_path in zip(smoothings, tiff_paths):
+        expected = heatmap_from_points(
+            points,
+            RESOLUTION,
+            IMAGE_SHAPE,
+            smoothing=smoothing,
+            mask_image=mask_image,
+        )
+        heatmap = tifffile.imread(tiff_path)
+        assert heatmap.dtype == np.uint16
+        np.testing.assert_allclose(heatmap, expected, atol=1)
+    # only the heatmaps are saved, and the temporary images are removed
+    assert sorted((tmp_path / "figures").iterdir()) == sorted(tiff_paths)
+
+
+@pytest.mark.parametrize("max_bytes", [None, 0])
+def test_generate_heatmaps_pyramid(tmp_path, points, max_bytes):
+    """
+    Test the heatmaps are also saved as multi-resolution pyramids, with
+    the TIFF heatmap at full resolution
+
+    Parameters
+    ----------
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    max_bytes : int or None
+        memory budget, None to generate the heatmaps in memory and 0 to
+        generate them in slabs
+    """
+    points_path = tmp_path / "downsampled.points"
+    pd.DataFrame(points).to_hdf(points_path, key="df", format="table")
+
+    tiff_paths = generate_heatmaps(
+        points_path,
+        RESOLUTION,
+        IMAGE_SHAPE,
+        tmp_path / "figures" / "heatmap.tiff",
+        [100, None],
+        pyramid=True,
+        max_bytes=max_bytes,
+        slab_size=4,
+        stripe_size=16,
+    )
+
+    for tiff_path in tiff_paths:
+        pyramid = nz.from_ngff_zarr(str(tiff_path.with_suffix(".zarr")))
+        assert [image.data.shape for image in pyramid.images] == [
+            IMAGE_SHAPE,
+            (20, 18, 16),
+        ]
+        np.testing.assert_array_equal(
+            pyramid.images[0].data, tifffile.imread(tiff_path)
+        )
+    assert len(list((tmp_path / "figures").iterdir())) == 2 * len(tiff_paths)
+
+
+def test_get_heatmap_paths():
+    assert get_heatmap_paths("figures/heatmap.tiff", 100, first=True) == (
+        Path("figures/heatmap.tiff"),
+        Path("figures/heatmap.zarr"),
+    )
+    assert get_heatmap_paths("figures/heatmap.tiff", 12.5, first=False) == (
+        Path("figures/heatmap_smoothing_12.5um.tiff"),
+        Path("figures/heatmap_smoothing_12.5um.zarr"),
+    )
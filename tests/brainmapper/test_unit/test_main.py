@@ -0,0 +1,153 @@
+from argparse import Namespace
+
+import pytest
+
+from brainglobe_workflows.brainmapper import main
+from brainglobe_workflows.brainmapper.prep import Paths
+
+
+@pytest.mark.parametrize(
+    "n_free_cpus, registration_n_cpus, expected_n_free_cpus",
+    [
+        (0, None, (4, 4)),
+        (2, None, (5, 5)),
+        (0, 2, (6, 2)),
+        (6, None, (7, 7)),
+        (7, None, (7, 7)),
+        (0, 10, (0, 7)),
+    ],
+)
+def test_get_concurrent_n_free_cpus(
+    monkeypatch, n_free_cpus, registration_n_cpus, expected_n_free_cpus
+):
+    """
+    Test the CPU cores are split between the registration and the cell
+    detection, and each gets at least one core
+
+    Parameters
+    ----------
+    monkeypatch : pytest.MonkeyPatch
+        Pytest fixture to set the number of CPU cores of the machine
+    n_free_cpus : int
+        number of CPU cores to leave unused
+    registration_n_cpus : int
+        number of CPU cores requested for the registration
+    expected_n_free_cpus : Tuple[int, int]
+        expected number of CPU cores to leave free for the registration,
+        and for the cell detection
+    """
+    monkeypatch.setattr(main.os, "cpu_count", lambda: 8)
+    assert (
+        main.get_concurrent_n_free_cpus(n_free_cpus, registration_n_cpus)
+        == expected_n_free_cpus
+    )
+
+
+@pytest.mark.parametrize(
+    "n_free_cpus, n_parallel_channels, expected_n_free_cpus",
+    [(0, 1, 0), (0, 2, 4), (0, 3, 6), (2, 2, 5), (6, 4, 7)],
+)
+def test_get_parallel_n_free_cpus(
+    monkeypatch, n_free_cpus, n_parallel_channels, expected_n_free_cpus
+):
+    """
+    Test the CPU cores are split between the channels processed in
+    parallel, and each gets at least one core
+
+    Parameters
+    ----------
+    monkeypatch : pytest.MonkeyPatch
+        Pytest fixture to set the number of CPU cores of the machine
+    n_free_cpus : int
+        number of CPU cores to leave unused
+    n_parallel_channels : int
+        number of channels processed at the same time
+    expected_n_free_cpus : int
+        expected number of CPU cores to leave free for each channel
+    """
+    monkeypatch.setattr(main.os, "cpu_count", lambda: 8)
+    assert (
+        main.get_parallel_n_free_cpus(n_free_cpus, n_parallel_channels)
+        == expected_n_free_cpus
+    )
+
+
+def test_get_channel_args(tmp_path):
+    """
+    Test the args of a channel point to its signal data and output
+    directory, without modifying the args of the run
+
+    Parameters
+    ----------
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    """
+    args = Namespace(
+        signal_planes_paths=["signal_0", "signal_1"],
+        output_dir=str(tmp_path),
+        paths=Paths(str(tmp_path)),
+    )
+
+    channel_args = main.get_channel_args(args, str(tmp_path), "signal_1", 1)
+    channel_args.paths.output_dir = channel_args.output_dir
+
+    assert channel_args.signal_planes_paths == ["signal_1", "signal_1"]
+    assert channel_args.signal_channel == 1
+    assert channel_args.output_dir == str(tmp_path / "channel_1")
+    assert (tmp_path / "channel_1").is_dir()
+    assert args.signal_planes_paths == ["signal_0", "signal_1"]
+    assert args.output_dir == str(tmp_path)
+    assert args.paths.output_dir == str(tmp_path)
+
+
+@pytest.mark.parametrize("n_parallel_channels", [1, 2])
+def test_run_for_each_channel(tmp_path, n_parallel_channels):
+    """
+    Test each channel is run with its own args and copy of what_to_run,
+    sequentially and in parallel, without modifying the args of the run
+
+    Parameters
+    ----------
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    n_parallel_channels : int
+        number of channels processed at the same time
+    """
+    signal_planes_paths = ["signal_0", "signal_1"]
+    args = Namespace(
+        signal_planes_paths=list(signal_planes_paths),
+        signal_ch_ids=[0, 1],
+        output_dir=str(tmp_path),
+        paths=Paths(str(tmp_path)),
+        n_free_cpus=0,
+    )
+    what_to_run = Namespace()
+    runs = []
+
+    def function(channel_args, channel_what_to_run):
+        runs.append(
+            (
+                channel_args.signal_channel,
+                channel_args.signal_planes_paths[0],
+                channel_args.output_dir,
+            )
+        )
+        assert channel_args is not args
+        assert channel_what_to_run is not what_to_run
+
+    main.run_for_each_channel(
+        function,
+        args,
+        what_to_run,
+        str(tmp_path),
+        signal_planes_paths,
+        n_parallel_channels,
+    )
+
+    assert sorted(runs) == [
+        (0, "signal_0", str(tmp_path / "channel_0")),
+        (1, "signal_1", str(tmp_path / "channel_1")),
+    ]
+    assert args.signal_planes_paths == signal_planes_paths
+    assert args.output_dir == str(tmp_path)
+    assert not hasattr(args, "signal_channel")
@@ -0,0 +1,69 @@
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+import pytest
+from brainreg.core import cli as brainreg_cli
+
+from brainglobe_workflows.brainmapper import parser
+
+
+@pytest.mark.parametrize(
+    "brainmapper_parse, brainreg_parse",
+    [
+        (parser.atlas_parse, brainreg_cli.atlas_parse),
+        (parser.backend_parse, brainreg_cli.backend_parse),
+        (parser.geometry_parse, brainreg_cli.geometry_parser),
+    ],
+)
+def test_brainreg_options_match(brainmapper_parse, brainreg_parse):
+    """
+    Test the brainreg options defined in the brainmapper parser match those
+    of brainreg
+
+    Parameters
+    ----------
+    brainmapper_parse : Callable
+        function adding the options to the brainmapper parser
+    brainreg_parse : Callable
+        function adding the options to the brainreg parser
+    """
+
+    def get_options(parse):
+        actions = parse(ArgumentParser())._actions[1:]  # skip help
+        return [
+            (a.dest, a.option_strings, a.type, a.default, a.required)
+            for a in actions
+        ]
+
+    assert get_options(brainmapper_parse) == get_options(brainreg_parse)
+
+
+def test_entry_point_imports_are_light():
+    """
+    Test parsing the brainmapper command line does not import the image,
+    atlas or cellfinder libraries
+    """
+    heavy_modules = [
+        "brainglobe_atlasapi",
+        "brainreg.core.main",
+        "cellfinder.core.main",
+        "dask",
+        "tifffile",
+        "torch",
+    ]
+    code = (
+        "import sys\n"
+        "from brainglobe_workflows.brainmapper import main, prep\n"
+        "prep.brainmapper_parser().parse_args("
+        "['-s', 's', '-b', 'b', '-o', 'o', '-v', '5', '2', '2', "
+        "'--orientation', 'asr'])\n"
+        f"print([m for m in {heavy_modules!r} if m in sys.modules])\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    assert result.stdout.strip() == "[]"
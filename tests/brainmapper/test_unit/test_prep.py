@@ -1,6 +1,9 @@
 import os
+from argparse import Namespace
 
+import numpy as np
 import pytest
+import tifffile
 from brainglobe_utils.general.exceptions import CommandLineInputError
 
 from brainglobe_workflows.brainmapper import prep
@@ -36,6 +39,30 @@ def test_check_return_ch_ids():
         assert prep.check_and_return_ch_ids(signal_ch, 3, signal_list)
 
 
+def test_prep_input_conversion(tmp_path):
+    for channel in ["signal", "background"]:
+        os.mkdir(tmp_path / channel)
+        for z in range(3):
+            tifffile.imwrite(
+                tmp_path / channel / f"{z}.tif",
+                np.full((4, 5), z, dtype=np.uint16),
+            )
+    args = Namespace(
+        signal_planes_paths=[str(tmp_path / "signal")],
+        background_planes_path=[str(tmp_path / "background")],
+        sort_input_file=False,
+        paths=prep.Paths(str(tmp_path / "output")),
+    )
+
+    args = prep.prep_input_conversion(args)
+
+    for path in args.signal_planes_paths + args.background_planes_path:
+        assert os.path.dirname(path) == args.paths.converted_input_folder
+        stack = tifffile.imread(path)
+        assert stack.shape == (3, 4, 5)
+        assert list(stack[:, 0, 0]) == [0, 1, 2]
+
+
 class Args:
     def __init__(
         self,
@@ -0,0 +1,207 @@
+import os
+
+import numpy as np
+import pytest
+import tifffile
+from brainreg.core.paths import Paths as BrainRegPaths
+
+from brainglobe_workflows.brainmapper import prep, stages
+from brainglobe_workflows.brainmapper.parser import brainmapper_parser
+
+STAGE_NAMES = list(stages.STAGES)
+
+
+@pytest.fixture(autouse=True)
+def default_model_weights(tmp_path, monkeypatch):
+    """
+    Write the default model weights, and return their path, so they are not
+    downloaded
+    """
+    from cellfinder.core.tools import prep as cellfinder_prep
+
+    weights_path = tmp_path / "model_weights.h5"
+    weights_path.write_bytes(b"weights")
+    monkeypatch.setattr(
+        cellfinder_prep,
+        "prep_model_weights",
+        lambda model_weights, install_path, model_name: weights_path,
+    )
+    return weights_path
+
+
+@pytest.fixture()
+def get_args(tmp_path):
+    """
+    Get the brainmapper arguments for a signal and a background image, with
+    extra command line options
+    """
+    for name in ("signal", "background"):
+        tifffile.imwrite(
+            tmp_path / f"{name}.tiff", np.zeros((4, 5, 6), dtype=np.uint16)
+        )
+
+    def get_args(*options):
+        args = brainmapper_parser().parse_args(
+            [
+                "-s",
+                str(tmp_path / "signal.tiff"),
+                "-b",
+                str(tmp_path / "background.tiff"),
+                "-o",
+                str(tmp_path / "output"),
+                "-v",
+                "5",
+                "2",
+                "2",
+                "--orientation",
+                "psl",
+                *options,
+            ]
+        )
+        args.paths = prep.Paths(args.output_dir)
+        args.signal_ch_ids, args.background_ch_id = (
+            prep.check_and_return_ch_ids(
+                args.signal_ch_ids,
+                args.background_ch_id,
+                args.signal_planes_paths,
+            )
+        )
+        args.brainreg_paths = BrainRegPaths(
+            args.paths.registration_output_folder
+        )
+        args.signal_channel = args.signal_ch_ids[0]
+        return args
+
+    return get_args
+
+
+def plan(args):
+    """Get the stages that run for the args."""
+    what_to_run = prep.CalcWhatToRun(args)
+    args, what_to_run = prep.prep_channel_specific_general(args, what_to_run)
+    return [name for name in STAGE_NAMES if getattr(what_to_run, name)]
+
+
+def run(args):
+    """
+    Run the stages that need to run for the args, by writing their outputs,
+    and return them.
+    """
+    what_to_run = prep.CalcWhatToRun(args)
+    args, what_to_run = prep.prep_channel_specific_general(args, what_to_run)
+    ran = []
+    for name in STAGE_NAMES:
+        if getattr(what_to_run, name):
+            what_to_run.start_stage(name, args)
+            for path in stages.get_stage_outputs(name, args):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "a") as f:
+                    f.write(name)
+            what_to_run.complete_stage(name, args)
+            ran.append(name)
+    return ran
+
+
+@pytest.mark.parametrize(
+    "options, expected_stages",
+    [
+        ([], []),
+        (["--heatmap-smoothing", "50", "100"], ["figures"]),
+        (["--no-mask-figs"], ["figures"]),
+        (
+            ["--tiled-threshold", "5"],
+            ["detect", "classify", "analyse", "figures"],
+        ),
+        (["--cube-width", "40"], ["classify", "analyse", "figures"]),
+        (["--atlas", "allen_mouse_10um"], ["register", "analyse", "figures"]),
+        # parameters that do not change the outputs
+        (["--n-free-cpus", "3", "--detection-batch-size", "2"], []),
+    ],
+)
+def test_parameter_changes(get_args, options, expected_stages):
+    """
+    Test that once the stages have run, only the stages whose parameters,
+    or whose upstream stages, change run again
+
+    Parameters
+    ----------
+    get_args : Callable
+        Fixture to get the brainmapper arguments with extra options
+    options : List[str]
+        extra command line options of the second run
+    expected_stages : List[str]
+        stages expected to run again
+    """
+    assert run(get_args()) == STAGE_NAMES
+    assert plan(get_args()) == []
+    assert plan(get_args(*options)) == expected_stages
+
+
+def test_missing_outputs_and_input_changes(get_args):
+    """
+    Test the stages run again if their outputs are missing, or their input
+    data change, and not if the outputs of a stage they read are written
+    again with the same parameters
+    """
+    args = get_args()
+    run(args)
+
+    os.remove(args.paths.heatmap)
+    assert plan(get_args()) == ["figures"]
+
+    os.remove(args.paths.detected_points)
+    assert run(get_args()) == ["detect", "figures"]
+
+    # a stage that does not complete leaves no record
+    what_to_run = prep.CalcWhatToRun(args)
+    what_to_run.start_stage("classify", args)
+    assert plan(get_args()) == ["classify"]
+    run(get_args())
+
+    stat = os.stat(args.background_planes_path[0])
+    os.utime(
+        args.background_planes_path[0],
+        ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9),
+    )
+    assert plan(get_args()) == ["register", "classify", "analyse", "figures"]
+
+
+def test_disabled_stages(get_args):
+    """
+    Test stages disabled on the command line do not run, and the outputs
+    they left (e.g. of an external registration, with no record) are read
+    by the later stages
+    """
+    assert plan(get_args("--no-register")) == ["detect", "classify"]
+
+    args = get_args("--no-register")
+    for path in stages.get_stage_outputs("register", args):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, "w").close()
+    assert run(args) == ["detect", "classify", "analyse", "figures"]
+    assert plan(get_args("--no-register")) == []
+
+    # the registration has no record, so it runs if enabled
+    assert plan(get_args()) == ["register", "analyse", "figures"]
+    assert plan(get_args("--no-register", "--no-analyse")) == []
+
+
+def test_default_model_weights_changes(get_args, default_model_weights):
+    """
+    Test the cells are classified again if the default model weights, used
+    when no model is given, change
+
+    Parameters
+    ----------
+    get_args : Callable
+        Fixture to get the brainmapper arguments with extra options
+    default_model_weights : Path
+        Fixture providing the path to the default model weights
+    """
+    run(get_args())
+    assert plan(get_args()) == []
+
+    default_model_weights.write_bytes(b"new weights")
+    assert plan(get_args()) == ["classify", "analyse", "figures"]
+    # the classification does not need the default weights if disabled
+    assert plan(get_args("--no-classification")) == []
@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+import pytest
+from brainglobe_atlasapi import BrainGlobeAtlas
+from brainglobe_utils.brainmapper import analysis as brainglobe_analysis
+
+from brainglobe_workflows.brainmapper.summary import (
+    get_structure_table,
+    roll_up_counts,
+    summarise_points_by_atlas_region,
+)
+from brainglobe_workflows.brainmapper.synthetic import (
+    ROOT_ID,
+    generate_synthetic_atlas,
+)
+
+
+@pytest.fixture()
+def atlas(tmp_path):
+    atlas_name = generate_synthetic_atlas(
+        tmp_path / "brainglobe", shape=(20, 12, 16), n_regions=3
+    )
+    return BrainGlobeAtlas(
+        atlas_name, brainglobe_dir=tmp_path / "brainglobe", check_latest=False
+    )
+
+
+@pytest.fixture()
+def volume_csv_path(tmp_path, atlas):
+    volume_csv_path = tmp_path / "volumes.csv"
+    names = [s["name"] for s in atlas.structures.values()]
+    pd.DataFrame(
+        {
+            "structure_name": names,
+            "left_volume_mm3": np.linspace(0.5, 1, len(names)),
+            "right_volume_mm3": np.linspace(1, 0.5, len(names)),
+            "total_volume_mm3": 1.5,
+        }
+    ).to_csv(volume_csv_path, index=False)
+    return volume_csv_path
+
+
+def test_summarise_points_by_atlas_region(tmp_path, atlas, volume_csv_path):
+    """
+    Test the vectorised summary is the same as that of brainglobe_utils,
+    including points outside the brain and outside the atlas
+    """
+    rng = np.random.default_rng(0)
+    atlas_points = (rng.uniform(0, 1.1, (500, 3)) * atlas.shape).astype(
+        np.int32
+    )
+    raw_points = 2 * atlas_points + 1
+
+    expected_all_points, expected_summary = (
+        brainglobe_analysis.summarise_points_by_atlas_region(
+            raw_points,
+            atlas_points,
+            atlas,
+            volume_csv_path,
+            tmp_path / "expected_all_points.csv",
+            tmp_path / "expected_summary.csv",
+        )
+    )
+    all_points, summary, hierarchy_summary = summarise_points_by_atlas_region(
+        raw_points,
+        atlas_points,
+        atlas,
+        volume_csv_path,
+        tmp_path / "all_points.csv",
+        tmp_path / "summary.csv",
+        tmp_path / "summary_hierarchy.csv",
+    )
+
+    assert 0 < len(expected_all_points) < len(atlas_points)
+    pd.testing.assert_frame_equal(
+        all_points, expected_all_points, check_dtype=False
+    )
+    pd.testing.assert_frame_equal(
+        summary.reset_index(drop=True),
+        expected_summary.reset_index(drop=True),
+    )
+    for filename in ("all_points.csv", "summary.csv"):
+        assert (tmp_path / filename).read_text() == (
+            tmp_path / f"expected_{filename}"
+        ).read_text()
+
+    # the root counts all the points, as the regions are its children
+    root = hierarchy_summary[hierarchy_summary.structure_id == ROOT_ID]
+    assert root.total_cells.item() == len(all_points)
+    assert root.left_cell_count.item() == np.count_nonzero(
+        all_points.hemisphere == "left"
+    )
+    pd.testing.assert_frame_equal(
+        pd.read_csv(tmp_path / "summary_hierarchy.csv"),
+        hierarchy_summary,
+        check_dtype=False,
+    )
+
+
+def test_roll_up_counts(atlas):
+    """
+    Test each structure counts the cells of all its substructures
+    """
+    structure_table = get_structure_table(atlas)
+    counts = np.arange(2 * structure_table.n_structures).reshape(-1, 2)
+
+    rolled_up = roll_up_counts(counts, structure_table)
+
+    root = structure_table.get_indices(np.array([ROOT_ID]))[0]
+    np.testing.assert_array_equal(rolled_up[root], counts.sum(axis=0))
+    children = np.flatnonzero(structure_table.parent_ids == ROOT_ID)
+    assert len(children) == 3
+    np.testing.assert_array_equal(rolled_up[children], counts[children])
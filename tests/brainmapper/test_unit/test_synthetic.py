@@ -0,0 +1,72 @@
+from argparse import Namespace
+
+import pandas as pd
+import tifffile
+from brainglobe_atlasapi import BrainGlobeAtlas
+from brainglobe_utils.IO.cells import get_cells
+from brainreg.core.paths import Paths as BrainRegPaths
+
+from brainglobe_workflows.brainmapper import analyse, prep
+from brainglobe_workflows.brainmapper.main import (
+    generate_heatmap,
+    get_downsampled_space,
+)
+from brainglobe_workflows.brainmapper.synthetic import (
+    SYNTHETIC_ORIENTATION,
+    SYNTHETIC_SIGNAL_FILENAME,
+    generate_synthetic_atlas,
+    generate_synthetic_registration,
+)
+
+
+def test_analyse_synthetic_registration(tmp_path):
+    """
+    Test the brainmapper analysis and heatmap run on the synthetic
+    registration outputs, and all the cells are assigned to a region
+
+    Parameters
+    ----------
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    """
+    atlas_name = generate_synthetic_atlas(
+        tmp_path / "brainglobe", shape=(40, 24, 32), n_regions=4
+    )
+    atlas = BrainGlobeAtlas(
+        atlas_name, brainglobe_dir=tmp_path / "brainglobe", check_latest=False
+    )
+    input_dir = generate_synthetic_registration(
+        tmp_path / "input", atlas, n_cells=100
+    )
+
+    args = Namespace(
+        signal_planes_paths=[str(input_dir / SYNTHETIC_SIGNAL_FILENAME)],
+        orientation=SYNTHETIC_ORIENTATION,
+        voxel_sizes=[50, 50, 50],
+        paths=prep.Paths(str(tmp_path / "output")),
+        brainreg_paths=BrainRegPaths(str(input_dir / "registration")),
+        mask_figures=True,
+        heatmap_smooth=100,
+        heatmap_pyramid=False,
+        max_ram=None,
+    )
+    args.paths.make_channel_specific_paths()
+    (tmp_path / "output" / "points").mkdir(parents=True)
+    input_paths = prep.Paths(str(input_dir))
+    input_paths.make_channel_specific_paths()
+    cells = get_cells(input_paths.classified_points, cells_only=True)
+
+    downsampled_space = get_downsampled_space(
+        atlas, args.brainreg_paths.boundaries_file_path
+    )
+    assert downsampled_space.shape == atlas.shape
+
+    analyse.run(args, cells, atlas, downsampled_space)
+    summary = pd.read_csv(args.paths.summary_csv)
+    assert summary["total_cells"].sum() == 100
+    assert set(summary["structure_name"]) == {
+        f"region {idx}" for idx in range(1, 5)
+    }
+
+    generate_heatmap(args, atlas, downsampled_space)
+    assert tifffile.imread(args.paths.heatmap).shape == atlas.shape
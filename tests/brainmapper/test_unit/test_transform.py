@@ -0,0 +1,84 @@
+import brainglobe_space as bgs
+import numpy as np
+import pandas as pd
+import pytest
+import tifffile
+from brainglobe_atlasapi import BrainGlobeAtlas
+from brainglobe_utils.brainreg import transform as brainglobe_transform
+
+from brainglobe_workflows.brainmapper.synthetic import generate_synthetic_atlas
+from brainglobe_workflows.brainmapper.transform import (
+    transform_points_to_atlas_space,
+)
+
+
+@pytest.mark.parametrize("chunk_size", [7, 1000])
+def test_transform_points_to_atlas_space(tmp_path, chunk_size):
+    """
+    Test the points transformed in chunks, with memory-mapped deformation
+    fields, are the same as those transformed by brainglobe_utils,
+    including points outside the deformation fields
+
+    Parameters
+    ----------
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    chunk_size : int
+        number of points transformed at a time
+    """
+    atlas_name = generate_synthetic_atlas(
+        tmp_path / "brainglobe", shape=(20, 12, 16), n_regions=2
+    )
+    atlas = BrainGlobeAtlas(
+        atlas_name, brainglobe_dir=tmp_path / "brainglobe", check_latest=False
+    )
+    rng = np.random.default_rng(0)
+    deformation_field_paths = []
+    for axis in range(3):
+        deformation_field_paths.append(tmp_path / f"field_{axis}.tiff")
+        tifffile.imwrite(
+            deformation_field_paths[-1],
+            rng.uniform(0, 2, atlas.shape).astype(np.float32),
+        )
+    raw_shape = (40, 24, 32)
+    tifffile.imwrite(tmp_path / "signal.tif", shape=raw_shape, dtype=np.uint16)
+    downsampled_space = bgs.AnatomicalSpace(
+        "asr", shape=atlas.shape, resolution=atlas.resolution
+    )
+    # some points fall outside the fields
+    points = rng.uniform(0, 1.1, (100, 3)) * raw_shape
+
+    expected_points, expected_out_of_bounds = (
+        brainglobe_transform.transform_points_to_atlas_space(
+            points,
+            tmp_path / "signal.tif",
+            "asr",
+            [50, 50, 50],
+            downsampled_space,
+            atlas,
+            deformation_field_paths,
+            downsampled_points_path=tmp_path / "expected_downsampled.points",
+            atlas_points_path=tmp_path / "expected_atlas.points",
+        )
+    )
+    atlas_points, in_bounds = transform_points_to_atlas_space(
+        points,
+        tmp_path / "signal.tif",
+        "asr",
+        [50, 50, 50],
+        downsampled_space,
+        atlas,
+        deformation_field_paths,
+        downsampled_points_path=tmp_path / "downsampled.points",
+        atlas_points_path=tmp_path / "atlas.points",
+        chunk_size=chunk_size,
+    )
+
+    assert 0 < len(expected_out_of_bounds) < len(points)
+    assert np.count_nonzero(in_bounds) == len(expected_points)
+    np.testing.assert_array_equal(atlas_points, expected_points)
+    for filename in ("downsampled.points", "atlas.points"):
+        np.testing.assert_array_equal(
+            pd.read_hdf(tmp_path / filename).values,
+            pd.read_hdf(tmp_path / f"expected_{filename}").values,
+        )
@@ -1,4 +1,11 @@
+import json
+from pathlib import Path
+
+import numpy as np
 import pytest
+import tifffile
+
+from brainglobe_workflows.utils import DEFAULT_JSON_CONFIG_PATH_CELLFINDER
 
 
 @pytest.fixture()
@@ -13,3 +20,45 @@ def custom_logger_name() -> str:
     from brainglobe_workflows.utils import __name__ as logger_name
 
     return logger_name
+
+
+@pytest.fixture()
+def config_synthetic_dict(tmp_path: Path) -> dict:
+    """Return a config dictionary for a small synthetic volume with
+    bright blobs, saved as directories of 2D TIFF planes
+
+    Parameters
+    ----------
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+
+    Returns
+    -------
+    dict
+        dictionary with the config for a cellfinder workflow run on the
+        synthetic volume, with the detection cache enabled
+    """
+    rng = np.random.default_rng(seed=0)
+    signal = rng.normal(100, 5, size=(30, 64, 64))
+    zz, yy, xx = np.mgrid[:30, :64, :64]
+    for z, y, x in [(15, 20, 20), (15, 44, 40)]:
+        blob = ((zz - z) * 5) ** 2 + ((yy - y) * 2) ** 2 + ((xx - x) * 2) ** 2
+        signal[blob < 8**2] = 1000
+
+    for channel, volume in [
+        ("signal", signal),
+        ("background", np.full(signal.shape, 100)),
+    ]:
+        (tmp_path / channel).mkdir()
+        for z, plane in enumerate(volume.astype(np.uint16)):
+            tifffile.imwrite(tmp_path / channel / f"{z:02d}.tif", plane)
+
+    with open(DEFAULT_JSON_CONFIG_PATH_CELLFINDER) as cfg:
+        config_dict = json.load(cfg)
+    config_dict.update(
+        input_data_dir=str(tmp_path),
+        output_parent_dir=str(tmp_path / "output"),
+        n_sds_above_mean_thresh=5,
+        cache_detection=True,
+    )
+    return config_dict
@@ -0,0 +1,208 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from brainglobe_workflows.utils import DEFAULT_JSON_CONFIG_PATH_CELLFINDER
+
+
+@pytest.fixture()
+def manifest_input_dirs_json(tmp_path: Path) -> Path:
+    """
+    Fixture that returns a batch manifest as a JSON file path, that defines
+    the samples from one config and a list of input data directories
+
+    Parameters
+    ----------
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+
+    Returns
+    -------
+    Path
+        path to a batch manifest JSON file
+    """
+    manifest_path = tmp_path / "manifest.json"
+    with open(manifest_path, "w") as js:
+        json.dump(
+            {
+                "config": str(DEFAULT_JSON_CONFIG_PATH_CELLFINDER),
+                "input_data_dirs": [
+                    str(tmp_path / "brain_1"),
+                    str(tmp_path / "brain_2"),
+                    str(tmp_path / "other" / "brain_1"),
+                ],
+                "output_parent_dir": str(tmp_path / "output"),
+            },
+            js,
+        )
+    return manifest_path
+
+
+@pytest.fixture()
+def manifest_configs_json(config_local_json: Path, tmp_path: Path) -> Path:
+    """
+    Fixture that returns a batch manifest as a JSON file path, that lists
+    one config per sample, each pointing to local data as input
+
+    Parameters
+    ----------
+    config_local_json : Path
+        path to a cellfinder config JSON file that points to local data
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+
+    Returns
+    -------
+    Path
+        path to a batch manifest JSON file
+    """
+    manifest_path = tmp_path / "manifest.json"
+    with open(manifest_path, "w") as js:
+        json.dump(
+            {
+                "configs": [str(config_local_json), str(config_local_json)],
+                "output_parent_dir": str(tmp_path / "output"),
+                "n_processes": 2,
+            },
+            js,
+        )
+    return manifest_path
+
+
+def test_read_batch_manifest(manifest_input_dirs_json: Path, tmp_path: Path):
+    """
+    Test a manifest with one config and a list of input data directories is
+    expanded into one config per sample, with unique sample names
+
+    Parameters
+    ----------
+    manifest_input_dirs_json : Path
+        path to a batch manifest JSON file
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    """
+    from brainglobe_workflows.cellfinder.batch import read_batch_manifest
+
+    manifest = read_batch_manifest(manifest_input_dirs_json)
+
+    assert list(manifest["samples"].keys()) == [
+        "brain_1",
+        "brain_2",
+        "brain_1_1",
+    ]
+    for sample_name, config_dict in manifest["samples"].items():
+        assert config_dict["output_parent_dir"] == str(tmp_path / "output")
+        assert config_dict["output_dir_basename"].endswith(f"{sample_name}_")
+    assert manifest["samples"]["brain_2"]["input_data_dir"] == str(
+        tmp_path / "brain_2"
+    )
+
+
+def test_read_batch_manifest_invalid(tmp_path: Path):
+    """
+    Test an error is raised if the manifest does not define the samples
+
+    Parameters
+    ----------
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    """
+    from brainglobe_workflows.cellfinder.batch import read_batch_manifest
+
+    manifest_path = tmp_path / "manifest.json"
+    with open(manifest_path, "w") as js:
+        json.dump({"config": str(DEFAULT_JSON_CONFIG_PATH_CELLFINDER)}, js)
+
+    with pytest.raises(ValueError, match="must define either"):
+        read_batch_manifest(manifest_path)
+
+
+def test_batch_parser_requires_manifest(capsys: pytest.CaptureFixture):
+    """
+    Test the batch manifest is a required command line argument
+
+    Parameters
+    ----------
+    capsys : pytest.CaptureFixture
+        Pytest fixture capturing the standard output and error
+    """
+    from brainglobe_workflows.cellfinder.batch import batch_parser
+
+    assert batch_parser(["--config", "manifest.json"]).config == (
+        "manifest.json"
+    )
+    with pytest.raises(SystemExit):
+        batch_parser([])
+    assert "--config" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize(
+    "n_cores, n_samples, n_free_cpus, n_processes, expected",
+    [
+        (32, 10, 2, None, (3, 22)),
+        (32, 2, 2, None, (2, 17)),
+        (32, 10, 2, 5, (5, 26)),
+        (4, 10, 2, None, (1, 2)),
+    ],
+)
+def test_compute_batch_resources(
+    n_cores: int,
+    n_samples: int,
+    n_free_cpus: int,
+    n_processes: int,
+    expected: tuple,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    """
+    Test the size of the process pool and the CPU share of each sample
+
+    Parameters
+    ----------
+    n_cores : int
+        number of CPU cores in the machine
+    n_samples : int
+        number of samples in the batch
+    n_free_cpus : int
+        number of CPU cores to leave free for the whole batch
+    n_processes : int
+        maximum number of samples to run concurrently
+    expected : tuple
+        expected number of processes and free cores per sample
+    monkeypatch : pytest.MonkeyPatch
+        a monkeypatch fixture
+    """
+    from brainglobe_workflows.cellfinder import batch
+
+    monkeypatch.setattr(batch, "get_cores_available", lambda: n_cores)
+
+    assert (
+        batch.compute_batch_resources(
+            n_samples, n_free_cpus, n_processes=n_processes
+        )
+        == expected
+    )
+
+
+def test_main(manifest_configs_json: Path, tmp_path: Path):
+    """
+    Test running the cellfinder workflow on a batch of samples
+
+    Parameters
+    ----------
+    manifest_configs_json : Path
+        path to a batch manifest JSON file
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    """
+    from brainglobe_workflows.cellfinder.batch import main
+
+    summary_df = main(str(manifest_configs_json))
+
+    # check one output file per sample
+    assert summary_df["error"].isna().all()
+    for output_path in summary_df["output_path"]:
+        assert (Path(output_path) / "detected_cells.xml").is_file()
+
+    # check batch summary is saved
+    assert len(list((tmp_path / "output").glob("batch_summary_*.csv"))) == 1
@@ -18,10 +18,10 @@ def config_force_GIN_dict(
     """
     Fixture returning a config as a dictionary, which has a
     Pytest-generated temporary directory as input data location,
-    and that monkeypatches pooch.retrieve()
+    and that monkeypatches the GIN data fetching function
 
     Since there is no data at the input_data_dir location, the GIN download
-    will be triggered, but the monkeypatched pooch.retrieve() will copy the
+    will be triggered, but the monkeypatched fetching function will copy the
     files rather than download them.
 
     Parameters
@@ -45,7 +45,7 @@ def config_force_GIN_dict(
 
     import shutil
 
-    import pooch
+    import brainglobe_workflows.cellfinder.cellfinder as cellfinder_workflow
 
     # read GIN config as dict
     config_dict = config_GIN_dict.copy()
@@ -53,10 +53,10 @@ def config_force_GIN_dict(
     # point to a temporary directory in input_data_dir
     config_dict["input_data_dir"] = str(tmp_path)
 
-    # monkeypatch pooch.retrieve()
+    # monkeypatch fetch_and_extract_archive()
     # when called copy GIN downloaded data, instead of downloading it
-    def mock_pooch_download(
-        url="", known_hash="", path="", progressbar="", processor=""
+    def mock_fetch_and_extract_archive(
+        url="", known_hash="", archive_dir="", extract_dir=""
     ):
         # Copy destination
         GIN_copy_destination = tmp_path
@@ -77,8 +77,12 @@ def config_force_GIN_dict(
 
         return list_of_files
 
-    # monkeypatch pooch.retreive with mock_pooch_download()
-    monkeypatch.setattr(pooch, "retrieve", mock_pooch_download)
+    # monkeypatch fetch_and_extract_archive with the mock function
+    monkeypatch.setattr(
+        cellfinder_workflow,
+        "fetch_and_extract_archive",
+        mock_fetch_and_extract_archive,
+    )
 
     return config_dict
 
@@ -207,8 +211,9 @@ def test_add_input_paths(
     # instantiate custom logger
     _ = setup_logger()
 
-    # instantiate config object
-    _ = CellfinderConfig(**request.getfixturevalue(input_config_dict))
+    # instantiate config object and fetch input data
+    cfg = CellfinderConfig(**request.getfixturevalue(input_config_dict))
+    cfg.prepare()
 
     # check log messages
     assert len(caplog.messages) > 0
@@ -217,6 +222,45 @@ def test_add_input_paths(
     assert out.group() is not None
 
 
+def test_config_is_lazy(default_input_config_cellfinder: Path, tmp_path: Path):
+    """
+    Test creating a config does not fetch input data or create the output
+    directory, until it is prepared
+
+    Parameters
+    ----------
+    default_input_config_cellfinder : Path
+        Path to the default cellfinder config json file, which defines the
+        URL and hash of the GIN data
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    """
+    from brainglobe_workflows.cellfinder.cellfinder import CellfinderConfig
+
+    with open(default_input_config_cellfinder) as cfg:
+        config_dict = json.load(cfg)
+    config_dict.update(
+        input_data_dir=tmp_path / "input",
+        output_parent_dir=tmp_path / "output",
+    )
+
+    # the input data is not available locally, but it is not downloaded
+    cfg = CellfinderConfig(**config_dict)
+
+    assert cfg._signal_dir_path == tmp_path / "input" / "signal"
+    assert cfg._detected_cells_path.parent == cfg._output_path
+    assert cfg._list_signal_files is None
+    assert list(tmp_path.iterdir()) == []
+
+    # the input data is listed and the output directory created on prepare
+    for channel in ["signal", "background"]:
+        (tmp_path / "input" / channel).mkdir(parents=True)
+    cfg.prepare()
+
+    assert cfg._list_signal_files == []
+    assert Path(cfg._output_path).is_dir()
+
+
 @pytest.mark.parametrize(
     "input_config_path, message",
     [
@@ -373,3 +417,94 @@ def test_run_workflow_from_cellfinder_run(
 
     # check output files exist
     assert Path(cfg._detected_cells_path).is_file()
+    assert (Path(cfg._output_path) / "run_metrics.json").is_file()
+
+
+def test_get_detection_cache_key(config_synthetic_dict: dict):
+    """
+    Test the detection cache key changes with the detection parameters and
+    the input data, but not with the classification parameters
+
+    Parameters
+    ----------
+    config_synthetic_dict : dict
+        dictionary with the config for a cellfinder workflow run on a
+        synthetic volume
+    """
+    import tifffile
+
+    from brainglobe_workflows.cellfinder.cellfinder import (
+        CellfinderConfig,
+        get_detection_cache_key,
+    )
+
+    key = get_detection_cache_key(CellfinderConfig(**config_synthetic_dict))
+
+    for param, value, same_key in [
+        ("classification_batch_size", 8, True),
+        ("trained_model", "model.h5", True),
+        ("ball_z_size", 10, False),
+        ("n_sds_above_mean_thresh", 6, False),
+        ("end_plane", 20, False),
+    ]:
+        cfg = CellfinderConfig(**{**config_synthetic_dict, param: value})
+        assert (get_detection_cache_key(cfg) == key) == same_key, param
+
+    # modify the input data
+    plane_path = Path(config_synthetic_dict["input_data_dir"]) / "signal"
+    tifffile.imwrite(
+        plane_path / "00.tif", tifffile.imread(plane_path / "00.tif")
+    )
+    cfg = CellfinderConfig(**config_synthetic_dict)
+    assert get_detection_cache_key(cfg) != key
+
+
+def test_detect_cell_candidates_cache(
+    config_synthetic_dict: dict, monkeypatch: pytest.MonkeyPatch
+):
+    """
+    Test the cell candidates are cached, and reused by a later run with the
+    same detection parameters without running detection again
+
+    Parameters
+    ----------
+    config_synthetic_dict : dict
+        dictionary with the config for a cellfinder workflow run on a
+        synthetic volume
+    monkeypatch : pytest.MonkeyPatch
+        a monkeypatch fixture
+    """
+    import brainglobe_workflows.cellfinder.cellfinder as cellfinder_workflow
+
+    cfg = cellfinder_workflow.CellfinderConfig(**config_synthetic_dict)
+    signal_array, background_array = cellfinder_workflow.read_input_data(cfg)
+    candidates = cellfinder_workflow.detect_cell_candidates(
+        cfg, signal_array, background_array
+    )
+
+    cache_dir = (
+        Path(cfg.output_parent_dir)
+        / cellfinder_workflow.DETECTION_CACHE_DIRNAME
+    )
+    assert len(candidates) > 0
+    assert [f.name for f in cache_dir.iterdir()] == [
+        f"candidates_{cellfinder_workflow.get_detection_cache_key(cfg)}.xml"
+    ]
+
+    # a later run with a different classification parameter reuses the cache
+    def fail_cellfinder_run(**kwargs):
+        raise AssertionError("Detection should be skipped")
+
+    monkeypatch.setattr(
+        cellfinder_workflow, "cellfinder_run", fail_cellfinder_run
+    )
+    cfg = cellfinder_workflow.CellfinderConfig(
+        **{**config_synthetic_dict, "classification_batch_size": 8}
+    )
+    cached_candidates = cellfinder_workflow.detect_cell_candidates(
+        cfg, signal_array, background_array
+    )
+
+    assert sorted((c.x, c.y, c.z) for c in cached_candidates) == sorted(
+        (c.x, c.y, c.z) for c in candidates
+    )
@@ -0,0 +1,288 @@
+import hashlib
+import io
+import logging
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+import brainglobe_workflows.fetch as fetch
+from brainglobe_workflows.fetch import (
+    fetch_and_extract_archive,
+    get_hash_sidecar_path,
+)
+from brainglobe_workflows.utils import __name__ as LOGGER_NAME
+
+ARCHIVE_MEMBERS = {
+    "signal/plane_0.tif": b"signal 0" * 1000,
+    "signal/plane_1.tif": b"signal 1" * 1000,
+    "background/plane_0.tif": b"background 0" * 1000,
+}
+
+
+class ArchiveServer(ThreadingHTTPServer):
+    """A local HTTP server for one archive, supporting range requests.
+
+    If `drop_after` is set, the first response is cut after that many
+    bytes, to simulate a network drop.
+    """
+
+    def __init__(self, archive: bytes, drop_after: int = 0):
+        super().__init__(("127.0.0.1", 0), ArchiveRequestHandler)
+        self.archive = archive
+        self.drop_after = drop_after
+        self.range_headers = []
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/data.zip"
+
+
+class ArchiveRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        archive = self.server.archive
+        range_header = self.headers.get("Range")
+        self.server.range_headers.append(range_header)
+
+        start = 0
+        if range_header:
+            start = int(range_header.removeprefix("bytes=").split("-")[0])
+            if start >= len(archive):
+                self.send_response(416)
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", f"bytes {start}-{len(archive) - 1}/*"
+            )
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(archive) - start))
+        self.end_headers()
+
+        body = archive[start:]
+        if self.server.drop_after:
+            body = body[: self.server.drop_after]
+            self.server.drop_after = 0
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_archive(compression: int, seekable: bool = True) -> bytes:
+    """Make a zip archive of the test members
+
+    Parameters
+    ----------
+    compression : int
+        zip compression method
+    seekable : bool, optional
+        whether to write the archive to a seekable stream, by default True.
+        Archives written to non-seekable streams use data descriptors.
+
+    Returns
+    -------
+    bytes
+        the zip archive
+    """
+
+    class NonSeekableBytesIO(io.BytesIO):
+        def seek(self, *args):
+            raise OSError("not seekable")
+
+    buffer = io.BytesIO() if seekable else NonSeekableBytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=compression) as archive:
+        for name, data in ARCHIVE_MEMBERS.items():
+            with archive.open(name, "w") as member:
+                member.write(data)
+    return buffer.getvalue()
+
+
+@pytest.fixture()
+def archive() -> bytes:
+    """Return a deflate-compressed zip archive of the test members
+
+    Returns
+    -------
+    bytes
+        the zip archive
+    """
+    return make_archive(zipfile.ZIP_DEFLATED)
+
+
+@pytest.fixture()
+def serve():
+    """Return a function that serves an archive from a local HTTP server
+
+    The servers are shut down after the test.
+
+    Yields
+    ------
+    Callable
+        a function that takes the archive and the number of bytes after
+        which to drop the first response, and returns the server
+    """
+    servers = []
+
+    def _serve(archive: bytes, drop_after: int = 0) -> ArchiveServer:
+        server = ArchiveServer(archive, drop_after)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield _serve
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def check_extracted(extract_dir: Path, file_paths: list):
+    """Check the archive members were extracted to `extract_dir`"""
+    assert sorted(file_paths) == sorted(
+        str((extract_dir / name).resolve()) for name in ARCHIVE_MEMBERS
+    )
+    for name, data in ARCHIVE_MEMBERS.items():
+        assert (extract_dir / name).read_bytes() == data
+    assert not list(extract_dir.parent.glob("*.partial"))
+
+
+@pytest.mark.parametrize(
+    "compression, seekable",
+    [
+        (zipfile.ZIP_DEFLATED, True),
+        (zipfile.ZIP_STORED, True),
+        (zipfile.ZIP_DEFLATED, False),
+        (zipfile.ZIP_STORED, False),  # not extracted while downloading
+    ],
+)
+def test_fetch_and_extract_archive(
+    compression: int, seekable: bool, serve, tmp_path: Path
+):
+    """
+    Test an archive is downloaded, verified and extracted
+
+    Parameters
+    ----------
+    compression : int
+        zip compression method
+    seekable : bool
+        whether the archive is written to a seekable stream
+    serve : Callable
+        function to serve an archive from a local HTTP server
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    """
+    archive = make_archive(compression, seekable)
+    server = serve(archive)
+
+    file_paths = fetch_and_extract_archive(
+        server.url,
+        hashlib.sha256(archive).hexdigest(),
+        archive_dir=tmp_path,
+        extract_dir=tmp_path / "data",
+    )
+
+    check_extracted(tmp_path / "data", file_paths)
+    assert (tmp_path / "data.zip").read_bytes() == archive
+    assert get_hash_sidecar_path(tmp_path / "data.zip").exists()
+
+
+def test_fetch_resumes_download(
+    archive: bytes, serve, tmp_path: Path, caplog: pytest.LogCaptureFixture
+):
+    """
+    Test a dropped download is resumed from the bytes already downloaded
+
+    Parameters
+    ----------
+    archive : bytes
+        the zip archive
+    serve : Callable
+        function to serve an archive from a local HTTP server
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    caplog : pytest.LogCaptureFixture
+        Pytest fixture to capture the logs
+    """
+    caplog.set_level(logging.DEBUG, logger=LOGGER_NAME)
+    server = serve(archive, drop_after=len(archive) // 2)
+
+    file_paths = fetch_and_extract_archive(
+        server.url,
+        f"sha256:{hashlib.sha256(archive).hexdigest()}",
+        archive_dir=tmp_path,
+        extract_dir=tmp_path / "data",
+    )
+
+    check_extracted(tmp_path / "data", file_paths)
+    assert server.range_headers == [None, f"bytes={len(archive) // 2}-"]
+    # logged to the workflow logger, so it is in the workflow log
+    assert [
+        record.name
+        for record in caplog.records
+        if record.message.startswith("Resuming download")
+    ] == [LOGGER_NAME]
+
+
+def test_fetch_verified_archive(
+    archive: bytes, serve, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    """
+    Test a verified archive is extracted again without downloading or
+    hashing it
+
+    Parameters
+    ----------
+    archive : bytes
+        the zip archive
+    serve : Callable
+        function to serve an archive from a local HTTP server
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    monkeypatch : pytest.MonkeyPatch
+        a monkeypatch fixture
+    """
+    server = serve(archive)
+    known_hash = hashlib.sha256(archive).hexdigest()
+    fetch_and_extract_archive(
+        server.url, known_hash, tmp_path, tmp_path / "data"
+    )
+
+    def fail_hash_file(*args):
+        raise AssertionError("The verified archive should not be hashed")
+
+    monkeypatch.setattr(fetch, "hash_file", fail_hash_file)
+    file_paths = fetch_and_extract_archive(
+        server.url, known_hash, tmp_path, tmp_path / "data_copy"
+    )
+
+    check_extracted(tmp_path / "data_copy", file_paths)
+    assert len(server.range_headers) == 1
+
+
+def test_fetch_hash_mismatch(archive: bytes, serve, tmp_path: Path):
+    """
+    Test an error is raised if the archive does not match the known hash,
+    and no files are extracted
+
+    Parameters
+    ----------
+    archive : bytes
+        the zip archive
+    serve : Callable
+        function to serve an archive from a local HTTP server
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    """
+    server = serve(archive)
+
+    with pytest.raises(ValueError, match="does not match the known hash"):
+        fetch_and_extract_archive(
+            server.url, "0" * 64, tmp_path, tmp_path / "data"
+        )
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == []
@@ -0,0 +1,385 @@
+import json
+import logging
+from pathlib import Path
+
+import dask.array as da
+import numpy as np
+import pytest
+import tifffile
+import zarr
+from brainglobe_utils.IO.image.load import read_z_stack
+
+from brainglobe_workflows import image_io
+from brainglobe_workflows.image_io import (
+    convert_to_tiff_stack,
+    fingerprint_file_stats,
+    fingerprint_files,
+    get_fallback_file_manifest_path,
+    get_file_manifest_path,
+    get_file_stats,
+    list_files,
+    list_tiff_file_stats,
+    list_tiff_files,
+    read_tiff_with_dask,
+    read_zarr_with_dask,
+)
+from brainglobe_workflows.utils import DEFAULT_JSON_CONFIG_PATH_CELLFINDER
+from brainglobe_workflows.utils import __name__ as LOGGER_NAME
+
+
+@pytest.fixture()
+def volume() -> np.ndarray:
+    """Return a small 3D volume, in z, y, x order
+
+    Returns
+    -------
+    np.ndarray
+        a 3D volume
+    """
+    return np.arange(4 * 5 * 6, dtype=np.uint16).reshape(4, 5, 6)
+
+
+@pytest.fixture()
+def ome_zarr_path(volume: np.ndarray, tmp_path: Path) -> Path:
+    """Write a two-level OME-Zarr store, with (t, c, z, y, x) arrays
+
+    Parameters
+    ----------
+    volume : np.ndarray
+        a 3D volume
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+
+    Returns
+    -------
+    Path
+        path to the OME-Zarr store
+    """
+    store_path = tmp_path / "signal.zarr"
+    group = zarr.open_group(str(store_path), mode="w")
+    for level, array in enumerate([volume, volume[:, ::2, ::2]]):
+        group.create_array(
+            str(level),
+            data=array[np.newaxis, np.newaxis],
+            chunks=(1, 1, 1) + array.shape[1:],
+        )
+    group.attrs["multiscales"] = [{"datasets": [{"path": "0"}, {"path": "1"}]}]
+    return store_path
+
+
+@pytest.fixture()
+def tiff_planes_dir(volume: np.ndarray, tmp_path: Path) -> Path:
+    """Write a volume as a directory of 2D TIFF planes
+
+    Parameters
+    ----------
+    volume : np.ndarray
+        a 3D volume
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+
+    Returns
+    -------
+    Path
+        path to the directory of 2D TIFF planes
+    """
+    planes_dir = tmp_path / "signal"
+    planes_dir.mkdir()
+    for z, plane in enumerate(volume):
+        # unpadded indices, to check the planes are sorted naturally
+        tifffile.imwrite(planes_dir / f"plane_{z}.tif", plane)
+    return planes_dir
+
+
+@pytest.mark.parametrize("resolution_level", [0, 1])
+def test_read_ome_zarr(
+    ome_zarr_path: Path, volume: np.ndarray, resolution_level: int
+):
+    """
+    Test reading a resolution level of an OME-Zarr store as a 3D dask array
+
+    Parameters
+    ----------
+    ome_zarr_path : Path
+        path to the OME-Zarr store
+    volume : np.ndarray
+        the full resolution volume in the store
+    resolution_level : int
+        resolution level to read
+    """
+    array = read_zarr_with_dask(
+        ome_zarr_path, resolution_level=resolution_level
+    )
+
+    assert isinstance(array, da.Array)
+    step = 2**resolution_level
+    np.testing.assert_array_equal(array, volume[:, ::step, ::step])
+
+
+def test_read_zarr_array_path(ome_zarr_path: Path, volume: np.ndarray):
+    """
+    Test reading an array from a zarr store given its path in the store
+
+    Parameters
+    ----------
+    ome_zarr_path : Path
+        path to the OME-Zarr store
+    volume : np.ndarray
+        the full resolution volume in the store
+    """
+    array = read_zarr_with_dask(ome_zarr_path, array_path="0")
+    np.testing.assert_array_equal(array, volume)
+
+
+def test_read_zarr_invalid_level(ome_zarr_path: Path):
+    """
+    Test an error is raised for a resolution level not in the store
+
+    Parameters
+    ----------
+    ome_zarr_path : Path
+        path to the OME-Zarr store
+    """
+    with pytest.raises(ValueError, match="Resolution level 2 not found"):
+        read_zarr_with_dask(ome_zarr_path, resolution_level=2)
+
+
+def test_read_input_data_zarr(
+    volume: np.ndarray, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    """
+    Test the cellfinder workflow reads zarr input data lazily
+
+    Parameters
+    ----------
+    volume : np.ndarray
+        a 3D volume
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    monkeypatch : pytest.MonkeyPatch
+        a monkeypatch fixture
+    """
+    from brainglobe_workflows.cellfinder.cellfinder import (
+        CellfinderConfig,
+        read_input_data,
+    )
+
+    for channel in ["signal", "background"]:
+        zarr.save_array(str(tmp_path / f"{channel}.zarr"), volume)
+
+    with open(DEFAULT_JSON_CONFIG_PATH_CELLFINDER) as cfg:
+        config_dict = json.load(cfg)
+    config_dict.update(
+        input_data_dir=str(tmp_path),
+        signal_subdir="signal.zarr",
+        background_subdir="background.zarr",
+        input_data_format="zarr",
+        output_parent_dir=str(tmp_path / "output"),
+    )
+    config = CellfinderConfig(**config_dict)
+
+    signal_array, background_array = read_input_data(config)
+
+    assert isinstance(signal_array, da.Array)
+    np.testing.assert_array_equal(signal_array, volume)
+    np.testing.assert_array_equal(background_array, volume)
+
+
+def test_convert_to_tiff_stack(
+    tiff_planes_dir: Path, volume: np.ndarray, tmp_path: Path
+):
+    """
+    Test 2D TIFF planes are converted into a memory-mappable 3D TIFF stack
+
+    Parameters
+    ----------
+    tiff_planes_dir : Path
+        path to the directory of 2D TIFF planes
+    volume : np.ndarray
+        the volume in the 2D TIFF planes
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    """
+    stack_path = convert_to_tiff_stack(tiff_planes_dir, tmp_path / "cache")
+
+    assert stack_path.parent == tmp_path / "cache"
+    assert not list(stack_path.parent.glob("*.partial"))
+    stack = read_z_stack(str(stack_path))
+    assert isinstance(stack, np.memmap)
+    np.testing.assert_array_equal(stack, volume)
+
+
+def test_convert_to_tiff_stack_cache(
+    tiff_planes_dir: Path, tmp_path: Path, caplog: pytest.LogCaptureFixture
+):
+    """
+    Test a converted stack is reused while the source planes are unchanged,
+    and converted again if they are modified
+
+    Parameters
+    ----------
+    tiff_planes_dir : Path
+        path to the directory of 2D TIFF planes
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    caplog : pytest.LogCaptureFixture
+        Pytest fixture to capture the logs
+    """
+    caplog.set_level(logging.DEBUG, logger=LOGGER_NAME)
+    cache_dir = tmp_path / "cache"
+    stack_path = convert_to_tiff_stack(tiff_planes_dir, cache_dir)
+    mtime = stack_path.stat().st_mtime_ns
+
+    assert convert_to_tiff_stack(tiff_planes_dir, cache_dir) == stack_path
+    assert stack_path.stat().st_mtime_ns == mtime
+    # logged to the workflow logger, so it is in the workflow log
+    assert [
+        record.name
+        for record in caplog.records
+        if record.message.startswith("Reusing converted input data")
+    ] == [LOGGER_NAME]
+
+    # modify a plane
+    new_plane = np.ones((5, 6), dtype=np.uint16)
+    tifffile.imwrite(tiff_planes_dir / "plane_0.tif", new_plane)
+    new_stack_path = convert_to_tiff_stack(tiff_planes_dir, cache_dir)
+
+    assert new_stack_path != stack_path
+    np.testing.assert_array_equal(read_z_stack(str(new_stack_path))[0], 1)
+
+
+def test_convert_to_tiff_stack_single_file(volume: np.ndarray, tmp_path: Path):
+    """
+    Test a single 3D TIFF file is not converted
+
+    Parameters
+    ----------
+    volume : np.ndarray
+        a 3D volume
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    """
+    tiff_path = tmp_path / "signal.tif"
+    tifffile.imwrite(tiff_path, volume, photometric="minisblack")
+
+    assert convert_to_tiff_stack(tiff_path, tmp_path / "cache") == tiff_path
+    assert not (tmp_path / "cache").exists()
+
+
+def test_list_files_manifest(tiff_planes_dir: Path):
+    """
+    Test the file manifest of a directory is saved next to it, reused while
+    the directory is unchanged, and updated when a file is added
+
+    Parameters
+    ----------
+    tiff_planes_dir : Path
+        path to the directory of 2D TIFF planes
+    """
+    file_paths = list_files(tiff_planes_dir)
+
+    manifest_path = get_file_manifest_path(tiff_planes_dir)
+    assert manifest_path.parent == tiff_planes_dir.parent
+    assert [f.name for f in file_paths] == [f"plane_{z}.tif" for z in range(4)]
+
+    # the cached manifest is reused, without scanning the directory
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    manifest["files"] = manifest["files"][:1]
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+    assert list_files(tiff_planes_dir) == file_paths[:1]
+
+    # adding a file changes the directory modification time
+    tifffile.imwrite(tiff_planes_dir / "plane_4.tif", np.zeros((5, 6)))
+    assert [f.name for f in list_files(tiff_planes_dir)] == [
+        f"plane_{z}.tif" for z in range(5)
+    ]
+
+
+def test_list_files_manifest_fallback(
+    tiff_planes_dir: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    """
+    Test the file manifest of a directory is saved to, and reused from, the
+    cache directory if it cannot be saved next to the directory
+
+    Parameters
+    ----------
+    tiff_planes_dir : Path
+        path to the directory of 2D TIFF planes
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    monkeypatch : pytest.MonkeyPatch
+        Pytest fixture to set the cache directory, and a manifest path next
+        to the directory that cannot be written
+    """
+    monkeypatch.setattr(
+        image_io, "FILE_MANIFEST_CACHE_DIR", tmp_path / "manifest_cache"
+    )
+    # a manifest path in a "directory" that is a file, as root can write
+    # to read-only directories
+    (tmp_path / "read_only").touch()
+    monkeypatch.setattr(
+        image_io,
+        "get_file_manifest_path",
+        lambda dir_path: tmp_path / "read_only" / ".signal.manifest.json",
+    )
+
+    file_paths = list_files(tiff_planes_dir)
+
+    manifest_path = get_fallback_file_manifest_path(tiff_planes_dir)
+    assert manifest_path.parent == tmp_path / "manifest_cache"
+    assert not list(tmp_path.glob(".*.manifest.json"))
+    assert [f.name for f in file_paths] == [f"plane_{z}.tif" for z in range(4)]
+
+    # the cached manifest is reused, without scanning the directory
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    manifest["files"] = manifest["files"][:1]
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+    assert list_files(tiff_planes_dir) == file_paths[:1]
+
+
+def test_list_tiff_file_stats(tiff_planes_dir: Path):
+    """
+    Test the sizes and modification times of the planes in a directory are
+    read from its file manifest, and give the same fingerprint as the files
+
+    Parameters
+    ----------
+    tiff_planes_dir : Path
+        path to the directory of 2D TIFF planes
+    """
+    file_stats = list_tiff_file_stats(tiff_planes_dir)
+
+    file_paths = list_tiff_files(tiff_planes_dir)
+    assert file_stats == get_file_stats(file_paths)
+    assert fingerprint_file_stats(file_stats) == fingerprint_files(file_paths)
+
+    # the files are not read again while the directory is unchanged
+    manifest_path = get_file_manifest_path(tiff_planes_dir)
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    manifest["files"][0]["size"] = 0
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+    assert list_tiff_file_stats(tiff_planes_dir)[0][1] == 0
+
+
+def test_read_tiff_with_dask(tiff_planes_dir: Path, volume: np.ndarray):
+    """
+    Test reading a directory of 2D TIFF planes lazily, in natural order
+
+    Parameters
+    ----------
+    tiff_planes_dir : Path
+        path to the directory of 2D TIFF planes
+    volume : np.ndarray
+        the volume in the 2D TIFF planes
+    """
+    array = read_tiff_with_dask(tiff_planes_dir)
+
+    assert isinstance(array, da.Array)
+    np.testing.assert_array_equal(array, volume)
@@ -0,0 +1,110 @@
+import json
+import subprocess
+import sys
+import threading
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from brainglobe_workflows.metrics import RUN_METRICS_FILENAME, RunMetrics
+
+
+def test_run_metrics(tmp_path: Path):
+    """
+    Test the resources used by each stage are recorded and saved
+
+    Parameters
+    ----------
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    """
+    metrics = RunMetrics(sampling_interval=0.01)
+
+    with metrics.stage("allocate"):
+        array = np.ones(50 * 2**20, dtype=np.uint8)
+    with metrics.stage("save", channel=1):
+        np.save(tmp_path / "array.npy", array)
+
+    metrics_path = metrics.save(tmp_path / "output")
+
+    assert metrics_path == tmp_path / "output" / RUN_METRICS_FILENAME
+    with open(metrics_path) as f:
+        stages = json.load(f)["stages"]
+    assert [s["stage"] for s in stages] == ["allocate", "save"]
+    assert stages[1]["channel"] == 1
+    assert stages[0]["peak_rss_bytes"] >= array.nbytes
+    for stage in stages:
+        assert stage["wall_time_s"] > 0
+        assert stage["cpu_time_s"] >= 0
+        assert stage["overlapping_stages"] == []
+
+
+def test_run_metrics_failed_stage():
+    """
+    Test a stage that raises an exception is not recorded
+    """
+    metrics = RunMetrics()
+
+    with pytest.raises(ValueError):
+        with metrics.stage("detect"):
+            raise ValueError("detection failed")
+
+    assert metrics.stages == []
+
+
+def test_run_metrics_overlapping_stages():
+    """
+    Test the stages running at the same time in other threads are recorded
+    as overlapping, and those that ran before are not
+    """
+    metrics = RunMetrics()
+    started = threading.Event()
+    done = threading.Event()
+
+    def register():
+        with metrics.stage("register"):
+            started.set()
+            done.wait()
+
+    with metrics.stage("read", channel=0):
+        pass
+    thread = threading.Thread(target=register)
+    thread.start()
+    started.wait()
+    with metrics.stage("detect", channel=0):
+        pass
+    with metrics.stage("detect", channel=1):
+        done.set()
+        thread.join()
+    with metrics.stage("save", channel=1):
+        pass
+
+    stages = {(s["stage"], s.get("channel")): s for s in metrics.stages}
+    assert stages[("read", 0)]["overlapping_stages"] == []
+    assert stages[("register", None)]["overlapping_stages"] == [
+        {"stage": "detect", "channel": 0},
+        {"stage": "detect", "channel": 1},
+    ]
+    assert stages[("detect", 0)]["overlapping_stages"] == [
+        {"stage": "register"}
+    ]
+    assert stages[("save", 1)]["overlapping_stages"] == []
+
+
+def test_run_metrics_children_cpu_time():
+    """
+    Test the CPU time of a child process is recorded separately from that
+    of the process
+    """
+    metrics = RunMetrics()
+
+    with metrics.stage("register"):
+        subprocess.run(
+            [sys.executable, "-c", "sum(i * i for i in range(10**7))"],
+            check=True,
+        )
+
+    stage = metrics.stages[0]
+    assert stage["children_cpu_time_s"] > 0.1
+    assert stage["cpu_time_s"] < stage["children_cpu_time_s"]
@@ -0,0 +1,384 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+from typing import List
+
+import numpy as np
+import pytest
+from brainglobe_utils.cells.cells import Cell
+from brainglobe_utils.IO.cells import get_cells
+from cellfinder.core.main import main as cellfinder_run
+from scipy.spatial import cKDTree
+
+from brainglobe_workflows.cellfinder.cellfinder import (
+    CellfinderConfig,
+    get_cellfinder_run_kwargs,
+    read_input_data,
+)
+from brainglobe_workflows.cellfinder.shard import (
+    SHARD_FILENAME_TEMPLATE,
+    Shard,
+    compute_halo,
+    compute_shard_resources,
+    compute_shards,
+    main,
+    merge_shard_cells,
+    run_sharded_workflow,
+)
+from brainglobe_workflows.cellfinder.synthetic import generate_synthetic_data
+
+# a small network, to classify the synthetic cells quickly
+NETWORK_DEPTH = "18"
+
+
+@pytest.fixture(scope="module")
+def synthetic_config_path(tmp_path_factory: pytest.TempPathFactory) -> Path:
+    """Generate the synthetic data and its config, with randomly initialised
+    classification weights, so that no model is downloaded
+
+    Parameters
+    ----------
+    tmp_path_factory : pytest.TempPathFactory
+        Pytest fixture providing a temporary path shared by the tests of
+        the module
+
+    Returns
+    -------
+    Path
+        path to the cellfinder config of the synthetic data
+    """
+    from cellfinder.core.classify.tools import get_model
+    from cellfinder.core.train.train_yaml import models
+
+    data_dir = tmp_path_factory.mktemp("synthetic")
+    config_path = generate_synthetic_data(
+        data_dir, shape=(48, 128, 128), n_cells=6
+    )
+    weights_path = data_dir / "random.weights.h5"
+    get_model(network_depth=models[NETWORK_DEPTH]).save_weights(weights_path)
+
+    with open(config_path) as cfg:
+        config_dict = json.load(cfg)
+    config_dict.update(
+        model_weights=str(weights_path),
+        network_depth=NETWORK_DEPTH,
+        n_free_cpus=0,
+    )
+    with open(config_path, "w") as cfg:
+        json.dump(config_dict, cfg)
+    return config_path
+
+
+def write_config(config_path: Path, output_dir: Path) -> Path:
+    """Write a copy of a config with a different output directory"""
+    with open(config_path) as cfg:
+        config_dict = json.load(cfg)
+    config_dict["output_parent_dir"] = str(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    output_config_path = output_dir / config_path.name
+    with open(output_config_path, "w") as cfg:
+        json.dump(config_dict, cfg)
+    return output_config_path
+
+
+def read_config(config_path: Path, output_dir: Path) -> CellfinderConfig:
+    """Read a config with a different output directory, and prepare it"""
+    with open(write_config(config_path, output_dir)) as f:
+        cfg = CellfinderConfig(**json.load(f))
+    cfg.prepare()
+    return cfg
+
+
+@pytest.fixture(scope="module")
+def unsharded_cells(
+    synthetic_config_path: Path, tmp_path_factory: pytest.TempPathFactory
+) -> List[Cell]:
+    """Run `cellfinder_run` on the whole synthetic volume
+
+    Parameters
+    ----------
+    synthetic_config_path : Path
+        path to the cellfinder config of the synthetic data
+    tmp_path_factory : pytest.TempPathFactory
+        Pytest fixture providing a temporary path shared by the tests of
+        the module
+
+    Returns
+    -------
+    List[Cell]
+        the cells detected and classified in the whole volume
+    """
+    cfg = read_config(
+        synthetic_config_path, tmp_path_factory.mktemp("unsharded")
+    )
+    signal_array, background_array = read_input_data(cfg)
+    return cellfinder_run(
+        signal_array=signal_array,
+        background_array=background_array,
+        **get_cellfinder_run_kwargs(cfg),
+    )
+
+
+def assert_cells_match(
+    cells: List[Cell], expected_cells: List[Cell], cfg: CellfinderConfig
+):
+    """Check each expected cell has a cell within a soma radius, and there
+    are as many cells as expected"""
+    assert len(expected_cells) > 0
+    assert len(cells) == len(expected_cells)
+
+    def positions_um(cells: List[Cell]) -> np.ndarray:
+        zyx = np.array([[c.z, c.y, c.x] for c in cells], dtype=float)
+        return zyx * np.asarray(cfg.voxel_sizes, dtype=float)
+
+    distances, _ = cKDTree(positions_um(cells)).query(
+        positions_um(expected_cells)
+    )
+    assert np.all(distances < cfg.soma_diameter / 2)
+
+
+@pytest.mark.parametrize(
+    "voxel_sizes, ball_z_size, soma_diameter, expected_halo",
+    [
+        ([5, 2, 2], 15, 16, 3 + 4),
+        ([2, 1, 1], 15, 16, 8 + 8),
+    ],
+)
+def test_compute_halo(
+    voxel_sizes: list,
+    ball_z_size: float,
+    soma_diameter: float,
+    expected_halo: int,
+):
+    """
+    Test the halo is sized from the ball filter and the soma diameter
+
+    Parameters
+    ----------
+    voxel_sizes : list
+        voxel sizes in microns, in z, y, x order
+    ball_z_size : float
+        3d filter's axial filter ball size in microns
+    soma_diameter : float
+        the expected soma diameter in microns
+    expected_halo : int
+        expected number of halo planes
+    """
+    cfg = SimpleNamespace(
+        voxel_sizes=voxel_sizes,
+        ball_z_size=ball_z_size,
+        soma_diameter=soma_diameter,
+    )
+    assert compute_halo(cfg) == expected_halo
+
+
+def test_compute_shards():
+    """
+    Test shard cores tile the planes range and slabs include the halo
+    """
+    shards = compute_shards(10, 110, n_shards=4, halo=5)
+
+    assert shards == [
+        Shard(core_start=10, core_end=35, start_plane=10, end_plane=40),
+        Shard(core_start=35, core_end=60, start_plane=30, end_plane=65),
+        Shard(core_start=60, core_end=85, start_plane=55, end_plane=90),
+        Shard(core_start=85, core_end=110, start_plane=80, end_plane=110),
+    ]
+
+
+def test_compute_shards_more_shards_than_planes():
+    """
+    Test the number of shards is reduced if there are fewer planes
+    """
+    shards = compute_shards(0, 3, n_shards=8, halo=2)
+
+    assert len(shards) == 3
+    assert [s.core_start for s in shards] == [0, 1, 2]
+
+
+@pytest.mark.parametrize(
+    "n_cores, n_shards, n_free_cpus, n_processes, expected",
+    [
+        (4, 2, 0, None, (2, 2)),
+        (16, 8, 2, None, (7, 14)),
+        (16, 2, 2, None, (2, 9)),
+        (3, 4, 0, None, (1, 0)),
+        (16, 8, 2, 2, (2, 9)),
+    ],
+)
+def test_compute_shard_resources(
+    n_cores: int,
+    n_shards: int,
+    n_free_cpus: int,
+    n_processes: int,
+    expected: tuple,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    """
+    Test the available cores are split across the shards, each with at
+    least the minimum number of cores per shard
+
+    Parameters
+    ----------
+    n_cores : int
+        number of CPU cores in the machine
+    n_shards : int
+        number of shards
+    n_free_cpus : int
+        number of CPU cores to leave free for the whole workflow
+    n_processes : int
+        maximum number of shards to run concurrently
+    expected : tuple
+        expected number of processes and free cores per shard
+    monkeypatch : pytest.MonkeyPatch
+        a monkeypatch fixture
+    """
+    from brainglobe_workflows.cellfinder import batch
+
+    monkeypatch.setattr(batch, "get_cores_available", lambda: n_cores)
+
+    assert (
+        compute_shard_resources(n_shards, n_free_cpus, n_processes) == expected
+    )
+
+
+def test_run_sharded_workflow_concurrent(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    """
+    Test the shards run concurrently by default, on a machine with a few
+    cores
+
+    The worker processes are replaced by threads that wait for each other,
+    so the test fails if the shards run one at a time.
+
+    Parameters
+    ----------
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    monkeypatch : pytest.MonkeyPatch
+        a monkeypatch fixture
+    """
+    from brainglobe_workflows.cellfinder import batch, shard
+
+    n_shards = 2
+    shards = compute_shards(0, 40, n_shards=n_shards, halo=5)
+    all_shards_running = threading.Barrier(n_shards, timeout=30)
+
+    def run_shard_worker(cfg, shard_to_run, n_free_cpus):
+        all_shards_running.wait()
+        return [Cell([10, 10, shard_to_run.core_start], Cell.CELL)]
+
+    def thread_pool_executor(max_workers, mp_context, initializer):
+        return ThreadPoolExecutor(max_workers=max_workers)
+
+    monkeypatch.setattr(batch, "get_cores_available", lambda: 4)
+    monkeypatch.setattr(shard, "get_shards", lambda cfg, n: shards)
+    monkeypatch.setattr(shard, "_run_shard_worker", run_shard_worker)
+    monkeypatch.setattr(shard, "ProcessPoolExecutor", thread_pool_executor)
+    cfg = SimpleNamespace(
+        n_free_cpus=0,
+        voxel_sizes=(5, 2, 2),
+        soma_diameter=16,
+        _detected_cells_path=tmp_path / "detected_cells.xml",
+    )
+
+    cells = shard.run_sharded_workflow(cfg, n_shards)
+
+    assert sorted(cell.z for cell in cells) == [0, 20]
+
+
+def test_merge_shard_cells():
+    """
+    Test duplicated cells across a shard boundary are removed, and cells
+    far from each other are kept
+    """
+    shards = compute_shards(0, 100, n_shards=2, halo=10)
+    voxel_sizes = (5, 2, 2)
+    soma_diameter = 16
+
+    lower_cells = [
+        Cell([100, 100, 10], Cell.CELL),
+        Cell([200, 200, 49.6], Cell.CELL),  # near the boundary at z=50
+    ]
+    upper_cells = [
+        Cell([201, 200, 50.2], Cell.CELL),  # duplicate of the cell above
+        Cell([400, 400, 50.5], Cell.CELL),  # near boundary, not a duplicate
+        Cell([100, 100, 90], Cell.CELL),
+    ]
+
+    merged = merge_shard_cells(
+        [lower_cells, upper_cells], shards, voxel_sizes, soma_diameter
+    )
+
+    assert len(merged) == 4
+    assert all(cell.x != 201 for cell in merged)
+
+
+@pytest.mark.slow
+def test_run_sharded_workflow(
+    synthetic_config_path: Path, unsharded_cells: List[Cell], tmp_path: Path
+):
+    """
+    Test running the shards in worker processes finds the same cells as an
+    unsharded run, including those near the shard boundaries
+
+    Parameters
+    ----------
+    synthetic_config_path : Path
+        path to the cellfinder config of the synthetic data
+    unsharded_cells : List[Cell]
+        the cells found by an unsharded run
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    """
+    cfg = read_config(synthetic_config_path, tmp_path / "output")
+
+    cells = run_sharded_workflow(cfg, n_shards=2)
+
+    assert_cells_match(cells, unsharded_cells, cfg)
+    assert_cells_match(
+        get_cells(str(cfg._detected_cells_path)), unsharded_cells, cfg
+    )
+
+
+@pytest.mark.slow
+def test_shard_index_and_merge(
+    synthetic_config_path: Path, unsharded_cells: List[Cell], tmp_path: Path
+):
+    """
+    Test running each shard separately with `--shard-index`, as on
+    different nodes, and merging them with `--merge`, finds the same cells
+    as an unsharded run
+
+    Parameters
+    ----------
+    synthetic_config_path : Path
+        path to the cellfinder config of the synthetic data
+    unsharded_cells : List[Cell]
+        the cells found by an unsharded run
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    """
+    config_path = write_config(synthetic_config_path, tmp_path / "output")
+    shard_dir = tmp_path / "shards"
+    argv = ["--config", str(config_path), "--n-shards", "3"]
+    argv += ["--shard-dir", str(shard_dir)]
+
+    # the results of all the shards are needed to merge them
+    main([*argv, "--shard-index", "0"])
+    with pytest.raises(FileNotFoundError, match="Missing shard results"):
+        main([*argv, "--merge"])
+
+    for shard_index in (1, 2):
+        main([*argv, "--shard-index", str(shard_index)])
+    assert sorted(path.name for path in shard_dir.iterdir()) == [
+        SHARD_FILENAME_TEMPLATE.format(index=idx) for idx in range(3)
+    ]
+    cfg = main([*argv, "--merge"])
+
+    assert_cells_match(
+        get_cells(str(cfg._detected_cells_path)), unsharded_cells, cfg
+    )
@@ -0,0 +1,147 @@
+import csv
+import importlib.util
+from pathlib import Path
+
+import pytest
+from brainglobe_utils.cells.cells import MissingCellsError
+from brainglobe_utils.IO.cells import get_cells
+
+import brainglobe_workflows.cellfinder.sweep as sweep
+from brainglobe_workflows.cellfinder.cellfinder import (
+    CellfinderConfig,
+    detect_cell_candidates,
+    read_input_data,
+)
+
+
+def read_cells(cells_path: Path) -> list:
+    """Read the positions of the cells in a file, which may have none"""
+    try:
+        cells = get_cells(str(cells_path))
+    except MissingCellsError:
+        return []
+    return sorted((c.x, c.y, c.z) for c in cells)
+
+
+def test_get_sweep_combinations(config_synthetic_dict: dict):
+    """
+    Test the swept parameters not in a combination take their value from
+    the config, and unknown parameters are rejected
+
+    Parameters
+    ----------
+    config_synthetic_dict : dict
+        dictionary with the config for a cellfinder workflow run on a
+        synthetic volume
+    """
+    cfg = CellfinderConfig(
+        **config_synthetic_dict,
+        threshold_sweep=[{"n_sds_above_mean_thresh": 8}],
+    )
+    assert sweep.get_sweep_combinations(cfg) == [
+        {
+            "n_sds_above_mean_thresh": 8,
+            "n_sds_above_mean_tiled_thresh": cfg.n_sds_above_mean_tiled_thresh,
+            "max_cluster_size": cfg.max_cluster_size,
+        }
+    ]
+
+    cfg.threshold_sweep = [{"ball_z_size": 10}]
+    with pytest.raises(ValueError, match="cannot be swept"):
+        sweep.get_sweep_combinations(cfg)
+
+
+def test_run_threshold_sweep(
+    config_synthetic_dict: dict, monkeypatch: pytest.MonkeyPatch
+):
+    """
+    Test the threshold sweep filters the planes once, saves one cells file
+    per combination and a count table, and matches the cell candidates
+    detected by cellfinder with the same parameters
+
+    Parameters
+    ----------
+    config_synthetic_dict : dict
+        dictionary with the config for a cellfinder workflow run on a
+        synthetic volume
+    monkeypatch : pytest.MonkeyPatch
+        a monkeypatch fixture
+    """
+    cfg = CellfinderConfig(
+        **config_synthetic_dict,
+        threshold_sweep=[
+            {"n_sds_above_mean_thresh": 5},
+            {"n_sds_above_mean_thresh": 50},
+            {"n_sds_above_mean_thresh": 5, "max_cluster_size": 1},
+        ],
+    )
+    cfg.prepare()
+
+    detect_structures_calls = []
+
+    def detect_structures(filtered_planes, settings):
+        detect_structures_calls.append(settings.n_sds_above_mean_thresh)
+        return _detect_structures(filtered_planes, settings)
+
+    _detect_structures = sweep.detect_structures
+    monkeypatch.setattr(sweep, "detect_structures", detect_structures)
+    rows = sweep.run_threshold_sweep(cfg)
+
+    # combinations that only differ in max_cluster_size share the 3D filter
+    assert detect_structures_calls == [5, 50]
+
+    # the filtered planes are cached once
+    cache_dir = Path(cfg.output_parent_dir) / sweep.SWEEP_CACHE_DIRNAME
+    assert [f.name for f in cache_dir.iterdir()] == [
+        sweep.get_filter_cache_key(cfg)
+    ]
+
+    # one cells file per combination, and a count table
+    with open(Path(cfg._output_path) / sweep.SWEEP_TABLE_FILENAME) as f:
+        table = list(csv.DictReader(f))
+    assert [row["cells_file"] for row in table] == [
+        sweep.SWEEP_CELLS_FILENAME_TEMPLATE.format(index=idx)
+        for idx in range(3)
+    ]
+    assert [int(row["n_cell_candidates"]) for row in table] == [
+        row["n_cell_candidates"] for row in rows
+    ]
+
+    # the config's own thresholds match cellfinder's detection
+    signal_array, background_array = read_input_data(cfg)
+    candidates = detect_cell_candidates(cfg, signal_array, background_array)
+    assert len(candidates) > 0
+    assert read_cells(Path(cfg._output_path) / table[0]["cells_file"]) == (
+        sorted((c.x, c.y, c.z) for c in candidates)
+    )
+
+    # a higher threshold detects fewer candidates
+    assert rows[1]["n_cell_candidates"] < rows[0]["n_cell_candidates"]
+
+    # a later sweep reuses the filtered planes
+    def fail_filter_planes(*args):
+        raise AssertionError("The filtered planes should be reused")
+
+    monkeypatch.setattr(sweep, "_filter_planes", fail_filter_planes)
+    assert sweep.run_threshold_sweep(cfg) == rows
+
+
+def test_missing_cellfinder_internals(monkeypatch: pytest.MonkeyPatch):
+    """
+    Test importing the sweep with a cellfinder version that lacks the
+    detection internals it uses raises an error naming the tested versions
+
+    Parameters
+    ----------
+    monkeypatch : pytest.MonkeyPatch
+        Pytest fixture to remove a cellfinder internal
+    """
+    from cellfinder.core.detect.filters.plane import plane_filter
+
+    monkeypatch.delattr(plane_filter, "_threshold_planes")
+    # a separate copy of the module, so the imported one is not modified
+    spec = importlib.util.spec_from_file_location("sweep_copy", sweep.__file__)
+
+    with pytest.raises(ImportError, match="_threshold_planes") as error:
+        spec.loader.exec_module(importlib.util.module_from_spec(spec))
+    assert sweep.TESTED_CELLFINDER_VERSIONS in str(error.value)
@@ -0,0 +1,88 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pytest
+from brainglobe_utils.IO.cells import get_cells
+
+from brainglobe_workflows.cellfinder.cellfinder import (
+    CellfinderConfig,
+    detect_cell_candidates,
+    read_input_data,
+)
+from brainglobe_workflows.cellfinder.synthetic import (
+    SYNTHETIC_CELLS_FILENAME,
+    generate_synthetic_data,
+    sample_cell_positions,
+)
+
+
+def read_synthetic_config(config_path: Path, tmp_path: Path):
+    """Read the config of the synthetic data, with a temporary output"""
+    with open(config_path) as cfg:
+        config_dict = json.load(cfg)
+    config_dict["output_parent_dir"] = str(tmp_path / "output")
+    return CellfinderConfig(**config_dict)
+
+
+@pytest.mark.parametrize("data_format", ["tiff", "zarr"])
+def test_generate_synthetic_data(data_format: str, tmp_path: Path):
+    """
+    Test the synthetic data is deterministic, scaled, and readable by the
+    cellfinder workflow with the generated config
+
+    Parameters
+    ----------
+    data_format : str
+        on-disk layout of the synthetic data
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    """
+    kwargs = dict(shape=(8, 64, 64), n_cells=4, data_format=data_format)
+    config_path = generate_synthetic_data(tmp_path / "a", scale=2, **kwargs)
+    cfg = read_synthetic_config(config_path, tmp_path)
+    signal_array, background_array = read_input_data(cfg)
+
+    assert signal_array.shape == background_array.shape == (16, 64, 64)
+    assert signal_array.dtype == np.uint16
+    assert len(get_cells(str(tmp_path / "a" / SYNTHETIC_CELLS_FILENAME))) == 8
+    assert signal_array.max() == 1000
+    assert background_array.max() < 1000
+
+    # the same parameters generate the same data
+    other_config_path = generate_synthetic_data(
+        tmp_path / "b", scale=2, **kwargs
+    )
+    other_cfg = read_synthetic_config(other_config_path, tmp_path)
+    np.testing.assert_array_equal(read_input_data(other_cfg)[0], signal_array)
+
+
+def test_sample_cell_positions_too_many_cells():
+    """
+    Test an error is raised if the cells do not fit in the volume
+    """
+    with pytest.raises(ValueError, match="fits at most 8 cells"):
+        sample_cell_positions(
+            (4, 4, 4), 9, (2, 2, 2), np.random.default_rng(0)
+        )
+
+
+def test_detect_synthetic_cells(tmp_path: Path):
+    """
+    Test cellfinder detects the synthetic cells with the generated config
+
+    Parameters
+    ----------
+    tmp_path : Path
+        Pytest fixture providing a temporary path
+    """
+    config_path = generate_synthetic_data(
+        tmp_path, shape=(16, 128, 128), n_cells=4
+    )
+    cfg = read_synthetic_config(config_path, tmp_path)
+    cfg.prepare()
+    signal_array, background_array = read_input_data(cfg)
+
+    candidates = detect_cell_candidates(cfg, signal_array, background_array)
+
+    assert len(candidates) == 4